@@ -9,15 +9,28 @@ import os
 import re
 import sqlite3
 import logging
+import threading
+import queue
+import asyncio
+import functools
+import heapq
+import itertools
 import hashlib
 import hmac
 import json
-from datetime import datetime, timedelta, time as dt_time
-from typing import Dict, Any, Optional, List, Tuple
+import random
+import time
+import uuid
+from collections import deque, OrderedDict, Counter, defaultdict
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, time as dt_time
+from typing import Dict, Any, Optional, List, Set, Tuple, AsyncIterator, Callable, Awaitable
 from pathlib import Path
-from zoneinfo import ZoneInfo
+from urllib.parse import urlparse
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-import requests
+import httpx
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, constants
 from telegram.ext import (
@@ -28,6 +41,7 @@ from telegram.ext import (
     ContextTypes,
     filters
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 
 # ====
 # НАСТРОЙКА ЛОГИРОВАНИЯ
@@ -55,6 +69,20 @@ DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY", "").strip()
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "0"))
 DATABASE_PATH = os.getenv("DATABASE_PATH", "bot.db")
 
+# Получение обновлений: polling (для разработки) или webhook (продакшн)
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# Публичный HTTPS адрес webhook (путь адреса - путь, который слушает бот)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0").strip()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Секрет, который Telegram передаёт в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "").strip()
+# Сколько одновременных соединений Telegram открывает к webhook (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Запускать ли фоновые задачи (прогнозы, обслуживание БД). При нескольких
+# экземплярах бота за балансировщиком задачи включаются только на одном
+BOT_RUN_JOBS = os.getenv("BOT_RUN_JOBS", "1").strip() == "1"
+
 # YooKassa (обязательно для оплаты)
 YUKASSA_SHOP_ID = os.getenv("YUKASSA_SHOP_ID", "").strip()
 YUKASSA_SECRET_KEY = os.getenv("YUKASSA_SECRET_KEY", "").strip()
@@ -67,9 +95,149 @@ SUBSCRIPTION_MONTH_PRICE = int(os.getenv("SUBSCRIPTION_MONTH_PRICE", "399"))
 SUBSCRIPTION_YEAR_PRICE = int(os.getenv("SUBSCRIPTION_YEAR_PRICE", "3990"))
 FREE_DAILY_LIMIT = int(os.getenv("FREE_DAILY_LIMIT", "5"))
 
+# Стоимость разделов в единицах дневного лимита (по умолчанию 1)
+FEATURE_QUOTA_COSTS = {
+    'view_calendar': 2,
+}
+
+# Настройки SQLite
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+DB_CACHE_SIZE_MB = int(os.getenv("DB_CACHE_SIZE_MB", "64"))
+DB_MMAP_SIZE_MB = int(os.getenv("DB_MMAP_SIZE_MB", "256"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+# Буферизация статистики использования (usage_stats)
+STATS_FLUSH_BATCH_SIZE = int(os.getenv("STATS_FLUSH_BATCH_SIZE", "200"))
+STATS_FLUSH_INTERVAL_MS = int(os.getenv("STATS_FLUSH_INTERVAL_MS", "2000"))
+STATS_QUEUE_MAX_SIZE = int(os.getenv("STATS_QUEUE_MAX_SIZE", "10000"))
+
+# Размер кэша PRO статуса в памяти (записей)
+PRO_CACHE_MAX_SIZE = int(os.getenv("PRO_CACHE_MAX_SIZE", "100000"))
+# Через сколько секунд запись кэша PRO статуса перечитывается из БД: оплату,
+# обработанную другим экземпляром бота, этот экземпляр увидит не позже (0 - без срока)
+PRO_CACHE_TTL_SECONDS = int(os.getenv("PRO_CACHE_TTL_SECONDS", "60"))
+
+# История диалогов: сколько последних сообщений хранить
+HISTORY_KEEP_MESSAGES = 15
+# Сколько пользователей держать в кэше истории в памяти
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", "2000"))
+# Сжатие диалога: последние N сообщений передаются как есть, более старые
+# сворачиваются пачками в краткое резюме; бюджет токенов на резюме + историю
+HISTORY_VERBATIM_MESSAGES = int(os.getenv("HISTORY_VERBATIM_MESSAGES", "4"))
+HISTORY_SUMMARY_BATCH = int(os.getenv("HISTORY_SUMMARY_BATCH", "6"))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "400"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+
+# Обслуживание БД: срок хранения данных (в днях) и размер пачки удаления
+USAGE_STATS_RETENTION_DAYS = int(os.getenv("USAGE_STATS_RETENTION_DAYS", "180"))
+CONVERSATION_RETENTION_DAYS = int(os.getenv("CONVERSATION_RETENTION_DAYS", "90"))
+ACTIVE_USERS_RETENTION_DAYS = int(os.getenv("ACTIVE_USERS_RETENTION_DAYS", "90"))
+SESSION_RETENTION_DAYS = int(os.getenv("SESSION_RETENTION_DAYS", "7"))
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "1000"))
+MAINTENANCE_HOUR = int(os.getenv("MAINTENANCE_HOUR", "4"))
+
+# HTTP-клиент DeepSeek: пул keep-alive соединений и таймауты
+DEEPSEEK_MAX_CONNECTIONS = int(os.getenv("DEEPSEEK_MAX_CONNECTIONS", "20"))
+DEEPSEEK_MAX_KEEPALIVE = int(os.getenv("DEEPSEEK_MAX_KEEPALIVE", "10"))
+DEEPSEEK_KEEPALIVE_EXPIRY = float(os.getenv("DEEPSEEK_KEEPALIVE_EXPIRY", "60"))
+DEEPSEEK_TIMEOUT = float(os.getenv("DEEPSEEK_TIMEOUT", "60"))
+
+# Цены DeepSeek в долларах за 1 млн токенов (для отчёта /admin_costs):
+# вход с попаданием в кэш префикса, вход без попадания, ответ
+DEEPSEEK_PRICE_CACHE_HIT = float(os.getenv("DEEPSEEK_PRICE_CACHE_HIT", "0.028"))
+DEEPSEEK_PRICE_CACHE_MISS = float(os.getenv("DEEPSEEK_PRICE_CACHE_MISS", "0.28"))
+DEEPSEEK_PRICE_OUTPUT = float(os.getenv("DEEPSEEK_PRICE_OUTPUT", "0.42"))
+
+# Планировщик запросов к AI: общий лимит одновременных запросов и бюджеты
+# токенов в минуту по классам приоритета (0 - без ограничения)
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "16"))
+AI_TPM_PRO = int(os.getenv("AI_TPM_PRO", "0"))
+AI_TPM_FREE = int(os.getenv("AI_TPM_FREE", "0"))
+AI_TPM_BATCH = int(os.getenv("AI_TPM_BATCH", "120000"))
+
+# Устойчивость внешних вызовов (DeepSeek, YooKassa): повторы с экспоненциальной
+# задержкой со случайным разбросом и размыкатель цепи на каждый сервис
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "8"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+# Таймаут = p95 наблюдаемой задержки × множитель, в пределах [минимум, максимум]
+UPSTREAM_TIMEOUT_FACTOR = float(os.getenv("UPSTREAM_TIMEOUT_FACTOR", "2"))
+DEEPSEEK_TIMEOUT_MIN = float(os.getenv("DEEPSEEK_TIMEOUT_MIN", "15"))
+YUKASSA_TIMEOUT = float(os.getenv("YUKASSA_TIMEOUT", "30"))
+YUKASSA_TIMEOUT_MIN = float(os.getenv("YUKASSA_TIMEOUT_MIN", "5"))
+# Общий бюджет времени на вызов вместе со всеми повторами (секунды)
+DEEPSEEK_DEADLINE = float(os.getenv("DEEPSEEK_DEADLINE", "60"))
+YUKASSA_DEADLINE = float(os.getenv("YUKASSA_DEADLINE", "30"))
+
+# Потоковые ответы AI: не чаще одного редактирования сообщения раз в N секунд
+AI_STREAM_EDIT_INTERVAL = float(os.getenv("AI_STREAM_EDIT_INTERVAL", "1.5"))
+
+# Кэш ответов AI для разделов, зависящих только от нумерологического профиля
+AI_CACHE_TTL_DAYS = int(os.getenv("AI_CACHE_TTL_DAYS", "30"))
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "50000"))
+# Версия шаблонов кэшируемых промптов: увеличить при изменении их текста,
+# чтобы старые ответы больше не выдавались
+AI_PROMPT_TEMPLATE_VERSION = 2
+# Метка имени в кэшируемых ответах, при показе заменяется на имя пользователя
+AI_NAME_PLACEHOLDER = "{ИМЯ}"
+
+# Сколько когорт ежедневного прогноза генерировать одновременно
+FORECAST_GENERATION_CONCURRENCY = int(os.getenv("FORECAST_GENERATION_CONCURRENCY", "8"))
+
+# Рассылки: общий лимит сообщений в секунду (Bot API допускает ~30),
+# не чаще одного сообщения в чат раз в N секунд, число параллельных отправителей
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+# Повторы одного сообщения после RetryAfter и сетевых ошибок
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+# Как часто сохранять прогресс рассылки (мс) и сколько дней хранить отметки
+BROADCAST_CHECKPOINT_INTERVAL_MS = int(os.getenv("BROADCAST_CHECKPOINT_INTERVAL_MS", "1000"))
+BROADCAST_RETENTION_DAYS = int(os.getenv("BROADCAST_RETENTION_DAYS", "14"))
+# Размер страницы при выборке получателей рассылки
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+
+# Ежедневный прогноз: час отправки по умолчанию (по местному времени пользователя),
+# на сколько минут от начала часа разносятся отправки, как часто проверять
+# наступившие слоты (секунды) и за сколько минут до слота готовить текст
+FORECAST_HOUR = int(os.getenv("FORECAST_HOUR", "10"))
+FORECAST_SPREAD_MINUTES = int(os.getenv("FORECAST_SPREAD_MINUTES", "60"))
+FORECAST_TICK_SECONDS = int(os.getenv("FORECAST_TICK_SECONDS", "60"))
+FORECAST_LOOKAHEAD_MINUTES = int(os.getenv("FORECAST_LOOKAHEAD_MINUTES", "10"))
+# Размер очередей между этапами конвейера рассылки прогнозов
+FORECAST_PIPELINE_QUEUE_SIZE = int(os.getenv("FORECAST_PIPELINE_QUEUE_SIZE", "100"))
+# Недоставленный прогноз (ошибка отправки или генерации) повторяется через
+# FORECAST_RETRY_MINUTES, всего не больше FORECAST_MAX_ATTEMPTS попыток
+FORECAST_RETRY_MINUTES = int(os.getenv("FORECAST_RETRY_MINUTES", "5"))
+FORECAST_MAX_ATTEMPTS = int(os.getenv("FORECAST_MAX_ATTEMPTS", "5"))
+
 # Часовой пояс
 TZ = ZoneInfo("Europe/Moscow")
 
+def pack_date(d) -> int:
+    """Дата → целое YYYYMMDD (так даты и дни хранятся в БД)"""
+    return d.year * 10000 + d.month * 100 + d.day
+
+def unpack_date(value: Optional[int]) -> Optional[datetime]:
+    """Целое YYYYMMDD → datetime, без разбора строк"""
+    if value is None:
+        return None
+    return datetime(value // 10000, value // 100 % 100, value % 100)
+
+def from_epoch(value: Optional[int]) -> Optional[datetime]:
+    """Секунды Unix → локальный datetime"""
+    return datetime.fromtimestamp(value) if value is not None else None
+
+def quota_day() -> int:
+    """Текущий день по московскому времени (YYYYMMDD) - ключ сброса дневного лимита"""
+    return pack_date(datetime.now(TZ))
+
+def feature_cost(feature: str) -> int:
+    """Сколько единиц дневного лимита стоит раздел"""
+    return FEATURE_QUOTA_COSTS.get(feature, 1)
+
 # Валидация обязательных переменных
 if not BOT_TOKEN:
     raise RuntimeError("❌ В .env не задан BOT_TOKEN")
@@ -78,163 +246,887 @@ if not DEEPSEEK_API_KEY:
 
 logger.info("✅ Переменные окружения загружены")
 
+# ====
+# МИГРАЦИИ СХЕМЫ БД
+# ====
+
+def _column_exists(cursor: sqlite3.Cursor, table: str, column: str) -> bool:
+    """Проверяет наличие колонки в таблице"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cursor.fetchall())
+
+def _migration_base_schema(cursor: sqlite3.Cursor):
+    """Базовые таблицы (совместимо с БД, созданными до появления миграций)"""
+    # Таблица пользователей
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            name TEXT,
+            birthdate TEXT,
+            registration_date TEXT,
+            state TEXT DEFAULT 'idle',
+            language TEXT DEFAULT 'ru',
+            daily_requests INTEGER DEFAULT 0,
+            last_request_date TEXT,
+            daily_forecast_enabled INTEGER DEFAULT 1
+        )
+    """)
+    
+    # Поле daily_forecast_enabled для таблиц из ранних версий
+    if not _column_exists(cursor, "users", "daily_forecast_enabled"):
+        cursor.execute("ALTER TABLE users ADD COLUMN daily_forecast_enabled INTEGER DEFAULT 1")
+    
+    # Таблица подписок
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            subscription_type TEXT,
+            start_date TEXT,
+            expiry_date TEXT,
+            payment_status TEXT,
+            payment_id TEXT,
+            auto_renew INTEGER DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+    
+    # Таблица статистики использования
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS usage_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action_type TEXT,
+            timestamp TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+    
+    # История диалогов для AI
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            role TEXT,
+            content TEXT,
+            timestamp TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+    
+    # Индекс для быстрого поиска по user_id
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_conversation_user_id 
+        ON conversation_history(user_id, timestamp DESC)
+    """)
+
+def _migration_pro_until(cursor: sqlite3.Cursor):
+    """Материализованная дата окончания PRO (максимум по успешным подпискам)"""
+    if _column_exists(cursor, "users", "pro_until"):
+        return
+    cursor.execute("ALTER TABLE users ADD COLUMN pro_until TEXT")
+    cursor.execute("""
+        UPDATE users SET pro_until = (
+            SELECT MAX(s.expiry_date) FROM subscriptions s
+            WHERE s.user_id = users.user_id AND s.payment_status = 'succeeded'
+        )
+    """)
+
+def _migration_indexes(cursor: sqlite3.Cursor):
+    """Индексы под запросы статистики, поиска и рассылки"""
+    # get_stats / get_popular_functions: диапазон по времени + группировка (покрывающий)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_usage_stats_timestamp
+        ON usage_stats(timestamp, action_type)
+    """)
+    # /grant_pro @username
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+    # Поиск подписок пользователя
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_user
+        ON subscriptions(user_id, payment_status, expiry_date)
+    """)
+    # Подсчёт PRO пользователей в get_stats
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_pro_until ON users(pro_until)")
+    # Получатели ежедневной рассылки (частичный индекс)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_forecast
+        ON users(user_id, pro_until)
+        WHERE birthdate IS NOT NULL AND daily_forecast_enabled = 1
+    """)
+
+def _migration_daily_rollups(cursor: sqlite3.Cursor):
+    """Дневные агрегаты статистики для админ-панели (заполняются из usage_stats)"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_action_counts (
+            day TEXT NOT NULL,
+            action_type TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, action_type)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_active_users (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            day TEXT PRIMARY KEY,
+            actions INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    
+    # Перенос накопленной истории
+    cursor.execute("""
+        INSERT OR IGNORE INTO daily_action_counts (day, action_type, count)
+        SELECT substr(timestamp, 1, 10), action_type, COUNT(*)
+        FROM usage_stats
+        GROUP BY 1, 2
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO daily_active_users (day, user_id)
+        SELECT DISTINCT substr(timestamp, 1, 10), user_id FROM usage_stats
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO daily_totals (day, actions, active_users)
+        SELECT c.day, SUM(c.count),
+               (SELECT COUNT(*) FROM daily_active_users d WHERE d.day = c.day)
+        FROM daily_action_counts c
+        GROUP BY c.day
+    """)
+
+def _migration_conversation_index(cursor: sqlite3.Cursor):
+    """История читается и подрезается по (user_id, id) вместо timestamp"""
+    cursor.execute("DROP INDEX IF EXISTS idx_conversation_user_id")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_conversation_user
+        ON conversation_history(user_id, id)
+    """)
+
+def _outside_transaction(migrate):
+    """Помечает миграцию, которую нельзя выполнять внутри транзакции (например, VACUUM)"""
+    migrate.outside_transaction = True
+    return migrate
+
+@_outside_transaction
+def _migration_incremental_vacuum(cursor: sqlite3.Cursor):
+    """Перевод БД в режим auto_vacuum = INCREMENTAL (требует однократного VACUUM)"""
+    cursor.execute("PRAGMA auto_vacuum")
+    if cursor.fetchone()[0] == 2:
+        return
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.execute("VACUUM")
+
+def _rebuild_table(cursor: sqlite3.Cursor, table: str, columns_sql: str, select_sql: str,
+                   options: str = ""):
+    """Пересоздать таблицу с новыми типами колонок, перенеся данные через select_sql"""
+    cursor.execute(f"CREATE TABLE {table}_new ({columns_sql}) {options}")
+    cursor.execute(f"INSERT INTO {table}_new {select_sql}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+def _migration_integer_dates(cursor: sqlite3.Cursor):
+    """
+    Время - целые секунды Unix, даты и дни - целые YYYYMMDD вместо ISO-строк
+    (локальное время сервера переводится в UTC через модификатор 'utc')
+    """
+    epoch = "CAST(strftime('%s', {0}, 'utc') AS INTEGER)"
+    day = "CAST(replace({0}, '-', '') AS INTEGER)"
+    
+    _rebuild_table(cursor, "users", """
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        name TEXT,
+        birthdate INTEGER,
+        registration_date INTEGER,
+        state TEXT DEFAULT 'idle',
+        language TEXT DEFAULT 'ru',
+        daily_requests INTEGER DEFAULT 0,
+        last_request_date INTEGER,
+        daily_forecast_enabled INTEGER DEFAULT 1,
+        pro_until INTEGER
+    """, f"""
+        SELECT user_id, username, name,
+               CAST(substr(birthdate, 7, 4) || substr(birthdate, 4, 2) || substr(birthdate, 1, 2) AS INTEGER),
+               {epoch.format('registration_date')},
+               state, language, daily_requests,
+               {day.format('last_request_date')},
+               daily_forecast_enabled,
+               {epoch.format('pro_until')}
+        FROM users
+    """)
+    
+    _rebuild_table(cursor, "subscriptions", """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        subscription_type TEXT,
+        start_date INTEGER,
+        expiry_date INTEGER,
+        payment_status TEXT,
+        payment_id TEXT,
+        auto_renew INTEGER DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    """, f"""
+        SELECT id, user_id, subscription_type,
+               {epoch.format('start_date')}, {epoch.format('expiry_date')},
+               payment_status, payment_id, auto_renew
+        FROM subscriptions
+    """)
+    
+    _rebuild_table(cursor, "usage_stats", """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        action_type TEXT,
+        timestamp INTEGER,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    """, f"SELECT id, user_id, action_type, {epoch.format('timestamp')} FROM usage_stats")
+    
+    _rebuild_table(cursor, "conversation_history", """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        role TEXT,
+        content TEXT,
+        timestamp INTEGER,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    """, f"SELECT id, user_id, role, content, {epoch.format('timestamp')} FROM conversation_history")
+    
+    _rebuild_table(cursor, "daily_action_counts", """
+        day INTEGER NOT NULL,
+        action_type TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, action_type)
+    """, f"SELECT {day.format('day')}, action_type, count FROM daily_action_counts",
+       options="WITHOUT ROWID")
+    
+    _rebuild_table(cursor, "daily_active_users", """
+        day INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (day, user_id)
+    """, f"SELECT {day.format('day')}, user_id FROM daily_active_users",
+       options="WITHOUT ROWID")
+    
+    _rebuild_table(cursor, "daily_totals", """
+        day INTEGER PRIMARY KEY,
+        actions INTEGER NOT NULL DEFAULT 0,
+        active_users INTEGER NOT NULL DEFAULT 0
+    """, f"SELECT {day.format('day')}, actions, active_users FROM daily_totals",
+       options="WITHOUT ROWID")
+    
+    # Индексы удалились вместе со старыми таблицами
+    _migration_indexes(cursor)
+    _migration_conversation_index(cursor)
+
+def _migration_ai_response_cache(cursor: sqlite3.Cursor):
+    """Кэш ответов AI по отпечатку нумерологического профиля"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ai_response_cache (
+            key TEXT PRIMARY KEY,
+            feature TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            last_hit_at INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_ai_response_cache_last_hit
+        ON ai_response_cache(last_hit_at)
+    """)
+
+def _migration_conversation_summaries(cursor: sqlite3.Cursor):
+    """Резюме старой части диалога (сообщения до covered_until_id включительно)"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covered_until_id INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+
+def _migration_ai_calls(cursor: sqlite3.Cursor):
+    """Журнал запросов к AI: токены, задержка и finish_reason каждого вызова"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ai_calls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            feature TEXT NOT NULL,
+            user_id INTEGER,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            cached_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            latency_ms INTEGER NOT NULL,
+            finish_reason TEXT NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_ai_calls_day_feature
+        ON ai_calls(day, feature)
+    """)
+
+def _migration_broadcast_deliveries(cursor: sqlite3.Cursor):
+    """Отметки доставки рассылок (для продолжения после перезапуска) и users.blocked_at"""
+    if not _column_exists(cursor, "users", "blocked_at"):
+        cursor.execute("ALTER TABLE users ADD COLUMN blocked_at INTEGER")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            run_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (run_id, user_id)
+        ) WITHOUT ROWID
+    """)
+
+def _migration_forecast_recipients_index(cursor: sqlite3.Cursor):
+    """Частичный индекс получателей прогноза без заблокировавших бота"""
+    cursor.execute("DROP INDEX IF EXISTS idx_users_forecast")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_forecast
+        ON users(user_id, pro_until)
+        WHERE birthdate IS NOT NULL AND daily_forecast_enabled = 1 AND blocked_at IS NULL
+    """)
+
+def _migration_forecast_schedule(cursor: sqlite3.Cursor):
+    """Время и часовой пояс прогноза пользователя и расписание доставки"""
+    if not _column_exists(cursor, "users", "forecast_hour"):
+        cursor.execute("ALTER TABLE users ADD COLUMN forecast_hour INTEGER")
+    if not _column_exists(cursor, "users", "timezone"):
+        cursor.execute("ALTER TABLE users ADD COLUMN timezone TEXT")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS forecast_schedule (
+            user_id INTEGER PRIMARY KEY,
+            local_day INTEGER NOT NULL,
+            due_at INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_forecast_schedule_due
+        ON forecast_schedule(due_at)
+    """)
+
+def _migration_forecast_attempts(cursor: sqlite3.Cursor):
+    """Счётчик попыток доставки прогноза (для повторов после ошибок)"""
+    if not _column_exists(cursor, "forecast_schedule", "attempts"):
+        cursor.execute("ALTER TABLE forecast_schedule ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+def _migration_retention_indexes(cursor: sqlite3.Cursor):
+    """Индексы по времени для пакетной чистки по срокам хранения (без полного скана на пачку)"""
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_conversation_timestamp
+        ON conversation_history(timestamp)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_conversation_summaries_updated
+        ON conversation_summaries(updated_at)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_ai_response_cache_created
+        ON ai_response_cache(created_at)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_updated
+        ON broadcast_deliveries(updated_at)
+    """)
+
+def _migration_user_sessions(cursor: sqlite3.Cursor):
+    """Состояние диалога пользователя (мини-тест, ожидаемый платёж) - общее для всех экземпляров бота"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_sessions_updated
+        ON user_sessions(updated_at)
+    """)
+
+# Упорядоченный список миграций: номер миграции = позиция в списке (с 1).
+# Уже выпущенные миграции не меняются - только добавляются новые в конец
+MIGRATIONS = [
+    ("базовые таблицы", _migration_base_schema),
+    ("users.pro_until", _migration_pro_until),
+    ("индексы статистики, подписок и рассылки", _migration_indexes),
+    ("дневные агрегаты статистики", _migration_daily_rollups),
+    ("индекс истории диалогов по id", _migration_conversation_index),
+    ("инкрементальный vacuum", _migration_incremental_vacuum),
+    ("целочисленные даты и время", _migration_integer_dates),
+    ("кэш ответов AI", _migration_ai_response_cache),
+    ("резюме диалогов", _migration_conversation_summaries),
+    ("журнал запросов к AI", _migration_ai_calls),
+    ("отметки доставки рассылок", _migration_broadcast_deliveries),
+    ("индекс получателей прогноза", _migration_forecast_recipients_index),
+    ("расписание ежедневных прогнозов", _migration_forecast_schedule),
+    ("попытки доставки прогнозов", _migration_forecast_attempts),
+    ("индексы для чистки по срокам хранения", _migration_retention_indexes),
+    ("состояние диалогов пользователей", _migration_user_sessions),
+]
+
 # ====
 # БАЗА ДАННЫХ
 # ====
 
+class BufferedSink:
+    """
+    Буфер отложенной записи (write-behind) для некритичных событий
+    События копятся в памяти и сбрасываются фоновым потоком одной транзакцией:
+    как только накопилось batch_size событий или прошло flush_interval_ms.
+    Очередь ограничена: при переполнении новые события отбрасываются и считаются в dropped
+    """
+    
+    def __init__(self, name: str, write_batch, batch_size: int, flush_interval_ms: int, max_size: int):
+        self.name = name
+        self._write_batch = write_batch  # write_batch(rows) - запись пачки в БД
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_size = max_size
+        
+        self.dropped = 0
+        self.flushed = 0
+        
+        self._buffer: deque = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"sink-{name}", daemon=True)
+        self._thread.start()
+    
+    def put(self, row: tuple):
+        """Поставить событие в очередь (не блокирует и не обращается к БД)"""
+        with self._lock:
+            if len(self._buffer) >= self.max_size:
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 1000 == 0:
+                    logger.warning(f"⚠️ Буфер {self.name} переполнен, отброшено событий: {self.dropped}")
+                return
+            self._buffer.append(row)
+            if len(self._buffer) >= self.batch_size:
+                self._wakeup.set()
+    
+    def pending(self) -> int:
+        """Количество событий, ожидающих записи"""
+        with self._lock:
+            return len(self._buffer)
+    
+    def flush(self) -> int:
+        """Записать все накопленные события одной транзакцией"""
+        with self._lock:
+            if not self._buffer:
+                return 0
+            rows = list(self._buffer)
+            self._buffer.clear()
+        
+        try:
+            self._write_batch(rows)
+        except sqlite3.Error as e:
+            self.dropped += len(rows)
+            logger.error(f"❌ Не удалось записать {len(rows)} событий из буфера {self.name}: {e}")
+            return 0
+        
+        self.flushed += len(rows)
+        return len(rows)
+    
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+    
+    def close(self):
+        """Остановить фоновый поток и сбросить остаток буфера"""
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+class EntitlementCache:
+    """
+    Кэш PRO статуса в памяти процесса (LRU)
+    Хранит pro_until пользователя; запись с активной подпиской перестаёт
+    действовать ровно в момент pro_until и перечитывается из БД. Любая запись
+    (в том числе "не PRO") живёт не дольше ttl секунд, поэтому подписка,
+    оформленная через другой экземпляр бота, здесь тоже появится
+    """
+    
+    _MISS = object()
+    
+    def __init__(self, max_size: int, ttl: float = 0):
+        self.max_size = max_size
+        self.ttl = ttl if ttl > 0 else float("inf")
+        # user_id → (pro_until, когда запись перестаёт действовать по time.monotonic)
+        self._entries: "OrderedDict[int, Tuple[Optional[datetime], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, user_id: int):
+        """Вернуть pro_until из кэша или EntitlementCache._MISS"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return self._MISS
+            pro_until, expires_at = entry
+            if time.monotonic() >= expires_at or (pro_until is not None and pro_until <= datetime.now()):
+                # Запись устарела или подписка истекла - перечитываем из БД
+                del self._entries[user_id]
+                return self._MISS
+            self._entries.move_to_end(user_id)
+            return pro_until
+    
+    def set(self, user_id: int, pro_until: Optional[datetime]):
+        with self._lock:
+            self._entries[user_id] = (pro_until, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+class ConversationCache:
+    """
+    LRU-кэш истории диалогов в памяти: для каждого пользователя - кольцевой
+    буфер последних сообщений {id, role, content}. Записи в SQLite идут
+    сквозь кэш, а перед использованием буфер сверяется с последним id сообщения
+    пользователя в БД: сообщения, записанные другим экземпляром бота, приводят
+    к перечитыванию истории, а не к устаревшему контексту
+    """
+    
+    def __init__(self, max_users: int, keep_messages: int):
+        self.max_users = max_users
+        self.keep_messages = keep_messages
+        self._users: "OrderedDict[int, deque]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _fresh(self, user_id: int, last_id: int) -> Optional[deque]:
+        """
+        Буфер пользователя, если его последнее сообщение - last_id из БД
+        (под блокировкой); отставший буфер выбрасывается
+        """
+        messages = self._users.get(user_id)
+        if messages is not None and (messages[-1]['id'] if messages else 0) != last_id:
+            del self._users[user_id]
+            return None
+        return messages
+    
+    def has(self, user_id: int, last_id: int) -> bool:
+        """Есть ли в кэше актуальный буфер пользователя"""
+        with self._lock:
+            return self._fresh(user_id, last_id) is not None
+    
+    def since(self, user_id: int, after_id: int, last_id: int) -> Optional[List[Dict]]:
+        """
+        Сообщения с id больше after_id (вместе с id) или None, если пользователя
+        нет в кэше или буфер отстал от БД (последнее сообщение в БД - last_id)
+        """
+        with self._lock:
+            messages = self._fresh(user_id, last_id)
+            if messages is None:
+                return None
+            self._users.move_to_end(user_id)
+            return [dict(m) for m in messages if m['id'] > after_id]
+    
+    def load(self, user_id: int, rows: List[Dict], replace: bool = False) -> deque:
+        """
+        Положить историю, прочитанную из БД (от старых к новым)
+        Без replace не затирает уже загруженную запись - она может быть свежее
+        """
+        with self._lock:
+            messages = self._users.get(user_id)
+            if messages is None or replace:
+                messages = deque(rows, maxlen=self.keep_messages)
+                self._users[user_id] = messages
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            self._users.move_to_end(user_id)
+            return messages
+    
+    def append(self, user_id: int, message: Dict) -> Optional[int]:
+        """
+        Добавить сообщение в буфер пользователя (если он загружен)
+        Возвращает id самого старого сохранённого сообщения, если буфер заполнен -
+        всё, что старше, можно удалять из БД
+        """
+        with self._lock:
+            messages = self._users.get(user_id)
+            if messages is None:
+                return None
+            messages.append(message)
+            if len(messages) == messages.maxlen:
+                return messages[0]['id']
+            return None
+    
+    def discard(self, user_id: int):
+        with self._lock:
+            self._users.pop(user_id, None)
+    
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
 class Database:
-    """Менеджер базы данных SQLite с поддержкой истории диалогов"""
+    """
+    Менеджер базы данных SQLite с поддержкой истории диалогов
+    Держит долгоживущие подключения: одно для записи и пул для чтения (WAL)
+    """
     
-    def __init__(self, db_path: str = DATABASE_PATH):
+    def __init__(self, db_path: str = DATABASE_PATH, read_pool_size: int = DB_READ_POOL_SIZE):
         self.db_path = db_path
+        self.pro_cache = EntitlementCache(PRO_CACHE_MAX_SIZE, PRO_CACHE_TTL_SECONDS)
+        self.history_cache = ConversationCache(
+            HISTORY_CACHE_MAX_USERS, HISTORY_KEEP_MESSAGES
+        )
+        # Попадания и промахи кэша ответов AI по разделам (с момента запуска)
+        self.ai_cache_hits = Counter()
+        self.ai_cache_misses = Counter()
+        self._ai_cache_stats_lock = threading.Lock()
+        
+        # Единственное подключение для записи - SQLite всё равно допускает одного писателя
+        self._writer = self._open_connection()
+        self._write_lock = threading.Lock()
+        
+        # Журнал WAL переключается один раз и сохраняется в файле БД.
+        # auto_vacuum действует только для новой БД, существующие переводятся миграцией
+        self._writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._writer.execute("PRAGMA journal_mode = WAL")
         self.init_database()
-        logger.info(f"✅ База данных инициализирована: {db_path}")
+        
+        # Пул подключений для чтения: в режиме WAL читатели не блокируют писателя
+        self._readers: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(max(1, read_pool_size)):
+            self._readers.put(self._open_connection())
+        
+        # Статистика использования пишется пачками в фоне
+        self.usage_sink = BufferedSink(
+            "usage_stats", self._write_usage_batch,
+            batch_size=STATS_FLUSH_BATCH_SIZE,
+            flush_interval_ms=STATS_FLUSH_INTERVAL_MS,
+            max_size=STATS_QUEUE_MAX_SIZE
+        )
+        self.ai_calls_sink = BufferedSink(
+            "ai_calls", self._write_ai_calls_batch,
+            batch_size=STATS_FLUSH_BATCH_SIZE,
+            flush_interval_ms=STATS_FLUSH_INTERVAL_MS,
+            max_size=STATS_QUEUE_MAX_SIZE
+        )
+        self.broadcast_sink = BufferedSink(
+            "broadcast_deliveries", self._write_deliveries_batch,
+            batch_size=STATS_FLUSH_BATCH_SIZE,
+            flush_interval_ms=BROADCAST_CHECKPOINT_INTERVAL_MS,
+            max_size=STATS_QUEUE_MAX_SIZE
+        )
+        # Попадания в кэш ответов AI (hits, last_hit_at) - тоже пачками
+        self.ai_cache_hit_sink = BufferedSink(
+            "ai_response_cache", self._write_ai_cache_hits_batch,
+            batch_size=STATS_FLUSH_BATCH_SIZE,
+            flush_interval_ms=STATS_FLUSH_INTERVAL_MS,
+            max_size=STATS_QUEUE_MAX_SIZE
+        )
+        
+        logger.info(f"✅ База данных инициализирована: {db_path} (WAL, читателей: {read_pool_size})")
     
-    def get_connection(self):
-        """Создаёт подключение к БД"""
-        conn = sqlite3.connect(self.db_path)
+    def _open_connection(self) -> sqlite3.Connection:
+        """Открывает подключение и применяет настройки производительности"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               timeout=DB_BUSY_TIMEOUT_MS / 1000)
         conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_MB * 1024}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE_MB * 1024 * 1024}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
         return conn
     
-    def init_database(self):
-        """Инициализация таблиц БД"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Таблица пользователей
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    name TEXT,
-                    birthdate TEXT,
-                    registration_date TEXT,
-                    state TEXT DEFAULT 'idle',
-                    language TEXT DEFAULT 'ru',
-                    daily_requests INTEGER DEFAULT 0,
-                    last_request_date TEXT,
-                    daily_forecast_enabled INTEGER DEFAULT 1
-                )
-            """)
-            
-            # Добавляем поле daily_forecast_enabled для существующих таблиц
+    @contextmanager
+    def read_connection(self):
+        """Берёт подключение для чтения из пула и возвращает его после использования"""
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+    
+    @contextmanager
+    def write_connection(self):
+        """
+        Эксклюзивный доступ к подключению для записи
+        Коммит по успешному выходу из блока, откат при исключении
+        """
+        with self._write_lock:
             try:
-                cursor.execute("ALTER TABLE users ADD COLUMN daily_forecast_enabled INTEGER DEFAULT 1")
-            except sqlite3.OperationalError:
-                pass  # Поле уже существует
-            
-            # Таблица подписок
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS subscriptions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    subscription_type TEXT,
-                    start_date TEXT,
-                    expiry_date TEXT,
-                    payment_status TEXT,
-                    payment_id TEXT,
-                    auto_renew INTEGER DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
-            
-            # Таблица статистики использования
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS usage_stats (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    action_type TEXT,
-                    timestamp TEXT,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
-            
-            # НОВАЯ ТАБЛИЦА: История диалогов для AI
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS conversation_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    role TEXT,
-                    content TEXT,
-                    timestamp TEXT,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
-            
-            # Индекс для быстрого поиска по user_id
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_conversation_user_id 
-                ON conversation_history(user_id, timestamp DESC)
-            """)
-            
-            conn.commit()
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+    
+    def close(self):
+        """Сбрасывает буферы и закрывает все подключения"""
+        self.usage_sink.close()
+        self.ai_calls_sink.close()
+        self.broadcast_sink.close()
+        self.ai_cache_hit_sink.close()
+        with self._write_lock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+    
+    def init_database(self):
+        """
+        Приводит схему БД к актуальной версии
+        Номер применённой миграции хранится в PRAGMA user_version,
+        поэтому на актуальной схеме никакой DDL не выполняется
+        """
+        version = self._writer.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(MIGRATIONS):
+            return
+        
+        for number, (description, migrate) in enumerate(MIGRATIONS[version:], start=version + 1):
+            with self.write_connection() as conn:
+                if not getattr(migrate, "outside_transaction", False):
+                    conn.execute("BEGIN")
+                migrate(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {number}")
+            logger.info(f"🛠 Миграция БД #{number}: {description}")
+    
+    @staticmethod
+    def _user_from_row(row: sqlite3.Row) -> Dict:
+        """Строка users → dict, даты переводятся в datetime"""
+        user = dict(row)
+        user['birthdate'] = unpack_date(user['birthdate'])
+        user['registration_date'] = from_epoch(user['registration_date'])
+        user['pro_until'] = from_epoch(user['pro_until'])
+        return user
     
     def get_user(self, user_id: int) -> Optional[Dict]:
-        """Получить данные пользователя"""
-        with self.get_connection() as conn:
+        """
+        Получить данные пользователя
+        birthdate, registration_date и pro_until возвращаются как datetime
+        """
+        with self.read_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
             row = cursor.fetchone()
-            return dict(row) if row else None
+            return self._user_from_row(row) if row else None
     
     def create_user(self, user_id: int, username: str = None):
-        """Создать нового пользователя"""
-        with self.get_connection() as conn:
+        """
+        Создать нового пользователя
+        Для существующего снимает отметку blocked_at: раз пользователь пишет
+        боту, рассылки ему снова доставляются
+        """
+        with self.write_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                INSERT OR IGNORE INTO users (user_id, username, registration_date, last_request_date)
+                INSERT INTO users (user_id, username, registration_date, last_request_date)
                 VALUES (?, ?, ?, ?)
-            """, (user_id, username, datetime.now().isoformat(), datetime.now().date().isoformat()))
-            conn.commit()
+                ON CONFLICT (user_id) DO UPDATE SET blocked_at = NULL
+                WHERE blocked_at IS NOT NULL
+            """, (user_id, username, int(time.time()), quota_day()))
     
     def update_user(self, user_id: int, **kwargs):
-        """Обновить данные пользователя"""
-        with self.get_connection() as conn:
+        """Обновить данные пользователя (birthdate передаётся как datetime)"""
+        if kwargs.get('birthdate') is not None:
+            kwargs['birthdate'] = pack_date(kwargs['birthdate'])
+        
+        with self.write_connection() as conn:
             cursor = conn.cursor()
             fields = ", ".join([f"{k} = ?" for k in kwargs.keys()])
             values = list(kwargs.values()) + [user_id]
             cursor.execute(f"UPDATE users SET {fields} WHERE user_id = ?", values)
-            conn.commit()
+    
+    def get_session(self, user_id: int) -> Dict:
+        """Состояние диалога пользователя (мини-тест, ожидаемый платёж) или {}"""
+        with self.read_connection() as conn:
+            row = conn.execute("SELECT data FROM user_sessions WHERE user_id = ?", (user_id,)).fetchone()
+            return json.loads(row['data']) if row else {}
+    
+    def update_session(self, user_id: int, **values):
+        """
+        Изменить состояние диалога: значение None удаляет ключ
+        Хранится в БД, поэтому следующее обновление может обработать другой экземпляр бота
+        """
+        with self.write_connection() as conn:
+            row = conn.execute("SELECT data FROM user_sessions WHERE user_id = ?", (user_id,)).fetchone()
+            data = json.loads(row['data']) if row else {}
+            for key, value in values.items():
+                if value is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+            if data:
+                conn.execute("""
+                    INSERT OR REPLACE INTO user_sessions (user_id, data, updated_at)
+                    VALUES (?, ?, ?)
+                """, (user_id, json.dumps(data, ensure_ascii=False), int(time.time())))
+            else:
+                conn.execute("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
+    
+    def clear_session(self, user_id: int):
+        """Сбросить состояние диалога пользователя"""
+        with self.write_connection() as conn:
+            conn.execute("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
+    
+    def get_pro_until(self, user_id: int) -> Optional[datetime]:
+        """Дата окончания PRO подписки (из кэша, при промахе - из users.pro_until)"""
+        pro_until = self.pro_cache.get(user_id)
+        if pro_until is not EntitlementCache._MISS:
+            return pro_until
+        
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT pro_until FROM users WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+        
+        pro_until = from_epoch(row['pro_until']) if row else None
+        self.pro_cache.set(user_id, pro_until)
+        return pro_until
     
     def is_pro_user(self, user_id: int) -> bool:
         """Проверить наличие активной PRO подписки"""
-        with self.get_connection() as conn:
+        pro_until = self.get_pro_until(user_id)
+        return pro_until is not None and pro_until > datetime.now()
+    
+    def consume_quota(self, user_id: int, cost: int = 1) -> bool:
+        """
+        Проверить и списать cost единиц дневного лимита одним атомарным запросом
+        Счётчик лениво сбрасывается при смене дня (по МСК), PRO пользователи не ограничены.
+        Возвращает False, если лимит исчерпан
+        """
+        with self.write_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT * FROM subscriptions 
-                WHERE user_id = ? 
-                AND payment_status = 'succeeded'
-                AND expiry_date > ?
-            """, (user_id, datetime.now().isoformat()))
+                UPDATE users SET
+                    daily_requests = CASE WHEN last_request_date = :today
+                                          THEN daily_requests + :cost ELSE :cost END,
+                    last_request_date = :today
+                WHERE user_id = :user_id
+                AND (
+                    pro_until > :now
+                    OR (CASE WHEN last_request_date = :today THEN daily_requests ELSE 0 END)
+                       + :cost <= :limit
+                )
+                RETURNING daily_requests
+            """, {"user_id": user_id, "cost": cost, "today": quota_day(),
+                  "now": int(time.time()), "limit": FREE_DAILY_LIMIT})
             return cursor.fetchone() is not None
     
-    def check_daily_limit(self, user_id: int) -> bool:
-        """Проверить лимит запросов для FREE пользователей"""
-        if self.is_pro_user(user_id):
-            return True
-        
-        user = self.get_user(user_id)
-        if not user:
-            return False
-        
-        today = datetime.now().date().isoformat()
-        
-        # Сброс счётчика если новый день
-        if user['last_request_date'] != today:
-            self.update_user(user_id, daily_requests=0, last_request_date=today)
-            return True
-        
-        return user['daily_requests'] < FREE_DAILY_LIMIT
-    
-    def increment_daily_requests(self, user_id: int):
-        """Увеличить счётчик запросов"""
-        user = self.get_user(user_id)
-        if user:
-            self.update_user(user_id, daily_requests=user['daily_requests'] + 1)
+    def refund_quota(self, user_id: int, cost: int = 1):
+        """Вернуть списанные единицы лимита (например, если AI не ответил)"""
+        with self.write_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE users SET daily_requests = MAX(daily_requests - ?, 0)
+                WHERE user_id = ? AND last_request_date = ?
+            """, (cost, user_id, quota_day()))
     
     def add_subscription(self, user_id: int, subscription_type: str, months: int, payment_id: str = "ADMIN_GRANT"):
         """Добавить PRO подписку"""
-        with self.get_connection() as conn:
+        with self.write_connection() as conn:
             cursor = conn.cursor()
             start_date = datetime.now()
             expiry_date = start_date + timedelta(days=30 * months)
@@ -243,143 +1135,691 @@ class Database:
                 INSERT INTO subscriptions 
                 (user_id, subscription_type, start_date, expiry_date, payment_status, payment_id)
                 VALUES (?, ?, ?, ?, ?, ?)
-            """, (user_id, subscription_type, start_date.isoformat(), 
-                  expiry_date.isoformat(), "succeeded", payment_id))
-            conn.commit()
+            """, (user_id, subscription_type, int(start_date.timestamp()), 
+                  int(expiry_date.timestamp()), "succeeded", payment_id))
+            
+            # Поддерживаем денормализованный pro_until в актуальном состоянии
+            cursor.execute("""
+                UPDATE users SET pro_until = MAX(COALESCE(pro_until, 0), ?)
+                WHERE user_id = ?
+                RETURNING pro_until
+            """, (int(expiry_date.timestamp()), user_id))
+            row = cursor.fetchone()
+        
+        if row:
+            self.pro_cache.set(user_id, from_epoch(row['pro_until']))
     
     def log_action(self, user_id: int, action_type: str):
-        """Записать действие в статистику"""
-        with self.get_connection() as conn:
+        """
+        Записать действие в статистику
+        Событие попадает в буфер и записывается пачкой в фоне, поэтому
+        вызов не блокирует и не требует пула потоков БД
+        """
+        self.usage_sink.put((user_id, action_type, int(time.time())))
+    
+    def _write_usage_batch(self, rows: List[tuple]):
+        """
+        Записать пачку событий статистики одной транзакцией
+        В той же транзакции обновляются дневные агрегаты (daily_*), из которых
+        читает админ-панель
+        """
+        action_counts = Counter()
+        day_actions = Counter()
+        day_users = defaultdict(set)
+        for user_id, action_type, timestamp in rows:
+            day = pack_date(datetime.fromtimestamp(timestamp))
+            action_counts[(day, action_type)] += 1
+            day_actions[day] += 1
+            day_users[day].add(user_id)
+        
+        with self.write_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
+            cursor.executemany("""
                 INSERT INTO usage_stats (user_id, action_type, timestamp)
                 VALUES (?, ?, ?)
-            """, (user_id, action_type, datetime.now().isoformat()))
-            conn.commit()
+            """, rows)
+            
+            cursor.executemany("""
+                INSERT INTO daily_action_counts (day, action_type, count)
+                VALUES (?, ?, ?)
+                ON CONFLICT (day, action_type) DO UPDATE SET count = count + excluded.count
+            """, [(day, action_type, count) for (day, action_type), count in action_counts.items()])
+            
+            for day, user_ids in day_users.items():
+                cursor.executemany("""
+                    INSERT OR IGNORE INTO daily_active_users (day, user_id) VALUES (?, ?)
+                """, [(day, user_id) for user_id in user_ids])
+                new_active_users = cursor.rowcount
+                
+                cursor.execute("""
+                    INSERT INTO daily_totals (day, actions, active_users)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (day) DO UPDATE SET
+                        actions = actions + excluded.actions,
+                        active_users = active_users + excluded.active_users
+                """, (day, day_actions[day], new_active_users))
+    
+    def log_ai_call(self, feature: str, user_id: Optional[int], prompt_tokens: int,
+                    cached_tokens: int, completion_tokens: int, latency_ms: int,
+                    finish_reason: str):
+        """Записать запрос к AI в журнал ai_calls (через буфер, пачкой в фоне)"""
+        now = int(time.time())
+        self.ai_calls_sink.put((
+            now, pack_date(datetime.fromtimestamp(now)), feature, user_id,
+            prompt_tokens, cached_tokens, completion_tokens, latency_ms, finish_reason
+        ))
+    
+    def _write_ai_calls_batch(self, rows: List[tuple]):
+        """Записать пачку запросов к AI одной транзакцией"""
+        with self.write_connection() as conn:
+            conn.executemany("""
+                INSERT INTO ai_calls (created_at, day, feature, user_id, prompt_tokens,
+                                      cached_tokens, completion_tokens, latency_ms, finish_reason)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+    
+    def _ai_calls_summary(self, conn: sqlite3.Connection, group_by: str, since_day: int) -> List[Dict]:
+        """
+        Токены, стоимость и p50/p95 задержки из ai_calls с дня since_day,
+        сгруппированные по колонке group_by (feature или day)
+        """
+        rows = conn.execute(f"""
+            SELECT {group_by} AS grp, COUNT(*) AS calls,
+                   SUM(finish_reason = 'error') AS errors,
+                   SUM(prompt_tokens) AS prompt_tokens,
+                   SUM(cached_tokens) AS cached_tokens,
+                   SUM(completion_tokens) AS completion_tokens
+            FROM ai_calls
+            WHERE day >= ?
+            GROUP BY grp
+        """, (since_day,)).fetchall()
+        
+        # Перцентили считаются оконными функциями, без выгрузки всех задержек
+        percentiles = defaultdict(dict)
+        for row in conn.execute(f"""
+            SELECT grp, latency_ms, rn, n FROM (
+                SELECT {group_by} AS grp, latency_ms,
+                       ROW_NUMBER() OVER (PARTITION BY {group_by} ORDER BY latency_ms) - 1 AS rn,
+                       COUNT(*) OVER (PARTITION BY {group_by}) AS n
+                FROM ai_calls
+                WHERE day >= ? AND finish_reason != 'error'
+            )
+            WHERE rn = MIN(CAST(n * 0.5 AS INTEGER), n - 1)
+               OR rn = MIN(CAST(n * 0.95 AS INTEGER), n - 1)
+        """, (since_day,)):
+            ranks = percentiles[row['grp']]
+            if row['rn'] == min(int(row['n'] * 0.5), row['n'] - 1):
+                ranks['p50'] = row['latency_ms'] / 1000
+            if row['rn'] == min(int(row['n'] * 0.95), row['n'] - 1):
+                ranks['p95'] = row['latency_ms'] / 1000
+        
+        result = []
+        for row in rows:
+            missed_tokens = row['prompt_tokens'] - row['cached_tokens']
+            cost = (
+                row['cached_tokens'] * DEEPSEEK_PRICE_CACHE_HIT
+                + missed_tokens * DEEPSEEK_PRICE_CACHE_MISS
+                + row['completion_tokens'] * DEEPSEEK_PRICE_OUTPUT
+            ) / 1_000_000
+            result.append({
+                group_by: row['grp'],
+                "calls": row['calls'],
+                "errors": row['errors'],
+                "prompt_tokens": row['prompt_tokens'],
+                "cached_tokens": row['cached_tokens'],
+                "completion_tokens": row['completion_tokens'],
+                "cost": cost,
+                "p50": percentiles[row['grp']].get('p50'),
+                "p95": percentiles[row['grp']].get('p95'),
+            })
+        return result
+    
+    def get_ai_cost_report(self, days: int = 7) -> Dict:
+        """Отчёт по запросам к AI за последние days дней: по разделам и по дням"""
+        since_day = pack_date(datetime.now() - timedelta(days=days - 1))
+        with self.read_connection() as conn:
+            features = self._ai_calls_summary(conn, "feature", since_day)
+            by_day = self._ai_calls_summary(conn, "day", since_day)
+        
+        return {
+            "features": sorted(features, key=lambda item: item['cost'], reverse=True),
+            "days": sorted(by_day, key=lambda item: item['day'], reverse=True),
+            "pending": self.ai_calls_sink.pending(),
+            "dropped": self.ai_calls_sink.dropped
+        }
     
     def get_stats(self) -> Dict:
-        """Получить общую статистику"""
-        with self.get_connection() as conn:
+        """Получить общую статистику (активность - из дневных агрегатов)"""
+        today = datetime.now().date()
+        week_start = pack_date(today - timedelta(days=6))
+        
+        with self.read_connection() as conn:
             cursor = conn.cursor()
             
             cursor.execute("SELECT COUNT(*) FROM users")
             total_users = cursor.fetchone()[0]
             
             cursor.execute("""
-                SELECT COUNT(DISTINCT user_id) FROM subscriptions 
-                WHERE payment_status = 'succeeded' AND expiry_date > ?
-            """, (datetime.now().isoformat(),))
+                SELECT COUNT(*) FROM users WHERE pro_until > ?
+            """, (int(time.time()),))
             pro_users = cursor.fetchone()[0]
             
             cursor.execute("""
-                SELECT COUNT(*) FROM usage_stats 
-                WHERE timestamp > ?
-            """, ((datetime.now() - timedelta(days=7)).isoformat(),))
-            actions_week = cursor.fetchone()[0]
+                SELECT COALESCE(SUM(actions), 0), COALESCE(SUM(active_users), 0) / 7.0
+                FROM daily_totals 
+                WHERE day >= ?
+            """, (week_start,))
+            actions_week, active_week_avg = cursor.fetchone()
+            
+            cursor.execute("SELECT active_users FROM daily_totals WHERE day = ?", (pack_date(today),))
+            row = cursor.fetchone()
+            active_today = row[0] if row else 0
             
             return {
                 "total_users": total_users,
                 "pro_users": pro_users,
                 "free_users": total_users - pro_users,
-                "actions_week": actions_week
+                "actions_week": actions_week,
+                "active_today": active_today,
+                "active_week_avg": active_week_avg,
+                "stats_dropped": self.usage_sink.dropped
             }
     
     def get_all_users_with_status(self) -> List[Dict]:
         """Получить список всех пользователей с их статусом подписки"""
-        with self.get_connection() as conn:
+        with self.read_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT u.user_id, u.username, u.name, u.registration_date,
-                       CASE 
-                           WHEN EXISTS (
-                               SELECT 1 FROM subscriptions s 
-                               WHERE s.user_id = u.user_id 
-                               AND s.payment_status = 'succeeded' 
-                               AND s.expiry_date > ?
-                           ) THEN 'PRO'
-                           ELSE 'FREE'
-                       END as status
+                       CASE WHEN u.pro_until > ? THEN 'PRO' ELSE 'FREE' END as status
                 FROM users u
                 ORDER BY u.registration_date DESC
-            """, (datetime.now().isoformat(),))
-            return [dict(row) for row in cursor.fetchall()]
+            """, (int(time.time()),))
+            return [dict(row, registration_date=from_epoch(row['registration_date']))
+                    for row in cursor.fetchall()]
     
     def get_popular_functions(self, limit: int = 10) -> List[Tuple[str, int]]:
-        """Получить статистику популярности функций бота"""
-        with self.get_connection() as conn:
+        """Получить статистику популярности функций бота за 30 дней (из дневных агрегатов)"""
+        with self.read_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT action_type, COUNT(*) as count
-                FROM usage_stats
-                WHERE timestamp > ?
+                SELECT action_type, SUM(count) as count
+                FROM daily_action_counts
+                WHERE day >= ?
                 GROUP BY action_type
                 ORDER BY count DESC
                 LIMIT ?
-            """, ((datetime.now() - timedelta(days=30)).isoformat(), limit))
+            """, (pack_date(datetime.now() - timedelta(days=29)), limit))
             return [(row['action_type'], row['count']) for row in cursor.fetchall()]
     
-    # ===== МЕТОДЫ ДЛЯ ИСТОРИИ ДИАЛОГОВ =====
+    def get_user_id_by_username(self, username: str) -> Optional[int]:
+        """Найти user_id по Telegram username (без @)"""
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id FROM users WHERE username = ?", (username,))
+            row = cursor.fetchone()
+            return row['user_id'] if row else None
     
-    def add_message_to_history(self, user_id: int, role: str, content: str):
+    def get_forecast_recipients_page(self, after_user_id: int, limit: int) -> List[Dict]:
         """
-        Добавить сообщение в историю диалога
-        role: 'user' или 'assistant'
+        Страница получателей ежедневного прогноза: PRO пользователи с датой
+        рождения и включенной рассылкой, user_id > after_user_id по возрастанию
+        Условия совпадают с частичным индексом idx_users_forecast, поэтому
+        страница читается из индекса без просмотра всей таблицы
         """
-        with self.get_connection() as conn:
+        with self.read_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                INSERT INTO conversation_history (user_id, role, content, timestamp)
+                SELECT user_id, name, birthdate, forecast_hour, timezone
+                FROM users
+                WHERE birthdate IS NOT NULL 
+                AND daily_forecast_enabled = 1
+                AND blocked_at IS NULL
+                AND user_id > ?
+                AND pro_until > ?
+                ORDER BY user_id
+                LIMIT ?
+            """, (after_user_id, int(time.time()), limit))
+            return [dict(row, birthdate=unpack_date(row['birthdate'])) for row in cursor.fetchall()]
+    
+    # ===== РАССЫЛКИ =====
+    
+    def mark_chat_blocked(self, user_id: int):
+        """Отметить, что пользователь заблокировал бота или удалил аккаунт"""
+        with self.write_connection() as conn:
+            conn.execute("""
+                UPDATE users SET blocked_at = ? WHERE user_id = ? AND blocked_at IS NULL
+            """, (int(time.time()), user_id))
+    
+    def record_delivery(self, run_id: str, user_id: int, status: str):
+        """Сохранить результат доставки (через буфер, пачкой в фоне)"""
+        self.broadcast_sink.put((run_id, user_id, status, int(time.time())))
+    
+    def _write_deliveries_batch(self, rows: List[tuple]):
+        """Записать пачку отметок доставки одной транзакцией"""
+        with self.write_connection() as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO broadcast_deliveries (run_id, user_id, status, updated_at)
                 VALUES (?, ?, ?, ?)
-            """, (user_id, role, content, datetime.now().isoformat()))
-            conn.commit()
+            """, rows)
+    
+    def get_completed_deliveries(self, run_id: str, user_ids: List[int]) -> Set[int]:
+        """Кому из user_ids рассылка run_id уже доставлена (или чат недоступен)"""
+        self.broadcast_sink.flush()
+        with self.read_connection() as conn:
+            cursor = conn.execute(f"""
+                SELECT user_id FROM broadcast_deliveries
+                WHERE run_id = ? AND status IN ('sent', 'blocked')
+                AND user_id IN ({", ".join("?" * len(user_ids))})
+            """, (run_id, *user_ids))
+            return {row['user_id'] for row in cursor}
+    
+    def save_forecast_schedule(self, rows: List[Tuple[int, int, int]]):
+        """Запланировать прогнозы: (user_id, местный день YYYYMMDD, due_at)"""
+        with self.write_connection() as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO forecast_schedule (user_id, local_day, due_at)
+                VALUES (?, ?, ?)
+            """, rows)
     
-    def get_conversation_history(self, user_id: int, limit: int = 10) -> List[Dict]:
+    def get_due_forecasts_page(self, cutoff: int, after: Tuple[int, int], limit: int) -> List[Dict]:
         """
-        Получить последние N сообщений из истории диалога
-        Возвращает список в формате [{role: 'user'/'assistant', content: '...'}]
+        Страница прогнозов, чей слот наступил до cutoff, по (due_at, user_id) > after
+        Пользователи, переставшие быть получателями после планирования, пропускаются
         """
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT role, content, timestamp
-                FROM conversation_history
-                WHERE user_id = ?
-                ORDER BY timestamp DESC
+        with self.read_connection() as conn:
+            cursor = conn.execute("""
+                SELECT s.user_id, s.local_day, s.due_at, u.name, u.birthdate
+                FROM forecast_schedule s
+                JOIN users u ON u.user_id = s.user_id
+                WHERE s.due_at <= ?
+                AND (s.due_at, s.user_id) > (?, ?)
+                AND u.birthdate IS NOT NULL
+                AND u.daily_forecast_enabled = 1
+                AND u.blocked_at IS NULL
+                AND u.pro_until > ?
+                ORDER BY s.due_at, s.user_id
                 LIMIT ?
-            """, (user_id, limit))
+            """, (cutoff, *after, int(time.time()), limit))
+            return [dict(row, birthdate=unpack_date(row['birthdate'])) for row in cursor.fetchall()]
+    
+    def get_upcoming_forecast_profiles(self, until: int) -> List[Tuple[int, datetime]]:
+        """Пары (местный день, дата рождения) прогнозов со слотом до until"""
+        with self.read_connection() as conn:
+            cursor = conn.execute("""
+                SELECT DISTINCT s.local_day, u.birthdate
+                FROM forecast_schedule s
+                JOIN users u ON u.user_id = s.user_id
+                WHERE s.due_at <= ? AND u.birthdate IS NOT NULL
+            """, (until,))
+            return [(row['local_day'], unpack_date(row['birthdate'])) for row in cursor.fetchall()]
+    
+    def finish_forecasts(self, rows: List[Tuple[int, int]]):
+        """Убрать из расписания доставленные прогнозы: (user_id, местный день)"""
+        with self.write_connection() as conn:
+            conn.executemany(
+                "DELETE FROM forecast_schedule WHERE user_id = ? AND local_day = ?", rows
+            )
+    
+    def retry_forecasts(self, rows: List[Tuple[int, int]], due_at: int, max_attempts: int) -> int:
+        """
+        Перенести недоставленные прогнозы (user_id, местный день) на due_at.
+        Прогнозы, исчерпавшие max_attempts попыток, удаляются; возвращает их число
+        """
+        with self.write_connection() as conn:
+            conn.executemany("""
+                UPDATE forecast_schedule SET due_at = ?, attempts = attempts + 1
+                WHERE user_id = ? AND local_day = ?
+            """, [(due_at, user_id, local_day) for user_id, local_day in rows])
+            return conn.executemany("""
+                DELETE FROM forecast_schedule
+                WHERE user_id = ? AND local_day = ? AND attempts >= ?
+            """, [(user_id, local_day, max_attempts) for user_id, local_day in rows]).rowcount
+    
+    def clear_stale_forecasts(self, cutoff: int) -> int:
+        """Убрать наступившие слоты тех, кто после планирования перестал быть получателем"""
+        with self.write_connection() as conn:
+            return conn.execute("""
+                DELETE FROM forecast_schedule
+                WHERE due_at <= ? AND user_id NOT IN (
+                    SELECT user_id FROM users
+                    WHERE birthdate IS NOT NULL
+                    AND daily_forecast_enabled = 1
+                    AND blocked_at IS NULL
+                    AND pro_until > ?
+                )
+            """, (cutoff, int(time.time()))).rowcount
+    
+    # ===== МЕТОДЫ ДЛЯ ИСТОРИИ ДИАЛОГОВ =====
+    
+    def _load_history(self, conn: sqlite3.Connection, user_id: int) -> List[Dict]:
+        """Последние HISTORY_KEEP_MESSAGES сообщений из БД (от старых к новым)"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, role, content
+            FROM conversation_history
+            WHERE user_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (user_id, HISTORY_KEEP_MESSAGES))
+        return [dict(row) for row in reversed(cursor.fetchall())]
+    
+    def _last_history_id(self, conn: sqlite3.Connection, user_id: int) -> int:
+        """id последнего сообщения пользователя в БД (0, если истории нет)"""
+        row = conn.execute("""
+            SELECT MAX(id) AS last_id FROM conversation_history WHERE user_id = ?
+        """, (user_id,)).fetchone()
+        return row['last_id'] or 0
+    
+    def _append_history(self, conn: sqlite3.Connection, user_id: int, role: str, content: str) -> Optional[int]:
+        """
+        Записать сообщение в БД и в кэш (вызывается под блокировкой записи)
+        Возвращает id, старше которого историю можно подрезать
+        """
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO conversation_history (user_id, role, content, timestamp)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, role, content, int(time.time())))
+        return self.history_cache.append(
+            user_id, {"id": cursor.lastrowid, "role": role, "content": content}
+        )
+    
+    def add_dialog_turn(self, user_id: int, question: str, answer: str):
+        """
+        Сохранить пару вопрос/ответ одной транзакцией и подрезать историю
+        до HISTORY_KEEP_MESSAGES сообщений (удаление по границе id)
+        """
+        with self.write_connection() as conn:
+            if not self.history_cache.has(user_id, self._last_history_id(conn, user_id)):
+                self.history_cache.load(user_id, self._load_history(conn, user_id), replace=True)
             
-            # Возвращаем в обратном порядке (от старых к новым)
-            messages = [{"role": row['role'], "content": row['content']} 
-                       for row in reversed(cursor.fetchall())]
-            return messages
+            self._append_history(conn, user_id, "user", question)
+            cutoff_id = self._append_history(conn, user_id, "assistant", answer)
+            
+            if cutoff_id is not None:
+                conn.execute("""
+                    DELETE FROM conversation_history WHERE user_id = ? AND id < ?
+                """, (user_id, cutoff_id))
+    
+    def get_dialog_context(self, user_id: int) -> Tuple[Optional[str], List[Dict]]:
+        """
+        Резюме старой части диалога и сообщения после неё (от старых к новым, с id)
+        Сообщения берутся из кэша истории, если пользователь в нём есть
+        и буфер не отстал от БД (сверка по последнему id - один поиск по индексу)
+        """
+        with self.read_connection() as conn:
+            row = conn.execute("""
+                SELECT summary, covered_until_id FROM conversation_summaries WHERE user_id = ?
+            """, (user_id,)).fetchone()
+            covered_until_id = row['covered_until_id'] if row else 0
+            
+            last_id = self._last_history_id(conn, user_id)
+            messages = self.history_cache.since(user_id, covered_until_id, last_id)
+            if messages is None:
+                rows = self._load_history(conn, user_id)
+                self.history_cache.load(user_id, rows)
+                messages = [r for r in rows if r['id'] > covered_until_id]
+        
+        return (row['summary'] if row else None), messages
+    
+    def save_conversation_summary(self, user_id: int, summary: str, covered_until_id: int):
+        """
+        Сохранить резюме диалога до сообщения covered_until_id включительно
+        Более старое резюме (например, из параллельного сжатия) не затирает новое
+        """
+        with self.write_connection() as conn:
+            conn.execute("""
+                INSERT INTO conversation_summaries (user_id, summary, covered_until_id, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    summary = excluded.summary,
+                    covered_until_id = excluded.covered_until_id,
+                    updated_at = excluded.updated_at
+                WHERE excluded.covered_until_id > conversation_summaries.covered_until_id
+            """, (user_id, summary, covered_until_id, int(time.time())))
     
     def clear_conversation_history(self, user_id: int):
-        """Очистить историю диалога пользователя"""
-        with self.get_connection() as conn:
+        """Очистить историю диалога пользователя (вместе с резюме)"""
+        with self.write_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM conversation_history WHERE user_id = ?", (user_id,))
-            conn.commit()
+            cursor.execute("DELETE FROM conversation_summaries WHERE user_id = ?", (user_id,))
+            self.history_cache.load(user_id, [], replace=True)
     
-    def trim_conversation_history(self, user_id: int, keep_last: int = 15):
+    # ===== КЭШ ОТВЕТОВ AI =====
+    
+    def get_cached_response(self, key: str) -> Optional[str]:
         """
-        Оставить только последние N сообщений, удалить старые
-        Это предотвращает неограниченный рост таблицы
+        Ответ AI из кэша по ключу ai_cache_key или None
+        Запись старше AI_CACHE_TTL_DAYS считается промахом. Чтение идёт через
+        пул читателей, счётчик попаданий и last_hit_at обновляются пачками
         """
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                DELETE FROM conversation_history
-                WHERE user_id = ? AND id NOT IN (
-                    SELECT id FROM conversation_history
-                    WHERE user_id = ?
-                    ORDER BY timestamp DESC
-                    LIMIT ?
-                )
-            """, (user_id, user_id, keep_last))
-            conn.commit()
+        now = int(time.time())
+        feature = key.partition(":")[0]
+        with self.read_connection() as conn:
+            row = conn.execute("""
+                SELECT response FROM ai_response_cache
+                WHERE key = ? AND created_at > ?
+            """, (key, now - AI_CACHE_TTL_DAYS * 24 * 60 * 60)).fetchone()
+        
+        with self._ai_cache_stats_lock:
+            if row:
+                self.ai_cache_hits[feature] += 1
+            else:
+                self.ai_cache_misses[feature] += 1
+        if not row:
+            return None
+        self.ai_cache_hit_sink.put((key, now))
+        return row['response']
+    
+    def _write_ai_cache_hits_batch(self, rows: List[tuple]):
+        """Записать пачку попаданий в кэш ответов AI: (key, время попадания)"""
+        hits = Counter(key for key, _ in rows)
+        last_hit = {}
+        for key, hit_at in rows:
+            last_hit[key] = max(last_hit.get(key, 0), hit_at)
+        with self.write_connection() as conn:
+            conn.executemany("""
+                UPDATE ai_response_cache SET hits = hits + ?, last_hit_at = MAX(last_hit_at, ?)
+                WHERE key = ?
+            """, [(count, last_hit[key], key) for key, count in hits.items()])
+    
+    def put_cached_response(self, key: str, response: str):
+        """Сохранить ответ AI в кэш (вытеснение старых записей - в run_maintenance)"""
+        now = int(time.time())
+        with self.write_connection() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO ai_response_cache
+                (key, feature, response, created_at, last_hit_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (key, key.partition(":")[0], response, now, now))
+    
+    def get_ai_cache_stats(self) -> Dict:
+        """Метрики кэша ответов AI: попадания/промахи с запуска и записи по разделам"""
+        self.ai_cache_hit_sink.flush()
+        with self.read_connection() as conn:
+            rows = conn.execute("""
+                SELECT feature, COUNT(*) as entries, SUM(hits) as stored_hits
+                FROM ai_response_cache
+                GROUP BY feature
+            """).fetchall()
+        
+        features = {row['feature']: {"entries": row['entries'], "stored_hits": row['stored_hits']}
+                    for row in rows}
+        hits = sum(self.ai_cache_hits.values())
+        misses = sum(self.ai_cache_misses.values())
+        for feature in set(self.ai_cache_hits) | set(self.ai_cache_misses):
+            info = features.setdefault(feature, {"entries": 0, "stored_hits": 0})
+            info["hits"] = self.ai_cache_hits[feature]
+            info["misses"] = self.ai_cache_misses[feature]
+        
+        return {
+            "entries": sum(info["entries"] for info in features.values()),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "features": features
+        }
+    
+    # ===== ОБСЛУЖИВАНИЕ БД =====
+    
+    def _delete_in_batches(self, table: str, condition: str, params: tuple, key: str = "rowid") -> int:
+        """
+        Удалить строки пачками по MAINTENANCE_BATCH_SIZE
+        Каждая пачка - отдельная короткая транзакция, между ними блокировку
+        записи могут получить обработчики. key - ключ строки (для WITHOUT ROWID таблиц)
+        """
+        deleted = 0
+        while True:
+            with self.write_connection() as conn:
+                cursor = conn.execute(f"""
+                    DELETE FROM {table} WHERE ({key}) IN (
+                        SELECT {key} FROM {table} WHERE {condition} LIMIT ?
+                    )
+                """, (*params, MAINTENANCE_BATCH_SIZE))
+                batch = cursor.rowcount
+            deleted += batch
+            if batch < MAINTENANCE_BATCH_SIZE:
+                return deleted
+            time.sleep(0.01)
+    
+    def _evict_ai_cache(self, expired_before: int) -> int:
+        """Удалить из кэша AI просроченные записи и давно не используемые сверх AI_CACHE_MAX_ENTRIES"""
+        self.ai_cache_hit_sink.flush()
+        with self.read_connection() as conn:
+            row = conn.execute("""
+                SELECT last_hit_at FROM ai_response_cache
+                ORDER BY last_hit_at DESC
+                LIMIT 1 OFFSET ?
+            """, (AI_CACHE_MAX_ENTRIES,)).fetchone()
+        # Всё, что использовалось не позже (MAX+1)-й по свежести записи, вытесняется
+        lru_cutoff = row['last_hit_at'] + 1 if row else 0
+        
+        return self._delete_in_batches(
+            "ai_response_cache", "created_at <= ? OR last_hit_at < ?",
+            (expired_before, lru_cutoff)
+        )
+    
+    def _database_size(self) -> int:
+        """Занятый объём файла БД в байтах (без свободных страниц)"""
+        with self.read_connection() as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            return page_size * page_count
+    
+    def run_maintenance(self) -> Dict:
+        """
+        Плановое обслуживание: удаление данных старше срока хранения,
+        инкрементальный vacuum и PRAGMA optimize. Возвращает отчёт
+        """
+        size_before = self._database_size()
+        now = int(time.time())
+        day = 24 * 60 * 60
+        
+        deleted = {
+            "usage_stats": self._delete_in_batches(
+                "usage_stats", "timestamp < ?",
+                (now - USAGE_STATS_RETENTION_DAYS * day,)
+            ),
+            "conversation_history": self._delete_in_batches(
+                "conversation_history", "timestamp < ?",
+                (now - CONVERSATION_RETENTION_DAYS * day,)
+            ),
+            "conversation_summaries": self._delete_in_batches(
+                "conversation_summaries", "updated_at < ?",
+                (now - CONVERSATION_RETENTION_DAYS * day,)
+            ),
+            "daily_active_users": self._delete_in_batches(
+                "daily_active_users", "day < ?",
+                (pack_date(datetime.now() - timedelta(days=ACTIVE_USERS_RETENTION_DAYS)),),
+                key="day, user_id"
+            ),
+            "ai_response_cache": self._evict_ai_cache(now - AI_CACHE_TTL_DAYS * day),
+            "ai_calls": self._delete_in_batches(
+                "ai_calls", "day < ?",
+                (pack_date(datetime.now() - timedelta(days=USAGE_STATS_RETENTION_DAYS)),)
+            ),
+            "broadcast_deliveries": self._delete_in_batches(
+                "broadcast_deliveries", "updated_at < ?",
+                (now - BROADCAST_RETENTION_DAYS * day,),
+                key="run_id, user_id"
+            ),
+            "user_sessions": self._delete_in_batches(
+                "user_sessions", "updated_at < ?",
+                (now - SESSION_RETENTION_DAYS * day,)
+            ),
+        }
+        
+        if deleted["conversation_history"]:
+            # Кэш мог содержать удалённые сообщения
+            self.history_cache.clear()
+        
+        # Возвращаем свободные страницы файловой системе небольшими порциями.
+        # Только в режиме auto_vacuum = INCREMENTAL (2); если порция ничего
+        # не освободила, дальше не крутимся
+        with self.read_connection() as conn:
+            incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        free_pages = None
+        while incremental:
+            with self.write_connection() as conn:
+                remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not remaining or (free_pages is not None and remaining >= free_pages):
+                    break
+                free_pages = remaining
+                # executescript выполняет pragma до конца (execute освобождает одну страницу за шаг)
+                conn.executescript(f"PRAGMA incremental_vacuum({MAINTENANCE_BATCH_SIZE});")
+            time.sleep(0.01)
+        
+        with self.write_connection() as conn:
+            conn.execute("PRAGMA optimize")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        
+        size_after = self._database_size()
+        return {
+            "deleted": deleted,
+            "size_before": size_before,
+            "size_after": size_after,
+            "reclaimed_bytes": max(size_before - size_after, 0)
+        }
+
+
+class AsyncDatabase:
+    """
+    Асинхронный фасад над Database для обработчиков бота
+    Каждый метод Database доступен как корутина и выполняется в отдельном пуле
+    потоков, поэтому запросы к SQLite не блокируют event loop
+    """
+    
+    def __init__(self, database: Database, max_workers: int = DB_READ_POOL_SIZE + 1):
+        self._db = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+    
+    async def run(self, func, *args, **kwargs):
+        """Выполнить произвольную синхронную функцию в пуле потоков БД"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+    
+    def __getattr__(self, name: str):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        return method
+    
+    def shutdown(self):
+        """Дождаться завершения запросов и закрыть подключения"""
+        self._executor.shutdown(wait=True)
+        self._db.close()
 
 # Глобальный экземпляр БД
 db = Database()
+adb = AsyncDatabase(db)
 
 # ====
 # НУМЕРОЛОГИЧЕСКИЕ РАСЧЁТЫ
@@ -536,6 +1976,203 @@ FINANCE_NOTES = {
     9: "Деньги через миссию и пользу людям. Риск — выгорание."
 }
 
+# ====
+# УСТОЙЧИВЫЕ ВЫЗОВЫ ВНЕШНИХ СЕРВИСОВ
+# ====
+
+class UpstreamUnavailable(Exception):
+    """Размыкатель цепи открыт: сервис недавно много раз подряд не отвечал"""
+
+class LatencyTracker:
+    """
+    Последние задержки успешных вызовов и таймаут по ним:
+    p95 × UPSTREAM_TIMEOUT_FACTOR в пределах [min_timeout, max_timeout].
+    Пока замеров мало, используется max_timeout
+    """
+    
+    MIN_SAMPLES = 20
+    
+    def __init__(self, min_timeout: float, max_timeout: float, window: int = 200):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._samples = deque(maxlen=window)
+    
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+    
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+    
+    def timeout(self) -> float:
+        if len(self._samples) < self.MIN_SAMPLES:
+            return self.max_timeout
+        return min(max(self.percentile(0.95) * UPSTREAM_TIMEOUT_FACTOR, self.min_timeout), self.max_timeout)
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи: после failure_threshold неудачных вызовов подряд вызовы
+    сразу отклоняются reset_seconds секунд, затем пропускается один пробный вызов.
+    Успех замыкает цепь, неудача снова размыкает её. Вызов с повторами
+    считается одним сбоем - когда повторы исчерпаны
+    """
+    
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+    
+    def allow(self) -> bool:
+        """Можно ли сейчас выполнять вызов"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+    
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._probing = False
+    
+    def abandon(self):
+        """Вызов прерван не по вине сервиса (отмена и т.п.) - пробный слот освобождается"""
+        self._probing = False
+
+def _is_retryable(error: Exception) -> bool:
+    """Сетевые ошибки, таймауты, 429 и 5xx - временные; прочие 4xx повторять бессмысленно"""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+class Upstream:
+    """
+    Вызовы одного внешнего сервиса: размыкатель цепи, таймауты по наблюдаемой
+    задержке (отдельно для каждой операции) и повторы временных ошибок
+    с экспоненциальной задержкой и случайным разбросом (full jitter).
+    Все попытки одного вызова укладываются в общий бюджет deadline секунд
+    """
+    
+    def __init__(self, name: str, min_timeout: float, max_timeout: float, deadline: float):
+        self.name = name
+        self.deadline = deadline
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.latency: Dict[str, LatencyTracker] = {}
+        self.retries = 0
+        self.rejected = 0
+    
+    def tracker(self, operation: str) -> LatencyTracker:
+        if operation not in self.latency:
+            self.latency[operation] = LatencyTracker(self.min_timeout, self.max_timeout)
+        return self.latency[operation]
+    
+    def observe(self, operation: str, seconds: float):
+        """Записать задержку операции (для потоков - время до первого куска)"""
+        self.tracker(operation).observe(seconds)
+    
+    async def call(self, operation: str, request: Callable[[float], Awaitable[Any]],
+                   can_retry: Callable[[], bool] = lambda: True,
+                   record_latency: bool = True, deadline: Optional[float] = None):
+        """
+        Выполнить request(timeout) с повторами временных ошибок
+        can_retry: повторять ли после очередной ошибки (например, только пока
+                   поток ещё ничего не выдал); вызов должен быть идемпотентным
+        record_latency: учитывать длительность вызова в таймаутах операции
+        deadline: бюджет времени на все попытки (по умолчанию self.deadline);
+                  таймаут попытки не больше остатка, повтор начинается,
+                  только если после паузы остаётся не меньше min_timeout
+        Выбрасывает UpstreamUnavailable, если цепь разомкнута. Цепь учитывает
+        итог всего вызова, а не каждую попытку: один запрос пользователя
+        с повторами не размыкает её для всех
+        """
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise UpstreamUnavailable(f"{self.name}: сервис временно недоступен")
+        
+        expires_at = time.monotonic() + (deadline or self.deadline)
+        recorded = False
+        try:
+            for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+                started = time.monotonic()
+                try:
+                    result = await request(min(self.tracker(operation).timeout(), expires_at - started))
+                except httpx.HTTPError as e:
+                    if not _is_retryable(e):
+                        # Ошибка запроса, а не сервиса - цепь не трогаем,
+                        # только освобождаем пробный слот (в finally)
+                        raise
+                    delay = random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+                    retry_after = getattr(getattr(e, "response", None), "headers", {}).get("Retry-After", "")
+                    if retry_after.isdigit():
+                        delay = max(delay, min(float(retry_after), UPSTREAM_BACKOFF_MAX))
+                    out_of_time = expires_at - time.monotonic() - delay < self.min_timeout
+                    # Повторы или время исчерпаны, либо цепь уже разомкнули другие вызовы
+                    if (attempt == UPSTREAM_MAX_RETRIES or out_of_time or not can_retry()
+                            or self.breaker.state == "open"):
+                        recorded = True
+                        self.breaker.record_failure()
+                        raise
+                    self.retries += 1
+                    logger.warning(
+                        f"⚠️ {self.name}/{operation}: {e} - повтор {attempt + 1} через {delay:.1f} с"
+                    )
+                    await asyncio.sleep(delay)
+                    continue
+                
+                recorded = True
+                self.breaker.record_success()
+                if record_latency:
+                    self.observe(operation, time.monotonic() - started)
+                return result
+        finally:
+            if not recorded:
+                # Исход ничего не говорит о сервисе (ошибка запроса, отмена) -
+                # пробный слот освобождается, счётчик сбоев не меняется
+                self.breaker.abandon()
+    
+    def snapshot(self) -> Dict:
+        """Состояние цепи, повторы и таймауты по операциям"""
+        return {
+            "state": self.breaker.state,
+            "failures": self.breaker.failures,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "operations": {
+                operation: {
+                    "p50": tracker.percentile(0.5),
+                    "p95": tracker.percentile(0.95),
+                    "timeout": tracker.timeout(),
+                }
+                for operation, tracker in self.latency.items()
+            }
+        }
+
+deepseek_upstream = Upstream("DeepSeek", DEEPSEEK_TIMEOUT_MIN, DEEPSEEK_TIMEOUT, DEEPSEEK_DEADLINE)
+yukassa_upstream = Upstream("YooKassa", YUKASSA_TIMEOUT_MIN, YUKASSA_TIMEOUT, YUKASSA_DEADLINE)
+
 # ====
 # YOOKASSA ИНТЕГРАЦИЯ
 # ====
@@ -547,15 +2184,22 @@ class YooKassaPayment:
         self.shop_id = shop_id
         self.secret_key = secret_key
         self.api_url = "https://api.yookassa.ru/v3/payments"
+        self._client: Optional[httpx.AsyncClient] = None
     
-    def create_payment(self, amount: float, description: str, user_id: int, 
-                      return_url: str = None) -> Optional[Dict]:
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Клиент создаётся лениво - уже внутри работающего event loop"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(auth=(self.shop_id, self.secret_key))
+        return self._client
+    
+    async def create_payment(self, amount: float, description: str, user_id: int, 
+                             return_url: str = None) -> Optional[Dict]:
         """
         Создать платёж в YooKassa
         Возвращает dict с payment_id и confirmation_url
         """
-        import uuid
-        
+        # Один ключ на все повторы: YooKassa не создаст второй платёж
         idempotence_key = str(uuid.uuid4())
         
         headers = {
@@ -579,16 +2223,18 @@ class YooKassaPayment:
             }
         }
         
-        try:
-            response = requests.post(
+        async def request(timeout: float) -> httpx.Response:
+            response = await self.client.post(
                 self.api_url,
                 json=payload,
                 headers=headers,
-                auth=(self.shop_id, self.secret_key),
-                timeout=30
+                timeout=timeout
             )
             response.raise_for_status()
-            
+            return response
+        
+        try:
+            response = await yukassa_upstream.call("create_payment", request)
             result = response.json()
             return {
                 "payment_id": result.get("id"),
@@ -596,27 +2242,33 @@ class YooKassaPayment:
                 "status": result.get("status")
             }
         
-        except requests.exceptions.RequestException as e:
+        except (httpx.HTTPError, UpstreamUnavailable) as e:
             logger.error(f"YooKassa API Error: {e}")
             return None
         except Exception as e:
             logger.error(f"Unexpected error in YooKassa: {e}")
             return None
     
-    def check_payment(self, payment_id: str) -> Optional[Dict]:
+    async def check_payment(self, payment_id: str) -> Optional[Dict]:
         """Проверить статус платежа"""
-        try:
-            response = requests.get(
-                f"{self.api_url}/{payment_id}",
-                auth=(self.shop_id, self.secret_key),
-                timeout=30
-            )
+        async def request(timeout: float) -> httpx.Response:
+            response = await self.client.get(f"{self.api_url}/{payment_id}", timeout=timeout)
             response.raise_for_status()
+            return response
+        
+        try:
+            response = await yukassa_upstream.call("check_payment", request)
             return response.json()
         except Exception as e:
             logger.error(f"Error checking payment: {e}")
             return None
     
+    async def close(self):
+        """Закрыть пул соединений"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
     @staticmethod
     def verify_webhook_signature(body: bytes, signature: str, secret_key: str) -> bool:
         """
@@ -645,34 +2297,494 @@ else:
 # DEEPSEEK AI ИНТЕГРАЦИЯ С ИСТОРИЕЙ ДИАЛОГОВ
 # ====
 
-def ask_deepseek_ai(prompt: str, user_id: int = None, max_tokens: int = 1500, 
-                   use_history: bool = True) -> str:
+class AIServiceError(Exception):
+    """AI не смог ответить (ошибка сети, API или формата ответа)"""
+
+# Текст для пользователя, если AI не ответил (лимит при этом возвращается)
+AI_UNAVAILABLE_TEXT = (
+    "⚠️ <b>AI временно недоступен</b>\n\n"
+    "Не удалось получить ответ. Попробуйте ещё раз чуть позже — "
+    "этот запрос не засчитан в дневной лимит."
+)
+
+# ====
+# Промпт собирается так, чтобы начало совпадало между запросами (DeepSeek
+# кэширует общий префикс): сначала SYSTEM_PROMPT и шаблон раздела из
+# FEATURE_TEMPLATES - они одинаковы для всех пользователей, затем профиль,
+# история и сам запрос. Меняющиеся данные в шаблоны не подставляются
+# ====
+
+SYSTEM_PROMPT = (
+    "Ты — цифровой психолог-нумеролог, работающий с числами сознания, миссии, матрицей (цифры 1–9), "
+    "стилем действия и финансовым кодом. "
+    "Никакой астрологии, гороскопов, знаков зодиака, таро, чакр и т.п. "
+    "Форматируй ответ для Telegram-HTML: используй <b>жирный</b>, <i>курсив</i>, списки с эмодзи. "
+    "НЕ используй *, #, кодовые блоки ``` или таблицы Markdown. "
+    "Будь тёплым, эмпатичным и конкретным. Давай практические советы."
+)
+
+FEATURE_TEMPLATES = {
+    'ai_question': (
+        "Отвечай на вопросы пользователя, опираясь на его нумерологический профиль. "
+        "Давай конкретные практические рекомендации. Ответ форматируй в Telegram-HTML."
+    ),
+    'free_text_query': (
+        "Отвечай, используя нумерологический профиль пользователя, форматируй в Telegram-HTML."
+    ),
+    'compatibility_check': (
+        "Сделай анализ совместимости пользователя с партнёром на основе нумерологического "
+        "анализа. Профиль пользователя и дата рождения партнёра - в сообщении пользователя.\n\n"
+        "Формат ответа в Telegram-HTML:\n"
+        "<b>💑 Совместимость</b>\n\n"
+        "<b>✅ Сильные стороны пары:</b>\n"
+        "(перечисли 3-4 пункта с эмодзи)\n\n"
+        "<b>⚠️ Возможные вызовы:</b>\n"
+        "(перечисли 2-3 пункта)\n\n"
+        "<b>💡 Рекомендации:</b>\n"
+        "(дай 3-4 практических совета)"
+    ),
+    'test_complete': (
+        "Пользователь прошёл мини-диагностику на основе нумерологии. Его профиль, "
+        "вопросы и ответы - в сообщении пользователя.\n\n"
+        "Сделай краткий вывод в Telegram-HTML:\n"
+        "<b>✨ Сильные стороны</b>\n"
+        "<b>🎯 Зоны роста</b>\n"
+        "<b>💡 Рекомендация недели</b>"
+    ),
+    'view_practices': (
+        "Составь персональные практики на основе нумерологии для прокачки зон роста "
+        "(пустых чисел матрицы) пользователя. "
+        "Для каждого числа дай 2-3 простых конкретных шага.\n"
+        "Формат Telegram-HTML с эмодзи."
+    ),
+    'view_guide': (
+        "Составь персональный гайд на основе нумерологии. Формат Telegram-HTML:\n"
+        "<b>✨ Сильные стороны</b> (3-4 пункта)\n"
+        "<b>🎯 Зоны роста</b> (2-3 пункта)\n"
+        "<b>💪 Практика недели</b> (конкретное упражнение)\n"
+        "<b>💡 Ключевой совет</b>\n"
+        "Коротко, дружелюбно, без воды."
+    ),
+    'view_media': (
+        "Подбери 6-8 рекомендаций книг и фильмов под нумерологический профиль. "
+        "Для каждого укажи название и кратко (1 строка) — почему подходит.\n"
+        "Формат Telegram-HTML с эмодзи 📚 и 🎬."
+    ),
+    'view_calendar': (
+        "Создай персональный календарь на неделю вперед: дни и числа дня - в сообщении "
+        "пользователя. Для каждого дня дай краткую рекомендацию (1-2 строки) с учётом "
+        "числа дня и профиля пользователя.\n"
+        "Формат Telegram-HTML с эмодзи."
+    ),
+    'daily_forecast': (
+        "Создай персонализированный прогноз на сегодня (дата, число дня и числа "
+        "пользователя - в сообщении пользователя) в формате Telegram-HTML:\n\n"
+        "1. <b>🌟 Энергия дня</b> (2-3 предложения о числе дня и что оно несет)\n"
+        "2. <b>💫 Для тебя сегодня</b> (как энергия дня взаимодействует с числом сознания пользователя)\n"
+        "3. <b>✨ Сильные стороны дня</b> (3-4 пункта списком с эмодзи)\n"
+        "4. <b>⚠️ На что обратить внимание</b> (2-3 пункта списком с эмодзи)\n"
+        "5. <b>🎯 Совет дня</b> (конкретная рекомендация)\n\n"
+        "Не обращайся к пользователю по имени. "
+        "Будь кратким, позитивным и практичным. Ответ должен быть не более 400 слов."
+    ),
+    'history_summary': (
+        "Тебе дают предыдущее резюме диалога и новые сообщения. Обнови резюме с учётом "
+        "новых сообщений: о чём спрашивал пользователь, какие советы он получил, "
+        "важные факты о нём. Пиши кратко, простым текстом, не более 150 слов."
+    ),
+}
+
+class AIFeatureUsage:
+    """
+    Токены и задержка запросов к AI по разделам (с момента запуска), в том
+    числе prompt_cache_hit_tokens / prompt_cache_miss_tokens из usage DeepSeek
+    """
+    
+    def __init__(self):
+        self._features: Dict[str, Counter] = defaultdict(Counter)
+    
+    def record(self, feature: str, usage: Dict, latency: float):
+        stats = self._features[feature or "other"]
+        stats["calls"] += 1
+        stats["latency"] += latency
+        for field in ("prompt_cache_hit_tokens", "prompt_cache_miss_tokens", "completion_tokens"):
+            stats[field] += usage.get(field, 0)
+    
+    def snapshot(self) -> Dict[str, Dict]:
+        result = {}
+        for feature, stats in sorted(self._features.items()):
+            prompt_tokens = stats["prompt_cache_hit_tokens"] + stats["prompt_cache_miss_tokens"]
+            result[feature] = {
+                "calls": stats["calls"],
+                "hit_tokens": stats["prompt_cache_hit_tokens"],
+                "miss_tokens": stats["prompt_cache_miss_tokens"],
+                "completion_tokens": stats["completion_tokens"],
+                "hit_rate": stats["prompt_cache_hit_tokens"] / prompt_tokens if prompt_tokens else 0.0,
+                "avg_latency": stats["latency"] / stats["calls"],
+            }
+        return result
+
+ai_feature_usage = AIFeatureUsage()
+
+class DeepSeekClient:
+    """
+    Асинхронный клиент DeepSeek API поверх httpx.AsyncClient
+    
+    Соединения к api.deepseek.com держатся в пуле keep-alive, поэтому
+    запросы не делают TLS-рукопожатие заново и не блокируют event loop:
+    ответы разных пользователей ждутся параллельно
+    """
+    
+    BASE_URL = "https://api.deepseek.com/v1"
+    
+    def __init__(self, api_key: str, max_connections: int, max_keepalive: int,
+                 keepalive_expiry: float, timeout: float):
+        self.api_key = api_key
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=min(timeout, 10.0))
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Клиент создаётся лениво - уже внутри работающего event loop"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.BASE_URL,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+                limits=self.limits,
+                timeout=self.timeout,
+            )
+        return self._client
+    
+    async def chat(self, payload: Dict[str, Any], timeout: float = None) -> Dict[str, Any]:
+        """POST /chat/completions, возвращает разобранный JSON ответа"""
+        response = await self.client.post(
+            "/chat/completions", json=payload, timeout=timeout or self.timeout
+        )
+        response.raise_for_status()
+        return response.json()
+    
+    async def chat_stream(self, payload: Dict[str, Any], usage: Optional[Dict] = None,
+                          timeout: float = None):
+        """
+        POST /chat/completions со stream=True
+        Разбирает server-sent events и по мере генерации отдаёт куски текста
+        usage: словарь, в который записываются статистика токенов из последнего
+               события и finish_reason
+        timeout: ожидание соединения и каждого следующего куска
+        """
+        payload = {**payload, "stream": True, "stream_options": {"include_usage": True}}
+        async with self.client.stream(
+            "POST", "/chat/completions", json=payload, timeout=timeout or self.timeout
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                # Пустые строки разделяют события, ": keep-alive" - комментарии
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                event = json.loads(data)
+                if event.get("usage") and usage is not None:
+                    usage.update(event["usage"])
+                # Последнее событие с usage приходит без choices
+                if not event.get("choices"):
+                    continue
+                choice = event["choices"][0]
+                if choice.get("finish_reason") and usage is not None:
+                    usage["finish_reason"] = choice["finish_reason"]
+                delta = choice["delta"].get("content")
+                if delta:
+                    yield delta
+    
+    async def close(self):
+        """Закрыть пул соединений"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+deepseek = DeepSeekClient(
+    DEEPSEEK_API_KEY,
+    max_connections=DEEPSEEK_MAX_CONNECTIONS,
+    max_keepalive=DEEPSEEK_MAX_KEEPALIVE,
+    keepalive_expiry=DEEPSEEK_KEEPALIVE_EXPIRY,
+    timeout=DEEPSEEK_TIMEOUT,
+)
+
+# Классы приоритета запросов к AI (меньше - важнее)
+AI_PRIORITY_PRO = 0
+AI_PRIORITY_FREE = 1
+AI_PRIORITY_BATCH = 2
+
+AI_PRIORITY_NAMES = {
+    AI_PRIORITY_PRO: "PRO",
+    AI_PRIORITY_FREE: "FREE",
+    AI_PRIORITY_BATCH: "batch",
+}
+
+class AIUsage:
+    """Токены одного запроса в минутном окне бюджета (оценка, затем фактические)"""
+    __slots__ = ("started_at", "tokens")
+    
+    def __init__(self, started_at: float, tokens: int):
+        self.started_at = started_at
+        self.tokens = tokens
+
+class AIScheduler:
+    """
+    Очередь запросов к AI с приоритетами
+    
+    Одновременно выполняется не больше max_concurrency запросов. Свободный
+    слот получает самый приоритетный ожидающий (PRO > FREE > batch, внутри
+    класса - по очереди), если его класс укладывается в бюджет токенов за
+    последние 60 секунд. Класс, исчерпавший бюджет, ждёт, не блокируя остальные
+    """
+    
+    WINDOW_SECONDS = 60.0
+    
+    def __init__(self, max_concurrency: int, tokens_per_minute: Dict[int, int]):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self._waiters = []
+        self._seq = itertools.count()
+        self._timer = None
+        self._usage = {priority: deque() for priority in AI_PRIORITY_NAMES}
+        self._completed = {priority: deque() for priority in AI_PRIORITY_NAMES}
+        self._running = Counter()
+        self.started = Counter()
+        self.wait_total = Counter()
+        self.wait_max = Counter()
+    
+    def _window_tokens(self, priority: int, now: float) -> int:
+        """Токены класса за последние WINDOW_SECONDS"""
+        usage = self._usage[priority]
+        while usage and usage[0].started_at <= now - self.WINDOW_SECONDS:
+            usage.popleft()
+        return sum(item.tokens for item in usage)
+    
+    def _fits_budget(self, priority: int, tokens: int, now: float) -> bool:
+        budget = self.tokens_per_minute.get(priority, 0)
+        if not budget:
+            return True
+        used = self._window_tokens(priority, now)
+        # Запрос больше всего бюджета пропускается в пустое окно, иначе он ждал бы вечно
+        return used == 0 or used + tokens <= budget
+    
+    def _dispatch(self):
+        """Раздать свободные слоты ожидающим по приоритету"""
+        now = time.monotonic()
+        blocked = set()
+        deferred = []
+        
+        while sum(self._running.values()) < self.max_concurrency and self._waiters:
+            item = heapq.heappop(self._waiters)
+            priority, _, future, tokens, _ = item
+            if future.done():
+                # Ожидающий отменён
+                continue
+            if priority in blocked or not self._fits_budget(priority, tokens, now):
+                blocked.add(priority)
+                deferred.append(item)
+                continue
+            
+            usage = AIUsage(now, tokens)
+            self._usage[priority].append(usage)
+            self._running[priority] += 1
+            future.set_result(usage)
+        
+        for item in deferred:
+            heapq.heappush(self._waiters, item)
+        
+        # Классы без бюджета проверяем снова, когда из окна выйдет самый старый запрос
+        if blocked and self._timer is None:
+            oldest = min(self._usage[priority][0].started_at for priority in blocked)
+            delay = oldest + self.WINDOW_SECONDS - now
+            self._timer = asyncio.get_running_loop().call_later(max(delay, 0.05), self._on_timer)
+    
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+    
+    def _release(self, priority: int):
+        self._running[priority] -= 1
+        self._completed[priority].append(time.monotonic())
+        self._dispatch()
+    
+    @asynccontextmanager
+    async def slot(self, priority: int, tokens: int):
+        """
+        Дождаться слота для запроса класса priority с оценкой tokens токенов
+        Возвращает AIUsage: после ответа в usage.tokens записываются фактические токены
+        """
+        future = asyncio.get_running_loop().create_future()
+        enqueued_at = time.monotonic()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future, tokens, enqueued_at))
+        self._dispatch()
+        
+        try:
+            usage = await future
+        except asyncio.CancelledError:
+            # Слот мог быть выдан одновременно с отменой - возвращаем его
+            if future.done() and not future.cancelled():
+                self._release(priority)
+            raise
+        
+        waited = time.monotonic() - enqueued_at
+        self.started[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+        
+        try:
+            yield usage
+        finally:
+            self._release(priority)
+    
+    def snapshot(self) -> Dict[str, Dict]:
+        """Метрики по классам: очередь, выполняются, ожидание, пропускная способность, токены"""
+        now = time.monotonic()
+        queued = Counter(priority for priority, _, future, _, _ in self._waiters if not future.done())
+        
+        result = {}
+        for priority, name in AI_PRIORITY_NAMES.items():
+            completed = self._completed[priority]
+            while completed and completed[0] <= now - self.WINDOW_SECONDS:
+                completed.popleft()
+            started = self.started[priority]
+            result[name] = {
+                "queued": queued[priority],
+                "running": self._running[priority],
+                "started": started,
+                "avg_wait": self.wait_total[priority] / started if started else 0.0,
+                "max_wait": self.wait_max[priority],
+                "per_minute": len(completed),
+                "tokens_minute": self._window_tokens(priority, now),
+                "budget": self.tokens_per_minute.get(priority, 0),
+            }
+        return result
+
+ai_scheduler = AIScheduler(AI_MAX_CONCURRENCY, {
+    AI_PRIORITY_PRO: AI_TPM_PRO,
+    AI_PRIORITY_FREE: AI_TPM_FREE,
+    AI_PRIORITY_BATCH: AI_TPM_BATCH,
+})
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных запросов к AI
+    
+    Пока запрос с ключом выполняется, повторные вызовы с тем же ключом не
+    идут в API, а ждут его результат (или ошибку). Промежуточный текст
+    потокового ответа получают все ожидающие, передавшие on_progress;
+    ошибка в обработчике одного из них не прерывает общий запрос
+    """
+    
+    def __init__(self):
+        self._flights: Dict[str, asyncio.Future] = {}
+        self._listeners: Dict[str, List[Callable[[str], Awaitable[None]]]] = {}
+        self.leaders = 0
+        self.coalesced = 0
+    
+    async def run(self, key: str,
+                  request: Callable[[Optional[Callable[[str], Awaitable[None]]]], Awaitable[str]],
+                  on_progress: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
+        """Выполнить request(on_progress) или дождаться уже идущего запроса с тем же key"""
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            listeners = self._listeners[key]
+            if on_progress is not None:
+                listeners.append(on_progress)
+            try:
+                # shield: отмена одного ожидающего не отменяет общий запрос
+                return await asyncio.shield(flight)
+            finally:
+                # Отменённый ожидающий больше не получает промежуточный текст
+                if on_progress in listeners:
+                    listeners.remove(on_progress)
+        
+        flight = asyncio.get_running_loop().create_future()
+        self._flights[key] = flight
+        self._listeners[key] = [on_progress] if on_progress is not None else []
+        self.leaders += 1
+        
+        async def broadcast(partial: str):
+            for listener in list(self._listeners[key]):
+                try:
+                    await listener(partial)
+                except Exception as e:
+                    logger.warning(f"⚠️ Ошибка при показе промежуточного ответа AI: {e}")
+        
+        try:
+            result = await request(broadcast if on_progress is not None else None)
+        except asyncio.CancelledError:
+            flight.set_exception(AIServiceError("Запрос к AI отменён"))
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            del self._flights[key]
+            del self._listeners[key]
+            if flight.done() and not flight.cancelled():
+                # Ошибку получат ожидающие; без них asyncio не должен ругаться на неё
+                flight.exception()
+
+ai_single_flight = SingleFlight()
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: ~3 символа на токен для русского текста"""
+    return len(text) // 3
+
+def clean_ai_markdown(text: str) -> str:
+    """Чистка ответа AI от Markdown артефактов"""
+    text = text.replace("**", "")
+    text = text.replace("```", "")
+    text = re.sub(r'\*\*([^*]+)\*\*', r'<b>\1</b>', text)
+    text = re.sub(r'\*([^*]+)\*', r'<i>\1</i>', text)
+    return text
+
+async def ask_deepseek_ai(prompt: str, user_id: int = None, max_tokens: int = 1500, 
+                         use_history: bool = True,
+                         on_progress: Optional[Callable[[str], Awaitable[None]]] = None,
+                         priority: int = AI_PRIORITY_FREE, context: str = "",
+                         feature: Optional[str] = None) -> str:
     """
     Запрос к DeepSeek AI с учётом истории диалога
+    prompt: только меняющаяся часть запроса; постоянные инструкции раздела
+            берутся из FEATURE_TEMPLATES[feature] и идут в начало промпта
     user_id: для загрузки истории диалога
     use_history: использовать ли историю (False для разовых запросов)
+    context: контекст только для этого запроса (профиль, инструкции) -
+             в историю сохраняется лишь сам prompt
+    on_progress: если задан, ответ запрашивается потоком и корутина вызывается
+                 с накопленным текстом после каждого куска
+    priority: класс в очереди ai_scheduler (AI_PRIORITY_PRO / FREE / BATCH)
+    При ошибке выбрасывает AIServiceError
     """
-    url = "https://api.deepseek.com/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    system_prompt = (
-        "Ты — цифровой психолог-нумеролог, работающий с числами сознания, миссии, матрицей (цифры 1–9), "
-        "стилем действия и финансовым кодом. "
-        "Никакой астрологии, гороскопов, знаков зодиака, таро, чакр и т.п. "
-        "Форматируй ответ для Telegram-HTML: используй <b>жирный</b>, <i>курсив</i>, списки с эмодзи. "
-        "НЕ используй *, #, кодовые блоки ``` или таблицы Markdown. "
-        "Будь тёплым, эмпатичным и конкретным. Давай практические советы."
-    )
+    # Общий для всех пользователей префикс: системный промпт + шаблон раздела
+    system_prompt = SYSTEM_PROMPT
+    if feature in FEATURE_TEMPLATES:
+        system_prompt += "\n\n" + FEATURE_TEMPLATES[feature]
     
     messages = [{"role": "system", "content": system_prompt}]
+    if context:
+        messages.append({"role": "system", "content": context})
     
-    # Добавляем историю диалога если нужно
+    # Добавляем резюме и последние сообщения диалога в пределах бюджета токенов
     if use_history and user_id:
-        history = db.get_conversation_history(user_id, limit=10)
-        messages.extend(history)
+        summary, history = await adb.get_dialog_context(user_id)
+        messages.extend(fit_history(summary, history, HISTORY_TOKEN_BUDGET))
     
     # Добавляем текущий запрос
     messages.append({"role": "user", "content": prompt})
@@ -684,45 +2796,350 @@ def ask_deepseek_ai(prompt: str, user_id: int = None, max_tokens: int = 1500,
         "temperature": 0.7
     }
     
-    try:
-        response = requests.post(url, headers=headers, json=data, timeout=60)
-        response.raise_for_status()
-        result = response.json()
-        answer = result["choices"][0]["message"]["content"].strip()
-        
-        # Чистка от Markdown артефактов
-        answer = answer.replace("**", "")
-        answer = answer.replace("```", "")
-        answer = re.sub(r'\*\*([^*]+)\*\*', r'<b>\1</b>', answer)
-        answer = re.sub(r'\*([^*]+)\*', r'<i>\1</i>', answer)
-        
-        # Сохраняем в историю если нужно
+    async def request(progress) -> str:
+        answer = await _request_completion(data, priority, progress, feature, user_id)
+        # Историю пишет только выполнивший запрос: повторное нажатие или
+        # повторно доставленное обновление не дублируют реплики диалога
         if use_history and user_id:
-            db.add_message_to_history(user_id, "user", prompt)
-            db.add_message_to_history(user_id, "assistant", answer)
-            # Подрезаем историю, оставляя последние 15 сообщений
-            db.trim_conversation_history(user_id, keep_last=15)
-        
+            # Вопрос и ответ одной транзакцией, история подрезается до HISTORY_KEEP_MESSAGES
+            await adb.add_dialog_turn(user_id, prompt, answer)
+            # Старые сообщения сворачиваются в резюме в фоне, не задерживая ответ
+            schedule_history_compaction(user_id)
         return answer
     
-    except requests.exceptions.RequestException as e:
+    # Одинаковые запросы, пришедшие пока первый ещё выполняется, ждут его ответ;
+    # приоритет входит в ключ, чтобы PRO запрос не ждал в очереди FREE
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    return await ai_single_flight.run(f"{priority}:{digest}", request, on_progress)
+
+def fit_history(summary: Optional[str], history: List[Dict], budget: int) -> List[Dict]:
+    """
+    Сообщения контекста диалога в пределах budget токенов: резюме старой
+    части и столько последних сообщений, сколько помещается (от старых к новым)
+    """
+    messages = []
+    if summary:
+        summary_message = {"role": "system", "content": f"Краткое содержание предыдущего диалога:\n{summary}"}
+        budget -= estimate_tokens(summary_message["content"])
+        messages.append(summary_message)
+    
+    recent = []
+    for message in reversed(history):
+        budget -= estimate_tokens(message["content"])
+        if budget < 0:
+            break
+        recent.append({"role": message["role"], "content": message["content"]})
+    
+    return messages + recent[::-1]
+
+# Пользователи, для которых сейчас идёт сжатие истории, и фоновые задачи сжатия
+_compacting_users: set = set()
+_compaction_tasks: set = set()
+
+def schedule_history_compaction(user_id: int):
+    """Запустить compact_history в фоне (не более одной задачи на пользователя)"""
+    if user_id in _compacting_users:
+        return
+    _compacting_users.add(user_id)
+    task = asyncio.create_task(compact_history(user_id))
+    _compaction_tasks.add(task)
+    
+    def done(task):
+        _compaction_tasks.discard(task)
+        _compacting_users.discard(user_id)
+    
+    task.add_done_callback(done)
+
+async def compact_history(user_id: int):
+    """
+    Свернуть старые сообщения диалога в резюме, если несжатых накопилось
+    HISTORY_VERBATIM_MESSAGES + HISTORY_SUMMARY_BATCH; последние
+    HISTORY_VERBATIM_MESSAGES остаются как есть
+    """
+    summary, history = await adb.get_dialog_context(user_id)
+    if len(history) < HISTORY_VERBATIM_MESSAGES + HISTORY_SUMMARY_BATCH:
+        return
+    
+    folded = history[:-HISTORY_VERBATIM_MESSAGES]
+    dialog = "\n".join(
+        f"{'Пользователь' if m['role'] == 'user' else 'Ассистент'}: {m['content']}" for m in folded
+    )
+    prompt = (
+        f"Предыдущее резюме диалога:\n{summary or '(нет)'}\n\n"
+        f"Новые сообщения:\n{dialog}"
+    )
+    
+    try:
+        new_summary = await ask_deepseek_ai(
+            prompt, max_tokens=HISTORY_SUMMARY_MAX_TOKENS, use_history=False,
+            priority=AI_PRIORITY_BATCH, feature='history_summary'
+        )
+    except AIServiceError:
+        # Попробуем при следующем сообщении
+        return
+    
+    await adb.save_conversation_summary(user_id, new_summary, folded[-1]['id'])
+    logger.info(f"🗜 История пользователя {user_id}: свёрнуто сообщений {len(folded)}")
+
+async def _request_completion(data: Dict[str, Any], priority: int,
+                              on_progress: Optional[Callable[[str], Awaitable[None]]],
+                              feature: Optional[str] = None, user_id: Optional[int] = None) -> str:
+    """
+    Один запрос к DeepSeek через ai_scheduler, ответ очищен от Markdown
+    Токены (включая попадания в кэш префикса) учитываются в ai_feature_usage,
+    каждый вызов (в том числе неудачный) записывается в журнал ai_calls
+    При ошибке выбрасывает AIServiceError
+    """
+    started = None
+    usage = {}
+    finish_reason = "error"
+    try:
+        # Оценка для бюджета: токены запроса плюс максимум ответа
+        estimated_tokens = data["max_tokens"] + sum(estimate_tokens(m["content"]) for m in data["messages"])
+        async with ai_scheduler.slot(priority, estimated_tokens) as slot:
+            started = time.monotonic()
+            if on_progress is None:
+                result = await deepseek_upstream.call(
+                    "chat", lambda timeout: deepseek.chat(data, timeout)
+                )
+                answer = result["choices"][0]["message"]["content"]
+                usage = result.get("usage") or {}
+                usage["finish_reason"] = result["choices"][0].get("finish_reason")
+            else:
+                answer = ""
+                
+                async def stream(timeout: float):
+                    nonlocal answer
+                    stream_started = time.monotonic()
+                    async for delta in deepseek.chat_stream(data, usage, timeout):
+                        if not answer:
+                            deepseek_upstream.observe("chat_stream", time.monotonic() - stream_started)
+                        answer += delta
+                        await on_progress(clean_ai_markdown(answer))
+                
+                # Повторяем поток, только пока пользователь не увидел ни одного куска
+                await deepseek_upstream.call(
+                    "chat_stream", stream,
+                    can_retry=lambda: not answer, record_latency=False
+                )
+            slot.tokens = usage.get("total_tokens", slot.tokens)
+            ai_feature_usage.record(feature, usage, time.monotonic() - started)
+            finish_reason = usage.get("finish_reason") or "unknown"
+        
+        return clean_ai_markdown(answer.strip())
+    
+    except asyncio.CancelledError:
+        finish_reason = "cancelled"
+        raise
+    except UpstreamUnavailable as e:
+        logger.warning(f"⚠️ {e}")
+        raise AIServiceError(str(e)) from e
+    except httpx.HTTPError as e:
         logger.error(f"DeepSeek API Error: {e}")
-        return f"⚠️ Ошибка соединения с AI: {str(e)}"
-    except Exception as e:
-        logger.error(f"Unexpected error in DeepSeek AI: {e}")
-        return f"⚠️ Произошла ошибка при обработке запроса: {str(e)}"
+        raise AIServiceError(f"Ошибка соединения с AI: {e}") from e
+    except (KeyError, IndexError, ValueError) as e:
+        logger.error(f"Unexpected response from DeepSeek AI: {e}")
+        raise AIServiceError(f"Некорректный ответ AI: {e}") from e
+    finally:
+        # Запросы, не дождавшиеся слота планировщика, в журнал не попадают
+        if started is not None:
+            db.log_ai_call(
+                feature or "other", user_id,
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                cached_tokens=usage.get("prompt_cache_hit_tokens", 0),
+                completion_tokens=usage.get("completion_tokens", 0),
+                latency_ms=int((time.monotonic() - started) * 1000),
+                finish_reason=finish_reason
+            )
+
+# Теги Telegram-HTML, которые нужно закрывать в незавершённом тексте
+_HTML_TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^<>]*>')
+
+# Недописанные в конце текста тег ("<", "</", "<a hre") и сущность ("&", "&am");
+# одиночные "<" и "&" внутри текста ("число < 5") не трогаются
+_PARTIAL_TAG_RE = re.compile(r'</?(?:[a-zA-Z][^<>]*)?$')
+_PARTIAL_ENTITY_RE = re.compile(r'&#?[a-zA-Z0-9]*$')
+
+def _trim_partial_html(text: str) -> str:
+    """Отрезает недописанный тег или сущность в конце текста"""
+    text = _PARTIAL_TAG_RE.sub("", text)
+    return _PARTIAL_ENTITY_RE.sub("", text)
+
+def _open_html_tags(text: str) -> List[Tuple[str, str]]:
+    """Незакрытые теги текста: пары (имя, открывающий тег целиком) в порядке открытия"""
+    open_tags = []
+    for match in _HTML_TAG_RE.finditer(text):
+        closing, tag = match.group(1), match.group(2).lower()
+        if not closing:
+            open_tags.append((tag, match.group(0)))
+        else:
+            # Закрывающий тег снимает ближайший открытый с тем же именем
+            for index in range(len(open_tags) - 1, -1, -1):
+                if open_tags[index][0] == tag:
+                    del open_tags[index]
+                    break
+    return open_tags
+
+def close_open_html(text: str) -> str:
+    """
+    Делает частичный Telegram-HTML валидным: отрезает недописанный тег
+    или сущность в конце и закрывает открытые теги в обратном порядке
+    """
+    text = _trim_partial_html(text)
+    return text + "".join(f"</{tag}>" for tag, _ in reversed(_open_html_tags(text)))
+
+def split_html(text: str, limit: int = constants.MessageLimit.MAX_TEXT_LENGTH) -> List[str]:
+    """
+    Делит Telegram-HTML на части не длиннее limit - по абзацам, строкам или словам.
+    Теги, открытые на границе, закрываются в конце части и открываются снова в следующей
+    """
+    parts = []
+    # Запас под закрывающие и повторно открытые теги
+    budget = max(limit - 256, limit // 2)
+    while len(text) > limit:
+        cut = next((pos for pos in (text.rfind(sep, 0, budget) for sep in ("\n\n", "\n", " ")) if pos > 0), budget)
+        head = _trim_partial_html(text[:cut]) or text[:cut]
+        open_tags = _open_html_tags(head)
+        parts.append(head.rstrip() + "".join(f"</{tag}>" for tag, _ in reversed(open_tags)))
+        text = "".join(opening for _, opening in open_tags) + text[len(head):].lstrip()
+    parts.append(text)
+    return parts
+
+class StreamingReply:
+    """
+    Показывает ответ AI по мере генерации, редактируя одно сообщение-заглушку
+    
+    Редактирования идут не чаще AI_STREAM_EDIT_INTERVAL секунд, каждый
+    промежуточный текст закрывается close_open_html, ошибки Telegram при
+    промежуточных правках только логируются. Готовый ответ заменяет заглушку
+    (длинный - продолжается следующими сообщениями), поэтому удалять её
+    и отправлять новое сообщение не нужно
+    """
+    
+    # Сколько раз повторять готовый ответ, если Telegram просит подождать
+    FINAL_ATTEMPTS = 3
+    
+    def __init__(self, message, header: str = "", interval: float = AI_STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.header = header
+        self.interval = interval
+        self._next_edit = 0.0
+        self._last_text = None
+    
+    async def _call(self, method, text: str, reply_markup=None, wait: bool = False) -> bool:
+        """
+        Отредактировать или отправить сообщение (method - edit_text или reply_text);
+        False, если Telegram отказал. wait: при RetryAfter подождать и повторить
+        """
+        for attempt in range(self.FINAL_ATTEMPTS if wait else 1):
+            try:
+                await method(
+                    text,
+                    parse_mode=constants.ParseMode.HTML,
+                    reply_markup=reply_markup
+                )
+            except RetryAfter as e:
+                self._next_edit = time.monotonic() + e.retry_after
+                if attempt + 1 < self.FINAL_ATTEMPTS and wait:
+                    await asyncio.sleep(e.retry_after)
+                continue
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return True
+                logger.warning(f"⚠️ Не удалось показать ответ AI: {e}")
+                return False
+            except TelegramError as e:
+                logger.warning(f"⚠️ Не удалось показать ответ AI: {e}")
+                return False
+            self._last_text = text
+            return True
+        return False
+    
+    async def update(self, partial: str):
+        """Промежуточный текст ответа (вызывается на каждый кусок потока)"""
+        now = time.monotonic()
+        if now < self._next_edit:
+            return
+        text = close_open_html(self.header + partial)
+        if text == self._last_text or len(text) > constants.MessageLimit.MAX_TEXT_LENGTH:
+            return
+        self._next_edit = now + self.interval
+        await self._call(self.message.edit_text, text)
+    
+    async def finish(self, result: str, reply_markup=None) -> bool:
+        """
+        Показать готовый ответ вместе с клавиатурой (она - у последней части
+        длинного ответа). Возвращает False, если ответ доставить не удалось
+        """
+        parts = split_html(self.header + result)
+        for index, text in enumerate(parts):
+            markup = reply_markup if index == len(parts) - 1 else None
+            if index == 0 and await self._call(self.message.edit_text, text, markup, wait=True):
+                continue
+            # Редактирование не удалось или это продолжение - отдельным сообщением
+            if not await self._call(self.message.reply_text, text, markup, wait=True):
+                return False
+        return True
+
+async def reply_with_ai(wait_msg, prompt: str, user_id: int, cost: Optional[int] = None,
+                        use_history: bool = False, max_tokens: int = 1500, header: str = "",
+                        cache_key: Optional[str] = None, name: str = "", context: str = "",
+                        feature: Optional[str] = None):
+    """
+    Потоком выводит ответ AI в сообщение-заглушку wait_msg
+    feature: раздел - шаблон инструкций из FEATURE_TEMPLATES
+    Если AI не ответил, показывает AI_UNAVAILABLE_TEXT. Списанный лимит (cost)
+    возвращается, если ответ AI не удалось получить или доставить
+    context: передаётся в ask_deepseek_ai (не сохраняется в историю)
+    cache_key: ответ берётся из ai_response_cache или сохраняется туда;
+               метка AI_NAME_PLACEHOLDER в ответе заменяется на name
+    """
+    def render(text: str) -> str:
+        return text.replace(AI_NAME_PLACEHOLDER, name)
+    
+    reply = StreamingReply(wait_msg, header=header)
+    
+    async def on_progress(partial: str):
+        await reply.update(render(partial))
+    
+    # Лимит возвращается при любом исходе, кроме доставленного ответа AI
+    answered = False
+    try:
+        if cache_key:
+            cached = await adb.get_cached_response(cache_key)
+            if cached is not None:
+                answered = await reply.finish(render(cached), reply_markup=back_menu())
+                return
+        
+        priority = AI_PRIORITY_PRO if await adb.is_pro_user(user_id) else AI_PRIORITY_FREE
+        try:
+            answer = await ask_deepseek_ai(
+                prompt, user_id=user_id, max_tokens=max_tokens,
+                use_history=use_history, on_progress=on_progress, priority=priority,
+                context=context, feature=feature
+            )
+            if cache_key:
+                await adb.put_cached_response(cache_key, answer)
+            result = render(answer)
+        except AIServiceError:
+            await reply.finish(AI_UNAVAILABLE_TEXT, reply_markup=back_menu())
+            return
+        
+        answered = await reply.finish(result, reply_markup=back_menu())
+    finally:
+        if cost and not answered:
+            await adb.refund_quota(user_id, cost)
 
 # ====
 # ГЕНЕРАЦИЯ ОТЧЁТОВ
 # ====
 
-def build_user_profile_context(user_id: int) -> str:
-    """Создаёт контекст профиля пользователя для AI"""
-    user = db.get_user(user_id)
-    if not user or not user['birthdate']:
-        return ""
-    
-    d = datetime.strptime(user['birthdate'], "%d.%m.%Y")
+def profile_context_text(name: str, d: datetime, personal: bool = True) -> str:
+    """
+    Текст нумерологического профиля для AI
+    personal=False: без даты рождения и финансового кода - такой текст
+    одинаков у всех пользователей с одним отпечатком профиля
+    """
     cn = consciousness_number(d.day)
     ms = mission_number(d)
     act = action_number(d)
@@ -731,19 +3148,61 @@ def build_user_profile_context(user_id: int) -> str:
     
     context = (
         f"Контекст профиля пользователя:\n"
-        f"- Имя: {user['name']}\n"
-        f"- Дата рождения: {user['birthdate']}\n"
+        f"- Имя: {name}\n"
+    )
+    if personal:
+        context += f"- Дата рождения: {d.strftime('%d.%m.%Y')}\n"
+    context += (
         f"- Число Сознания: {cn}\n"
         f"- Число Миссии: {ms}\n"
         f"- Число Действия: {act}\n"
         f"- Сильные числа (присутствуют в дате): {strong}\n"
         f"- Зоны роста (отсутствуют в дате): {missing}\n"
-        f"- Финансовый код: {fcode} (корень: {froot})\n\n"
-        f"Учитывай нумерологический профиль пользователя в своём ответе.\n"
     )
+    if personal:
+        context += f"- Финансовый код: {fcode} (корень: {froot})\n\n"
+    else:
+        context += f"- Корень финансового кода: {froot}\n\n"
+    context += "Учитывай нумерологический профиль пользователя в своём ответе.\n"
     
     return context
 
+async def build_user_profile_context(user_id: int) -> str:
+    """Создаёт контекст профиля пользователя для AI"""
+    user = await adb.get_user(user_id)
+    if not user or not user['birthdate']:
+        return ""
+    
+    return profile_context_text(user['name'], user['birthdate'])
+
+def shared_profile_context(d: datetime) -> str:
+    """
+    Контекст профиля для кэшируемых ответов: вместо имени метка
+    AI_NAME_PLACEHOLDER, которую reply_with_ai заменяет при показе
+    """
+    return (
+        profile_context_text(AI_NAME_PLACEHOLDER, d, personal=False) +
+        f"Если обращаешься к пользователю по имени, пиши ровно {AI_NAME_PLACEHOLDER}.\n"
+    )
+
+def profile_fingerprint(d: datetime) -> Tuple:
+    """Всё, от чего зависит shared_profile_context: числа сознания, миссии, действия, пустые цифры, корень"""
+    _, missing = matrix_counts(d)
+    return (consciousness_number(d.day), mission_number(d), action_number(d),
+            tuple(missing), finance_code(d)[1])
+
+def content_cache_key(feature: str, *parts) -> str:
+    """Ключ ai_response_cache: раздел + sha256 от версии шаблона и параметров промпта"""
+    raw = json.dumps([AI_PROMPT_TEMPLATE_VERSION, *parts])
+    return f"{feature}:{hashlib.sha256(raw.encode()).hexdigest()}"
+
+def ai_cache_key(feature: str, d: datetime, *extra) -> str:
+    """
+    Ключ кэша ответа AI по отпечатку профиля и дополнительным
+    параметрам промпта (например, дате для календаря)
+    """
+    return content_cache_key(feature, profile_fingerprint(d), *extra)
+
 def build_full_report(name: str, d: datetime) -> str:
     """Создаёт полный нумерологический отчёт"""
     day_raw = d.day
@@ -794,118 +3253,557 @@ def build_full_report(name: str, d: datetime) -> str:
         f"• ❌ В минусе: {m.get('minus', '—')}\n"
         f"• 🎯 Цель: {m.get('goal', '—')}\n\n"
         
-        f"🧭 <b>Стиль действия: {act}</b> — {a.get('title', '—')}\n"
-        f"• ✅ Плюс: {a.get('plus', '—')}\n"
-        f"• ❌ Минус: {a.get('minus', '—')}\n\n"
+        f"🧭 <b>Стиль действия: {act}</b> — {a.get('title', '—')}\n"
+        f"• ✅ Плюс: {a.get('plus', '—')}\n"
+        f"• ❌ Минус: {a.get('minus', '—')}\n\n"
+        
+        f"🗂 <b>Матрица судьбы</b>\n"
+        f"✨ <b>Сильные стороны:</b>\n" + ("\n".join(strong_lines) if strong_lines else "—") + "\n\n"
+        f"🎯 <b>Зоны роста:</b>\n" + ("\n".join(growth_lines) if growth_lines else "—") + "\n\n"
+        
+        f"💰 <b>Финансовый код: {fcode}</b> (корень: {froot})\n"
+        + (f"• {f_note}" if f_note else "")
+    )
+    
+    return text
+
+def forecast_cohort(birthdate: datetime, today: datetime) -> Tuple[int, int, int]:
+    """Когорта ежедневного прогноза: (число дня, число сознания, число миссии)"""
+    return daily_number(today), consciousness_number(birthdate.day), mission_number(birthdate)
+
+async def generate_cohort_forecast(today: datetime, cohort: Tuple[int, int, int]) -> Optional[str]:
+    """
+    Текст прогноза на сегодня для когорты (без имени и приветствия)
+    Генерируется один раз в день на когорту и хранится в ai_response_cache
+    """
+    day_num, user_consciousness, user_mission = cohort
+    cache_key = content_cache_key('daily_forecast', pack_date(today), cohort)
+    
+    cached = await adb.get_cached_response(cache_key)
+    if cached is not None:
+        return cached
+    
+    # Формируем промпт для AI (БЕЗ использования истории)
+    prompt = (
+        f"Сегодня {today.strftime('%d.%m.%Y')}, число дня: {day_num}\n\n"
+        f"Пользователь:\n"
+        f"- Число сознания: {user_consciousness}\n"
+        f"- Число миссии: {user_mission}"
+    )
+    
+    try:
+        forecast = await ask_deepseek_ai(
+            prompt, max_tokens=1000, use_history=False,
+            priority=AI_PRIORITY_BATCH, feature='daily_forecast'
+        )
+    except AIServiceError:
+        return None
+    
+    await adb.put_cached_response(cache_key, forecast)
+    return forecast
+
+def render_daily_forecast(name: str, today: datetime, forecast: str) -> str:
+    """Персональное приветствие + общий текст когорты"""
+    header = (
+        f"🌅 <b>Доброе утро, {name}!</b>\n\n"
+        f"📅 Сегодня: {today.strftime('%d.%m.%Y')}\n"
+        f"🔢 Число дня: <b>{daily_number(today)}</b>\n\n"
+    )
+    return header + forecast
+
+# ====
+# РАССЫЛКИ
+# ====
+
+class TokenBucket:
+    """
+    Ограничитель частоты: не больше rate событий в секунду с запасом capacity
+    pause() останавливает выдачу для всех (flood control Telegram действует на весь бот)
+    """
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class Broadcaster:
+    """
+    Массовая отправка сообщений в пределах лимитов Bot API
+    
+    Каждое сообщение ждёт токен общего TokenBucket и паузу между сообщениями
+    в один чат, сколько отправителей работает одновременно - решает вызывающий
+    (этап send конвейера рассылки). RetryAfter приостанавливает всю рассылку
+    на указанное время, сетевые ошибки повторяются. Заблокировавшие бота
+    отмечаются в users.blocked_at. Результат каждой доставки сохраняется
+    в broadcast_deliveries по run_id, поэтому повторная рассылка пропускает
+    уже доставленные сообщения
+    """
+    
+    def __init__(self, rate: float, per_chat_interval: float, max_retries: int):
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._chat_next: Dict[int, float] = {}
+        self.retry_after_count = 0
+    
+    async def _wait_chat(self, chat_id: int):
+        """Пауза, если в этот чат недавно уже отправляли"""
+        now = time.monotonic()
+        next_allowed = self._chat_next.get(chat_id, 0.0)
+        self._chat_next[chat_id] = max(now, next_allowed) + self.per_chat_interval
+        if next_allowed > now:
+            await asyncio.sleep(next_allowed - now)
+        if len(self._chat_next) > 10000:
+            self._chat_next = {chat: at for chat, at in self._chat_next.items() if at > now}
+    
+    async def send(self, bot, chat_id: int, **kwargs) -> str:
+        """
+        Отправить одно сообщение с учётом лимитов и повторов
+        Возвращает статус: sent, blocked или failed
+        """
+        await self._wait_chat(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, **kwargs)
+                return "sent"
+            except RetryAfter as e:
+                self.retry_after_count += 1
+                logger.warning(f"⏳ Telegram просит подождать {e.retry_after} с (чат {chat_id})")
+                self.bucket.pause(e.retry_after)
+            except Forbidden as e:
+                logger.info(f"🚫 Чат {chat_id} недоступен: {e}")
+                await adb.mark_chat_blocked(chat_id)
+                return "blocked"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    await adb.mark_chat_blocked(chat_id)
+                    return "blocked"
+                logger.error(f"❌ Telegram отклонил сообщение в чат {chat_id}: {e}")
+                return "failed"
+            except NetworkError as e:
+                if attempt == self.max_retries:
+                    logger.error(f"❌ Не удалось отправить сообщение в чат {chat_id}: {e}")
+                    return "failed"
+                await asyncio.sleep(min(UPSTREAM_BACKOFF_BASE * 2 ** attempt, UPSTREAM_BACKOFF_MAX))
+        
+        logger.error(f"❌ Сообщение в чат {chat_id} не отправлено: Telegram не снял ограничение")
+        return "failed"
+    
+    async def deliver(self, bot, run_id: str, chat_id: int, **kwargs) -> str:
+        """Отправить сообщение рассылки run_id и сохранить отметку доставки"""
+        status = await self.send(bot, chat_id, **kwargs)
+        db.record_delivery(run_id, chat_id, status)
+        return status
+
+broadcaster = Broadcaster(
+    rate=BROADCAST_RATE,
+    per_chat_interval=BROADCAST_PER_CHAT_INTERVAL,
+    max_retries=BROADCAST_MAX_RETRIES,
+)
+
+class StageStats:
+    """Счётчики этапа конвейера: обработано, отброшено, ошибки, время работы и ожидания"""
+    __slots__ = ("items", "dropped", "errors", "busy", "max_latency", "blocked")
+    
+    def __init__(self):
+        self.items = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy = 0.0          # суммарное время обработки элементов
+        self.max_latency = 0.0
+        self.blocked = 0.0       # сколько ждали места в очереди следующего этапа
+    
+    def observe(self, latency: float):
+        self.items += 1
+        self.busy += latency
+        self.max_latency = max(self.max_latency, latency)
+    
+    def summary(self, elapsed: float) -> str:
+        avg = self.busy / self.items if self.items else 0.0
+        rate = self.items / elapsed if elapsed else 0.0
+        text = (
+            f"{self.items} шт. ({rate:.1f}/с), среднее {avg:.2f} с, максимум {self.max_latency:.2f} с, "
+            f"ожидание очереди {self.blocked:.1f} с"
+        )
+        if self.dropped or self.errors:
+            text += f", отброшено {self.dropped}, ошибок {self.errors}"
+        return text
+
+class Pipeline:
+    """
+    Конвейер обработки: источник и этапы, связанные ограниченными очередями
+    
+    У каждого этапа своё число обработчиков. Когда очередь следующего этапа
+    заполнена, предыдущий ждёт (обратное давление), поэтому в памяти не больше
+    queue_size элементов на этап. Обработчик возвращает элемент для следующего
+    этапа или None, чтобы отбросить его; ошибка обработчика отбрасывает
+    только текущий элемент
+    """
+    
+    _STOP = object()
+    
+    def __init__(self, name: str, queue_size: int):
+        self.name = name
+        self.queue_size = queue_size
+        self.stages: List[Tuple[str, Callable[[Any], Awaitable[Any]], int]] = []
+    
+    def stage(self, name: str, handler: Callable[[Any], Awaitable[Any]], concurrency: int = 1) -> "Pipeline":
+        self.stages.append((name, handler, max(1, concurrency)))
+        return self
+    
+    async def run(self, source: AsyncIterator) -> Tuple[Dict[str, StageStats], float]:
+        """Прогнать все элементы source через этапы; возвращает счётчики этапов и время"""
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+        stats = {"select": StageStats(), **{name: StageStats() for name, _, _ in self.stages}}
+        started = time.monotonic()
+        
+        async def put(index: int, item, stage_stats: StageStats):
+            waited = time.monotonic()
+            await queues[index].put(item)
+            stage_stats.blocked += time.monotonic() - waited
+        
+        async def feed():
+            source_stats = stats["select"]
+            iterator = source.__aiter__()
+            while True:
+                began = time.monotonic()
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                source_stats.observe(time.monotonic() - began)
+                await put(0, item, source_stats)
+            for _ in range(self.stages[0][2]):
+                await queues[0].put(self._STOP)
+        
+        async def worker(index: int):
+            name, handler, _ = self.stages[index]
+            stage_stats = stats[name]
+            last = index == len(self.stages) - 1
+            while True:
+                item = await queues[index].get()
+                if item is self._STOP:
+                    return
+                began = time.monotonic()
+                try:
+                    result = await handler(item)
+                except Exception as e:
+                    stage_stats.errors += 1
+                    logger.error(f"❌ {self.name}/{name}: {e}")
+                    continue
+                stage_stats.observe(time.monotonic() - began)
+                if last:
+                    continue
+                if result is None:
+                    stage_stats.dropped += 1
+                    continue
+                await put(index + 1, result, stage_stats)
+        
+        async def run_stage(index: int):
+            await asyncio.gather(*(worker(index) for _ in range(self.stages[index][2])))
+            if index + 1 < len(self.stages):
+                for _ in range(self.stages[index + 1][2]):
+                    await queues[index + 1].put(self._STOP)
         
-        f"🗂 <b>Матрица судьбы</b>\n"
-        f"✨ <b>Сильные стороны:</b>\n" + ("\n".join(strong_lines) if strong_lines else "—") + "\n\n"
-        f"🎯 <b>Зоны роста:</b>\n" + ("\n".join(growth_lines) if growth_lines else "—") + "\n\n"
+        tasks = [asyncio.create_task(feed())]
+        tasks += [asyncio.create_task(run_stage(index)) for index in range(len(self.stages))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
         
-        f"💰 <b>Финансовый код: {fcode}</b> (корень: {froot})\n"
-        + (f"• {f_note}" if f_note else "")
-    )
+        return stats, time.monotonic() - started
+
+# ====
+# ЕЖЕДНЕВНЫЕ РАССЫЛКИ
+# ====
+
+async def iter_forecast_recipients(page_size: int = BROADCAST_PAGE_SIZE) -> AsyncIterator[List[Dict]]:
+    """
+    PRO пользователи с датой рождения и включенной рассылкой, страницами по
+    возрастанию user_id (keyset-пагинация: в памяти только одна страница)
+    """
+    after_user_id = 0
+    while True:
+        page = await adb.get_forecast_recipients_page(after_user_id, page_size)
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        after_user_id = page[-1]['user_id']
+
+def user_timezone(user: Dict) -> ZoneInfo:
+    """Часовой пояс пользователя (по умолчанию - МСК)"""
+    if user.get('timezone'):
+        try:
+            return ZoneInfo(user['timezone'])
+        except (ZoneInfoNotFoundError, ValueError):
+            pass
+    return TZ
+
+def forecast_slot(user_id: int, local_day: date, hour: int, tz: ZoneInfo) -> datetime:
+    """
+    Время отправки прогноза пользователю в день local_day: начало часа hour
+    плюс постоянное для пользователя смещение внутри FORECAST_SPREAD_MINUTES,
+    чтобы отправки и запросы к AI распределялись по окну, а не шли в одну минуту
+    """
+    spread = max(FORECAST_SPREAD_MINUTES * 60, 1)
+    offset = int(hashlib.md5(str(user_id).encode()).hexdigest(), 16) % spread
+    return datetime.combine(local_day, dt_time(hour=hour), tzinfo=tz) + timedelta(seconds=offset)
+
+async def plan_forecasts(users: List[Dict], now: datetime) -> List[Tuple[int, int, int]]:
+    """
+    Ближайший слот прогноза для каждого пользователя: сегодня по его местному
+    времени, а если сегодняшний слот прошёл и прогноз уже доставлен - завтра.
+    Недоставленный сегодняшний прогноз (например, после перезапуска) уходит сразу
+    """
+    slots = {}
+    for user in users:
+        tz = user_timezone(user)
+        hour = user['forecast_hour'] if user.get('forecast_hour') is not None else FORECAST_HOUR
+        local_day = now.astimezone(tz).date()
+        slots[user['user_id']] = (tz, hour, local_day, forecast_slot(user['user_id'], local_day, hour, tz))
+    
+    # Доставленные сегодня проверяются одним запросом на каждый местный день
+    passed = defaultdict(list)
+    for user_id, (_, _, local_day, slot) in slots.items():
+        if slot <= now:
+            passed[local_day].append(user_id)
+    delivered = set()
+    for local_day, user_ids in passed.items():
+        delivered |= await adb.get_completed_deliveries(f"daily_forecast:{pack_date(local_day)}", user_ids)
+    
+    rows = []
+    for user_id, (tz, hour, local_day, slot) in slots.items():
+        if user_id in delivered:
+            local_day += timedelta(days=1)
+            slot = forecast_slot(user_id, local_day, hour, tz)
+        rows.append((user_id, pack_date(local_day), int(slot.timestamp())))
+    return rows
+
+async def plan_daily_forecasts(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Раскладывает ежедневные прогнозы по слотам (раз в сутки и при запуске бота):
+    каждому получателю - своё время в окне FORECAST_SPREAD_MINUTES от его часа
+    """
+    now = datetime.now(TZ)
+    planned = 0
+    async for page in iter_forecast_recipients():
+        rows = await plan_forecasts(page, now)
+        await adb.save_forecast_schedule(rows)
+        planned += len(rows)
+    
+    logger.info(f"🗓 Запланировано ежедневных прогнозов: {planned}")
+
+async def reschedule_user_forecast(user_id: int):
+    """
+    Пересчитать слот пользователя после смены часа или часового пояса,
+    регистрации или оформления PRO - чтобы прогноз пришёл уже сегодня,
+    не дожидаясь ночного планирования
+    """
+    user = await adb.get_user(user_id)
+    if not user or not user['birthdate'] or not user['daily_forecast_enabled']:
+        return
+    if not await adb.is_pro_user(user_id):
+        return
+    await adb.save_forecast_schedule(await plan_forecasts([user], datetime.now(TZ)))
+
+# Задачи генерации текстов прогнозов по (местный день, когорта): одна задача
+# на когорту, её результат получают все получатели этой когорты
+_forecast_tasks: Dict[Tuple[int, Tuple[int, int, int]], asyncio.Task] = {}
+
+def cohort_forecast_task(local_day: int, cohort: Tuple[int, int, int]) -> asyncio.Task:
+    """Задача генерации текста когорты (из кэша ответов AI или через AI)"""
+    key = (local_day, cohort)
+    task = _forecast_tasks.get(key)
+    if task is None:
+        task = asyncio.create_task(generate_cohort_forecast(unpack_date(local_day), cohort))
+        _forecast_tasks[key] = task
+    return task
+
+def _prune_forecast_tasks():
+    """
+    Убрать задачи прошедших дней и неудачные (None или ошибка),
+    чтобы на следующем тике текст сгенерировался заново
+    """
+    oldest_day = pack_date(datetime.now(TZ) - timedelta(days=1))
+    for key, task in list(_forecast_tasks.items()):
+        failed = task.done() and (task.cancelled() or task.exception() is not None or task.result() is None)
+        if key[0] < oldest_day or failed:
+            del _forecast_tasks[key]
+
+async def prepare_upcoming_forecasts(until: int) -> int:
+    """
+    Заранее готовит тексты когорт для слотов до until, не более
+    FORECAST_GENERATION_CONCURRENCY генераций одновременно. Возвращает число когорт
+    """
+    upcoming = {
+        (local_day, forecast_cohort(birthdate, unpack_date(local_day)))
+        for local_day, birthdate in await adb.get_upcoming_forecast_profiles(until)
+    }
+    semaphore = asyncio.Semaphore(FORECAST_GENERATION_CONCURRENCY)
     
-    return text
+    async def prepare(local_day, cohort):
+        async with semaphore:
+            await cohort_forecast_task(local_day, cohort)
+    
+    await asyncio.gather(*(prepare(local_day, cohort) for local_day, cohort in upcoming))
+    return len(upcoming)
 
-def generate_daily_forecast(user_id: int, today: datetime) -> str:
+async def send_daily_forecasts(context: ContextTypes.DEFAULT_TYPE):
     """
-    Генерирует персонализированный ежедневный прогноз
+    Доставка ежедневных прогнозов по расписанию (каждые FORECAST_TICK_SECONDS)
+    
+    Тексты для слотов ближайших FORECAST_LOOKAHEAD_MINUTES готовятся заранее,
+    наступившие слоты проходят конвейер: выборка → генерация → оформление →
+    отправка. Этапы работают параллельно и связаны ограниченными очередями,
+    поэтому ожидание AI перекрывается с отправкой уже готовых сообщений.
+    Текст генерируется один раз на когорту (число дня, сознание, миссия),
+    приветствие с именем подставляется локально. Отметки доставки защищают
+    от повторной отправки. Из расписания убираются только доставленные
+    прогнозы (или недоступные чаты), остальные повторяются через
+    FORECAST_RETRY_MINUTES, не больше FORECAST_MAX_ATTEMPTS попыток
     """
-    user = db.get_user(user_id)
-    if not user or not user['birthdate']:
-        return None
+    now = int(time.time())
+    _prune_forecast_tasks()
+    
+    # Генерация заранее: к моменту слота текст уже готов
+    await prepare_upcoming_forecasts(now + FORECAST_LOOKAHEAD_MINUTES * 60)
+    
+    results = Counter()
+    # Взятые в работу слоты user_id → местный день и завершённые (user_id, день)
+    pending: Dict[int, int] = {}
+    finished: List[Tuple[int, int]] = []
+    
+    async def select():
+        """Наступившие слоты страницами по (due_at, user_id), без уже доставленных"""
+        after = (0, 0)
+        while True:
+            page = await adb.get_due_forecasts_page(now, after, BROADCAST_PAGE_SIZE)
+            if not page:
+                return
+            after = (page[-1]['due_at'], page[-1]['user_id'])
+            
+            # Отметки доставки - по местному дню пользователя
+            by_day = defaultdict(list)
+            for user_row in page:
+                by_day[user_row['local_day']].append(user_row)
+            for local_day, users in by_day.items():
+                completed = await adb.get_completed_deliveries(
+                    f"daily_forecast:{local_day}", [user['user_id'] for user in users]
+                )
+                results["skipped"] += len(completed)
+                for user_row in users:
+                    if user_row['user_id'] in completed:
+                        finished.append((user_row['user_id'], local_day))
+                        continue
+                    pending[user_row['user_id']] = local_day
+                    yield user_row
+            
+            if len(page) < BROADCAST_PAGE_SIZE:
+                return
     
-    # Расчет числа дня
-    day_num = daily_number(today)
+    async def generate(user_row: Dict):
+        today = unpack_date(user_row['local_day'])
+        forecast = await cohort_forecast_task(
+            user_row['local_day'], forecast_cohort(user_row['birthdate'], today)
+        )
+        if not forecast:
+            results["no_forecast"] += 1
+            return None
+        return user_row, forecast
     
-    # Расчет числа сознания пользователя
-    birthdate = datetime.strptime(user['birthdate'], "%d.%m.%Y")
-    user_consciousness = consciousness_number(birthdate.day)
-    user_mission = mission_number(birthdate)
+    async def render(item):
+        user_row, forecast = item
+        return user_row['local_day'], user_row['user_id'], {
+            "text": render_daily_forecast(user_row['name'], unpack_date(user_row['local_day']), forecast),
+            "parse_mode": constants.ParseMode.HTML,
+        }
     
-    # Формируем промпт для AI (БЕЗ использования истории)
-    prompt = (
-        f"Сегодня {today.strftime('%d.%m.%Y')}, число дня: {day_num}\n\n"
-        f"Пользователь:\n"
-        f"- Имя: {user['name']}\n"
-        f"- Дата рождения: {user['birthdate']}\n"
-        f"- Число сознания: {user_consciousness}\n"
-        f"- Число миссии: {user_mission}\n\n"
-        f"Создай персонализированный прогноз на сегодня в формате Telegram-HTML:\n\n"
-        f"1. <b>🌟 Энергия дня</b> (2-3 предложения о числе {day_num} и что оно несет)\n"
-        f"2. <b>💫 Для тебя сегодня</b> (как энергия дня взаимодействует с числом сознания {user_consciousness} пользователя)\n"
-        f"3. <b>✨ Сильные стороны дня</b> (3-4 пункта списком с эмодзи)\n"
-        f"4. <b>⚠️ На что обратить внимание</b> (2-3 пункта списком с эмодзи)\n"
-        f"5. <b>🎯 Совет дня</b> (конкретная рекомендация)\n\n"
-        f"Будь кратким, позитивным и практичным. Ответ должен быть не более 400 слов."
+    async def send(item):
+        local_day, chat_id, kwargs = item
+        status = await broadcaster.deliver(context.bot, f"daily_forecast:{local_day}", chat_id, **kwargs)
+        results[status] += 1
+        if status in ("sent", "blocked"):
+            finished.append((chat_id, pending.pop(chat_id)))
+        return status
+    
+    pipeline = (
+        Pipeline("daily_forecasts", FORECAST_PIPELINE_QUEUE_SIZE)
+        .stage("generate", generate, FORECAST_GENERATION_CONCURRENCY)
+        .stage("render", render, 1)
+        .stage("send", send, BROADCAST_CONCURRENCY)
+    )
+    try:
+        stats, elapsed = await pipeline.run(select())
+    finally:
+        await adb.run(db.broadcast_sink.flush)
+    
+    # Ошибки отправки, генерации и этапов конвейера - повтор на одном из следующих тиков
+    await adb.finish_forecasts(finished)
+    given_up = await adb.retry_forecasts(
+        list(pending.items()), now + FORECAST_RETRY_MINUTES * 60, FORECAST_MAX_ATTEMPTS
     )
+    await adb.clear_stale_forecasts(now)
     
-    forecast = ask_deepseek_ai(prompt, user_id=user_id, max_tokens=1000, use_history=False)
+    if given_up:
+        logger.warning(f"⚠️ Прогнозы не доставлены за {FORECAST_MAX_ATTEMPTS} попыток: {given_up}")
+    if not stats["select"].items and not results:
+        return
     
-    # Формируем итоговое сообщение
-    header = (
-        f"🌅 <b>Доброе утро, {user['name']}!</b>\n\n"
-        f"📅 Сегодня: {today.strftime('%d.%m.%Y')}\n"
-        f"🔢 Число дня: <b>{day_num}</b>\n\n"
+    stages_text = "; ".join(f"{name}: {info.summary(elapsed)}" for name, info in stats.items())
+    logger.info(
+        f"🌅 Ежедневные прогнозы за {elapsed:.1f} с: отправлено {results['sent']}, "
+        f"уже было доставлено {results['skipped']}, чат недоступен {results['blocked']}, "
+        f"ошибок {results['failed']}, без прогноза {results['no_forecast']}, "
+        f"отложено на повтор {len(pending) - given_up}. "
+        f"Этапы - {stages_text}"
     )
-    
-    return header + forecast
 
 # ====
-# ЕЖЕДНЕВНЫЕ РАССЫЛКИ
+# ОБСЛУЖИВАНИЕ БАЗЫ ДАННЫХ
 # ====
 
-async def send_daily_forecasts(context: ContextTypes.DEFAULT_TYPE):
+async def run_db_maintenance(context: ContextTypes.DEFAULT_TYPE):
     """
-    Отправка ежедневных прогнозов всем PRO пользователям в 10:00 МСК
+    Ночное обслуживание БД: чистка по срокам хранения, vacuum, optimize
     """
-    logger.info("🌅 Начинаем отправку ежедневных прогнозов...")
-    
-    today = datetime.now(TZ)
-    
-    # Получаем всех пользователей с включенной рассылкой
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_id, name, birthdate 
-            FROM users 
-            WHERE birthdate IS NOT NULL 
-            AND daily_forecast_enabled = 1
-        """)
-        users = cursor.fetchall()
+    logger.info("🧹 Начинаем обслуживание базы данных...")
+    started = time.monotonic()
     
-    sent_count = 0
-    error_count = 0
-    
-    for user_row in users:
-        user_id = user_row['user_id']
-        
-        # Проверяем, что пользователь PRO
-        if not db.is_pro_user(user_id):
-            continue
-        
-        try:
-            forecast = generate_daily_forecast(user_id, today)
-            
-            if forecast:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=forecast,
-                    parse_mode=constants.ParseMode.HTML
-                )
-                sent_count += 1
-                logger.info(f"✅ Прогноз отправлен пользователю {user_id}")
-            
-            # Небольшая задержка чтобы не превысить лимиты Telegram
-            import asyncio
-            await asyncio.sleep(0.1)
-        
-        except Exception as e:
-            error_count += 1
-            logger.error(f"❌ Ошибка отправки прогноза пользователю {user_id}: {e}")
+    report = await adb.run_maintenance()
     
-    logger.info(f"🌅 Рассылка завершена. Отправлено: {sent_count}, Ошибок: {error_count}")
+    deleted = ", ".join(f"{table}: {count}" for table, count in report['deleted'].items())
+    logger.info(
+        f"🧹 Обслуживание завершено за {time.monotonic() - started:.1f} с. "
+        f"Удалено строк - {deleted}. "
+        f"Освобождено: {report['reclaimed_bytes'] / 1024 / 1024:.1f} МБ "
+        f"({report['size_before'] / 1024 / 1024:.1f} → {report['size_after'] / 1024 / 1024:.1f} МБ)"
+    )
 
 # ====
 # КЛАВИАТУРЫ
@@ -956,12 +3854,12 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username
     
     # Создаём пользователя если его нет
-    db.create_user(user_id, username)
-    user = db.get_user(user_id)
+    await adb.create_user(user_id, username)
+    user = await adb.get_user(user_id)
     
     # Если пользователь уже зарегистрирован
     if user and user['name'] and user['birthdate']:
-        is_pro = db.is_pro_user(user_id)
+        is_pro = await adb.is_pro_user(user_id)
         status = "⭐ PRO" if is_pro else "🆓 FREE"
         await update.message.reply_text(
             f"👋 С возвращением, <b>{user['name']}</b>!\n\n"
@@ -973,7 +3871,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Новый пользователь
-    db.update_user(user_id, state='awaiting_name')
+    await adb.update_user(user_id, state='awaiting_name')
     
     welcome_text = (
         "👋 <b>Привет! Я твой персональный бот-нумеролог</b>\n\n"
@@ -996,10 +3894,10 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Сброс всех состояний ожидания
-    db.update_user(user_id, state='idle')
-    context.user_data.clear()
+    await adb.update_user(user_id, state='idle')
+    await adb.clear_session(user_id)
     
-    is_pro = db.is_pro_user(user_id)
+    is_pro = await adb.is_pro_user(user_id)
     
     await update.message.reply_text(
         "🏠 <b>Главное меню</b>\n\nВыбери нужный раздел:",
@@ -1015,7 +3913,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/start - Начать работу с ботом\n"
         "/menu - Открыть главное меню\n"
         "/help - Показать эту справку\n"
-        "/cancel - Отменить текущее действие\n\n"
+        "/cancel - Отменить текущее действие\n"
+        "/forecast_time - Время ежедневного прогноза\n\n"
         "<b>Что умеет бот:</b>\n"
         "📊 Персональный нумерологический анализ\n"
         "❤️ Совместимость с партнёром\n"
@@ -1030,7 +3929,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• Безлимит запросов\n"
         "• Расширенный AI-анализ с историей\n"
         "• Детальные отчёты\n"
-        "• Ежедневные прогнозы в 10:00\n"
+        f"• Ежедневные прогнозы (по умолчанию в {FORECAST_HOUR}:00)\n"
         f"• От {SUBSCRIPTION_MONTH_PRICE}₽/месяц\n\n"
         "По всем вопросам: /help"
     )
@@ -1041,14 +3940,78 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=back_menu()
     )
 
+async def forecast_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Команда /forecast_time - время ежедневного прогноза
+    /forecast_time 8 - в 8 часов, /forecast_time 8 Asia/Yekaterinburg - с часовым поясом,
+    /forecast_time off | on - выключить / включить прогнозы
+    """
+    user_id = update.effective_user.id
+    user = await adb.get_user(user_id)
+    if not user or not user['birthdate']:
+        await update.message.reply_text("Сначала пройди регистрацию: /start")
+        return
+    
+    args = context.args
+    if not args:
+        hour = user['forecast_hour'] if user['forecast_hour'] is not None else FORECAST_HOUR
+        status = "включены" if user['daily_forecast_enabled'] else "выключены"
+        await update.message.reply_text(
+            f"🌅 <b>Ежедневный прогноз</b> ({status})\n\n"
+            f"Время: {hour}:00, часовой пояс: {user_timezone(user).key}\n\n"
+            f"Изменить:\n"
+            f"<code>/forecast_time 8</code> - в 8 часов\n"
+            f"<code>/forecast_time 8 Asia/Yekaterinburg</code> - с часовым поясом\n"
+            f"<code>/forecast_time off</code> / <code>on</code> - выключить / включить",
+            parse_mode=constants.ParseMode.HTML
+        )
+        return
+    
+    if args[0].lower() in ("off", "on"):
+        enabled = args[0].lower() == "on"
+        await adb.update_user(user_id, daily_forecast_enabled=int(enabled))
+        if enabled:
+            await reschedule_user_forecast(user_id)
+        await update.message.reply_text(
+            "✅ Ежедневные прогнозы включены." if enabled else "🔕 Ежедневные прогнозы выключены."
+        )
+        return
+    
+    try:
+        hour = int(args[0])
+        if not 0 <= hour <= 23:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❌ Укажи час от 0 до 23, например: /forecast_time 8")
+        return
+    
+    fields = {"forecast_hour": hour}
+    if len(args) > 1:
+        try:
+            ZoneInfo(args[1])
+        except (ZoneInfoNotFoundError, ValueError):
+            await update.message.reply_text(
+                "❌ Неизвестный часовой пояс. Пример: Europe/Moscow, Asia/Yekaterinburg"
+            )
+            return
+        fields["timezone"] = args[1]
+    
+    await adb.update_user(user_id, **fields)
+    await reschedule_user_forecast(user_id)
+    
+    user = await adb.get_user(user_id)
+    await update.message.reply_text(
+        f"✅ Прогноз будет приходить с {hour}:00 ({user_timezone(user).key})."
+    )
+
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /cancel - отмена текущего действия"""
     user_id = update.effective_user.id
     
-    db.update_user(user_id, state='idle')
-    context.user_data.clear()
+    await adb.update_user(user_id, state='idle')
+    await adb.clear_session(user_id)
     
-    is_pro = db.is_pro_user(user_id)
+    is_pro = await adb.is_pro_user(user_id)
     
     await update.message.reply_text(
         "❌ Действие отменено.",
@@ -1063,8 +4026,8 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
         return
     
-    stats = db.get_stats()
-    popular_functions = db.get_popular_functions(5)
+    stats = await adb.get_stats()
+    popular_functions = await adb.get_popular_functions(5)
     
     # Формируем список популярных функций
     functions_text = ""
@@ -1091,12 +4054,15 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• Всего пользователей: {stats['total_users']}\n"
         f"• PRO пользователей: {stats['pro_users']}\n"
         f"• FREE пользователей: {stats['free_users']}\n"
+        f"• Активных сегодня: {stats['active_today']}\n"
         f"• Действий за неделю: {stats['actions_week']}\n\n"
         f"🔥 <b>Популярные функции (30 дней):</b>\n"
         f"{functions_text}\n"
         f"<b>📋 Команды администратора:</b>\n"
         f"/admin_users - Список всех пользователей\n"
         f"/admin_stats - Детальная статистика\n"
+        f"/admin_ai - Очередь запросов к AI\n"
+        f"/admin_costs [дней] - Токены, стоимость и задержка AI\n"
         f"/grant_pro user_id months - Выдать PRO подписку\n"
         f"  Пример: <code>/grant_pro 123456789 1</code>\n"
         f"/grant_pro @username months - Выдать PRO по username\n"
@@ -1116,7 +4082,7 @@ async def admin_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
         return
     
-    users = db.get_all_users_with_status()
+    users = await adb.get_all_users_with_status()
     
     if not users:
         await update.message.reply_text("📭 В базе нет пользователей")
@@ -1134,7 +4100,7 @@ async def admin_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             status_emoji = "⭐" if user['status'] == 'PRO' else "🆓"
             username = f"@{user['username']}" if user['username'] else "—"
             name = user['name'] if user['name'] else "Не указано"
-            reg_date = user['registration_date'][:10] if user['registration_date'] else "—"
+            reg_date = user['registration_date'].strftime('%d.%m.%Y') if user['registration_date'] else "—"
             
             users_text += (
                 f"{status_emoji} <b>{user['status']}</b> | ID: <code>{user['user_id']}</code>\n"
@@ -1155,8 +4121,9 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
         return
     
-    stats = db.get_stats()
-    popular_functions = db.get_popular_functions(10)
+    stats = await adb.get_stats()
+    popular_functions = await adb.get_popular_functions(10)
+    ai_cache = await adb.get_ai_cache_stats()
     
     # Формируем детальную статистику функций
     functions_text = ""
@@ -1180,6 +4147,15 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     else:
         functions_text = "Нет данных\n"
     
+    # Кэш ответов AI по разделам
+    cache_text = ""
+    for feature, info in sorted(ai_cache['features'].items()):
+        requests_total = info.get('hits', 0) + info.get('misses', 0)
+        cache_text += (
+            f"• {feature}: {info.get('hits', 0)}/{requests_total} с запуска, "
+            f"записей {info['entries']}, попаданий всего {info['stored_hits'] or 0}\n"
+        )
+    
     stats_text = (
         "📊 <b>Детальная статистика бота</b>\n\n"
         f"👥 <b>Пользователи:</b>\n"
@@ -1188,8 +4164,16 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"• FREE пользователей: {stats['free_users']}\n"
         f"• Конверсия в PRO: {(stats['pro_users']/stats['total_users']*100 if stats['total_users'] > 0 else 0):.1f}%\n\n"
         f"📈 <b>Активность:</b>\n"
+        f"• Активных пользователей сегодня: {stats['active_today']}\n"
+        f"• Активных в день (среднее за неделю): {stats['active_week_avg']:.1f}\n"
         f"• Действий за неделю: {stats['actions_week']}\n"
-        f"• Среднее на пользователя: {(stats['actions_week']/stats['total_users'] if stats['total_users'] > 0 else 0):.1f}\n\n"
+        f"• Среднее на пользователя: {(stats['actions_week']/stats['total_users'] if stats['total_users'] > 0 else 0):.1f}\n"
+        f"• Потеряно событий статистики: {stats['stats_dropped']}\n\n"
+        f"🧠 <b>Кэш ответов AI:</b>\n"
+        f"• Записей: {ai_cache['entries']}\n"
+        f"• Попаданий с запуска: {ai_cache['hits']} из {ai_cache['hits'] + ai_cache['misses']} "
+        f"({ai_cache['hit_rate'] * 100:.1f}%)\n"
+        f"{cache_text}\n"
         f"🔥 <b>Популярные функции (за 30 дней):</b>\n\n"
         f"{functions_text}"
     )
@@ -1199,6 +4183,109 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         parse_mode=constants.ParseMode.HTML
     )
 
+async def admin_ai_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /admin_ai - очередь запросов к AI по классам приоритета"""
+    user_id = update.effective_user.id
+    
+    if user_id != ADMIN_USER_ID:
+        await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    classes_text = ""
+    for name, info in ai_scheduler.snapshot().items():
+        budget = f"{info['budget']}" if info['budget'] else "без ограничения"
+        classes_text += (
+            f"<b>{name}</b>\n"
+            f"• В очереди: {info['queued']}, выполняется: {info['running']}\n"
+            f"• Ожидание: среднее {info['avg_wait']:.2f} с, максимум {info['max_wait']:.2f} с\n"
+            f"• Запросов за минуту: {info['per_minute']}, всего: {info['started']}\n"
+            f"• Токенов за минуту: {info['tokens_minute']} (бюджет: {budget})\n\n"
+        )
+    
+    features_text = ""
+    for feature, info in ai_feature_usage.snapshot().items():
+        features_text += (
+            f"• {feature}: запросов {info['calls']}, кэш префикса {info['hit_rate'] * 100:.0f}% "
+            f"({info['hit_tokens']} / {info['hit_tokens'] + info['miss_tokens']} ток.), "
+            f"ответ {info['completion_tokens']} ток., задержка {info['avg_latency']:.1f} с\n"
+        )
+    
+    upstreams_text = ""
+    for upstream in (deepseek_upstream, yukassa_upstream):
+        info = upstream.snapshot()
+        upstreams_text += (
+            f"<b>{upstream.name}</b>: цепь {info['state']}, сбоев подряд {info['failures']}, "
+            f"повторов {info['retries']}, отклонено {info['rejected']}\n"
+        )
+        for operation, latency in info['operations'].items():
+            if latency['p50'] is None:
+                continue
+            upstreams_text += (
+                f"• {operation}: p50 {latency['p50']:.2f} с, p95 {latency['p95']:.2f} с, "
+                f"таймаут {latency['timeout']:.1f} с\n"
+            )
+    
+    await update.message.reply_text(
+        "📡 <b>Очередь запросов к AI</b>\n\n"
+        f"Одновременно не более {ai_scheduler.max_concurrency} запросов\n"
+        f"Одинаковых запросов объединено: {ai_single_flight.coalesced} "
+        f"(ушло в API: {ai_single_flight.leaders})\n\n"
+        f"{classes_text}"
+        f"💾 <b>Кэш префикса DeepSeek по разделам</b>\n"
+        f"{features_text or 'Нет данных'}\n\n"
+        f"🛡 <b>Внешние сервисы</b>\n"
+        f"{upstreams_text}",
+        parse_mode=constants.ParseMode.HTML
+    )
+
+async def admin_costs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /admin_costs [дней] - токены, стоимость и задержка запросов к AI"""
+    user_id = update.effective_user.id
+    
+    if user_id != ADMIN_USER_ID:
+        await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    days = 7
+    if context.args:
+        try:
+            days = max(1, min(int(context.args[0]), USAGE_STATS_RETENTION_DAYS))
+        except ValueError:
+            await update.message.reply_text("❌ Укажите количество дней числом, например: /admin_costs 30")
+            return
+    
+    report = await adb.get_ai_cost_report(days)
+    
+    def format_line(title: str, info: Dict) -> str:
+        latency = (
+            f"p50 {info['p50']:.2f} с, p95 {info['p95']:.2f} с"
+            if info['p50'] is not None else "задержка -"
+        )
+        return (
+            f"<b>{title}</b>: {info['calls']} запр. (ошибок {info['errors']}), ${info['cost']:.3f}\n"
+            f"  вход {info['prompt_tokens']} (из кэша {info['cached_tokens']}), "
+            f"ответ {info['completion_tokens']}, {latency}\n"
+        )
+    
+    features_text = "".join(format_line(info['feature'], info) for info in report['features'])
+    days_text = "".join(
+        format_line(unpack_date(info['day']).strftime('%d.%m'), info) for info in report['days']
+    )
+    total_cost = sum(info['cost'] for info in report['features'])
+    
+    await update.message.reply_text(
+        f"💰 <b>Запросы к AI за {days} дн.</b>\n"
+        f"Итого: ${total_cost:.3f}\n"
+        f"Цены за 1 млн токенов: кэш ${DEEPSEEK_PRICE_CACHE_HIT}, вход ${DEEPSEEK_PRICE_CACHE_MISS}, "
+        f"ответ ${DEEPSEEK_PRICE_OUTPUT}\n\n"
+        f"📂 <b>По разделам</b>\n"
+        f"{features_text or 'Нет данных'}\n"
+        f"📅 <b>По дням</b>\n"
+        f"{days_text or 'Нет данных'}\n"
+        f"Ожидают записи: {report['pending']}, потеряно: {report['dropped']}",
+        parse_mode=constants.ParseMode.HTML
+    )
+
 async def grant_pro_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /grant_pro - выдача PRO подписки администратором"""
     user_id = update.effective_user.id
@@ -1238,12 +4325,7 @@ async def grant_pro_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if target_identifier.startswith('@'):
         # Поиск по username
         username = target_identifier[1:]  # Убираем @
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT user_id FROM users WHERE username = ?", (username,))
-            result = cursor.fetchone()
-            if result:
-                target_user_id = result['user_id']
+        target_user_id = await adb.get_user_id_by_username(username)
     else:
         # Прямой user_id
         try:
@@ -1260,7 +4342,7 @@ async def grant_pro_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Проверка существования пользователя
-    target_user = db.get_user(target_user_id)
+    target_user = await adb.get_user(target_user_id)
     if not target_user:
         await update.message.reply_text(
             f"❌ Пользователь с ID {target_user_id} не найден в базе"
@@ -1268,12 +4350,13 @@ async def grant_pro_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Выдача подписки
-    db.add_subscription(
+    await adb.add_subscription(
         target_user_id,
         subscription_type="PRO" if months >= 12 else "PRO_MONTH",
         months=months,
         payment_id=f"ADMIN_GRANT_{user_id}"
     )
+    await reschedule_user_forecast(target_user_id)
     
     # Уведомление администратора
     await update.message.reply_text(
@@ -1315,10 +4398,10 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     text = (update.message.text or "").strip()
     
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user:
-        db.create_user(user_id, update.effective_user.username)
-        user = db.get_user(user_id)
+        await adb.create_user(user_id, update.effective_user.username)
+        user = await adb.get_user(user_id)
     
     state = user.get('state', 'idle')
     
@@ -1328,7 +4411,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text("❌ Имя слишком длинное. Попробуйте ещё раз:")
             return
         
-        db.update_user(user_id, name=text, state='awaiting_birthdate')
+        await adb.update_user(user_id, name=text, state='awaiting_birthdate')
         await update.message.reply_text(
             f"Отлично, <b>{text}</b>! 👍\n\n"
             f"Теперь введи дату рождения в формате <b>ДД.ММ.ГГГГ</b>\n"
@@ -1356,11 +4439,12 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return
         
-        db.update_user(user_id, birthdate=text, state='idle')
+        await adb.update_user(user_id, birthdate=birthdate, state='idle')
         db.log_action(user_id, 'registration_complete')
+        await reschedule_user_forecast(user_id)
         
         # Генерируем отчёт
-        user = db.get_user(user_id)
+        user = await adb.get_user(user_id)
         report = build_full_report(user['name'], birthdate)
         
         await update.message.reply_text(
@@ -1368,7 +4452,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             parse_mode=constants.ParseMode.HTML
         )
         
-        is_pro = db.is_pro_user(user_id)
+        is_pro = await adb.is_pro_user(user_id)
         
         await update.message.reply_text(
             "✅ <b>Регистрация завершена!</b>\n\n"
@@ -1391,92 +4475,62 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return
         
-        db.update_user(user_id, state='idle')
+        await adb.update_user(user_id, state='idle')
         
-        # Проверка лимитов
-        if not db.check_daily_limit(user_id):
+        # Проверка и списание лимита одним атомарным запросом
+        cost = feature_cost('compatibility_check')
+        if not await adb.consume_quota(user_id, cost):
             await show_limit_message(update.message)
             return
         
-        db.increment_daily_requests(user_id)
         db.log_action(user_id, 'compatibility_check')
         
         # Генерация отчёта совместимости через AI (БЕЗ истории)
         wait_msg = await update.message.reply_text("⏳ Анализирую совместимость...")
         
-        profile_context = build_user_profile_context(user_id)
+        profile_context = await build_user_profile_context(user_id)
         prompt = (
             f"{profile_context}\n"
-            f"Сделай анализ совместимости на основе нумерологического анализа с партнёром, "
-            f"родившимся {partner_date.strftime('%d.%m.%Y')}.\n\n"
-            f"Формат ответа в Telegram-HTML:\n"
-            f"<b>💑 Совместимость</b>\n\n"
-            f"<b>✅ Сильные стороны пары:</b>\n"
-            f"(перечисли 3-4 пункта с эмодзи)\n\n"
-            f"<b>⚠️ Возможные вызовы:</b>\n"
-            f"(перечисли 2-3 пункта)\n\n"
-            f"<b>💡 Рекомендации:</b>\n"
-            f"(дай 3-4 практических совета)"
+            f"Партнёр родился {partner_date.strftime('%d.%m.%Y')}."
         )
         
-        result = ask_deepseek_ai(prompt, user_id=user_id, max_tokens=1200, use_history=False)
-        
-        try:
-            await wait_msg.delete()
-        except:
-            pass
-        
-        await update.message.reply_text(
-            result,
-            parse_mode=constants.ParseMode.HTML,
-            reply_markup=back_menu()
+        await reply_with_ai(
+            wait_msg, prompt, user_id, cost=cost, max_tokens=1200, feature='compatibility_check'
         )
         return
     
     # === Ожидание вопроса для AI (С ИСТОРИЕЙ) ===
     if state == 'awaiting_ai_question':
-        db.update_user(user_id, state='idle')
+        await adb.update_user(user_id, state='idle')
         
-        # Проверка лимитов
-        if not db.check_daily_limit(user_id):
+        # Проверка и списание лимита одним атомарным запросом
+        cost = feature_cost('ai_question')
+        if not await adb.consume_quota(user_id, cost):
             await show_limit_message(update.message)
             return
         
-        db.increment_daily_requests(user_id)
         db.log_action(user_id, 'ai_question')
         
         wait_msg = await update.message.reply_text("⏳ Обрабатываю ваш вопрос...")
         
-        profile_context = build_user_profile_context(user_id)
-        prompt = (
-            f"{profile_context}\n"
-            f"Вопрос пользователя: {text}\n\n"
-            f"Ответь на вопрос, опираясь на нумерологический профиль пользователя. "
-            f"Дай конкретные практические рекомендации. Ответ форматируй в Telegram-HTML."
-        )
+        # Профиль идёт отдельным контекстом - в историю попадает только вопрос
+        profile_context = await build_user_profile_context(user_id)
         
         # ВАЖНО: use_history=True - AI будет помнить предыдущие сообщения
-        result = ask_deepseek_ai(prompt, user_id=user_id, use_history=True)
-        
-        try:
-            await wait_msg.delete()
-        except:
-            pass
-        
-        await update.message.reply_text(
-            result,
-            parse_mode=constants.ParseMode.HTML,
-            reply_markup=back_menu()
+        await reply_with_ai(
+            wait_msg, text, user_id, cost=cost, use_history=True,
+            context=profile_context, feature='ai_question'
         )
         return
     
     # === Прохождение теста ===
-    if 'test_state' in context.user_data:
-        test_state = context.user_data['test_state']
+    test_state = (await adb.get_session(user_id)).get('test_state')
+    if test_state:
         test_state['answers'].append(text)
         test_state['idx'] += 1
         
         if test_state['idx'] < len(test_state['questions']):
+            await adb.update_session(user_id, test_state=test_state)
             # Следующий вопрос
             await update.message.reply_text(
                 f"📝 <b>Вопрос {test_state['idx'] + 1}/{len(test_state['questions'])}</b>\n\n"
@@ -1491,7 +4545,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         wait_msg = await update.message.reply_text("⏳ Анализирую ваши ответы...")
         
-        profile_context = build_user_profile_context(user_id)
+        profile_context = await build_user_profile_context(user_id)
         answers_text = "\n".join([
             f"{i+1}. {q}\nОтвет: {a}"
             for i, (q, a) in enumerate(zip(test_state['questions'], test_state['answers']))
@@ -1499,57 +4553,34 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         prompt = (
             f"{profile_context}\n"
-            f"Проведена мини-диагностика на основе нумерологии.\n\n"
-            f"Вопросы и ответы:\n{answers_text}\n\n"
-            f"Сделай краткий вывод в Telegram-HTML:\n"
-            f"<b>✨ Сильные стороны</b>\n"
-            f"<b>🎯 Зоны роста</b>\n"
-            f"<b>💡 Рекомендация недели</b>"
+            f"Вопросы и ответы:\n{answers_text}"
         )
         
-        result = ask_deepseek_ai(prompt, user_id=user_id, use_history=False)
-        
-        try:
-            await wait_msg.delete()
-        except:
-            pass
-        
-        context.user_data.pop('test_state', None)
+        await adb.update_session(user_id, test_state=None)
         
-        await update.message.reply_text(
-            f"✅ <b>Тест завершён!</b>\n\n{result}",
-            parse_mode=constants.ParseMode.HTML,
-            reply_markup=back_menu()
+        await reply_with_ai(
+            wait_msg, prompt, user_id, header="✅ <b>Тест завершён!</b>\n\n", feature='test_complete'
         )
         return
     
     # === Свободный текст - передаём AI с историей ===
     if user.get('birthdate'):
-        # Проверка лимитов
-        if not db.check_daily_limit(user_id):
+        # Проверка и списание лимита одним атомарным запросом
+        cost = feature_cost('free_text_query')
+        if not await adb.consume_quota(user_id, cost):
             await show_limit_message(update.message)
             return
         
-        db.increment_daily_requests(user_id)
         db.log_action(user_id, 'free_text_query')
         
         wait_msg = await update.message.reply_text("⏳ Обрабатываю...")
         
-        profile_context = build_user_profile_context(user_id)
-        prompt = f"{profile_context}\n{text}\n\nОтветь используя нумерологический профиль, форматируй в Telegram-HTML."
+        profile_context = await build_user_profile_context(user_id)
         
         # С историей для естественного диалога
-        result = ask_deepseek_ai(prompt, user_id=user_id, use_history=True)
-        
-        try:
-            await wait_msg.delete()
-        except:
-            pass
-        
-        await update.message.reply_text(
-            result,
-            parse_mode=constants.ParseMode.HTML,
-            reply_markup=back_menu()
+        await reply_with_ai(
+            wait_msg, text, user_id, cost=cost, use_history=True,
+            context=profile_context, feature='free_text_query'
         )
     else:
         await update.message.reply_text(
@@ -1568,18 +4599,18 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     callback_data = query.data
     
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user:
-        db.create_user(user_id, query.from_user.username)
-        user = db.get_user(user_id)
+        await adb.create_user(user_id, query.from_user.username)
+        user = await adb.get_user(user_id)
     
     # Проверка PRO статуса
-    is_pro = db.is_pro_user(user_id)
+    is_pro = await adb.is_pro_user(user_id)
     
     # === Возврат в меню ===
     if callback_data == "menu":
-        db.update_user(user_id, state='idle')
-        context.user_data.clear()
+        await adb.update_user(user_id, state='idle')
+        await adb.clear_session(user_id)
         
         await query.message.reply_text(
             "🏠 <b>Главное меню</b>\n\nВыбери нужный раздел:",
@@ -1612,7 +4643,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_pro_required_message(query, feature_names.get(callback_data, "Этот раздел"))
         return
     
-    birthdate = datetime.strptime(user['birthdate'], "%d.%m.%Y")
+    birthdate = user['birthdate']
     
     # === Моя карта ===
     if callback_data == "card":
@@ -1628,7 +4659,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # === Совместимость ===
     if callback_data == "compat":
-        db.update_user(user_id, state='awaiting_compat_date')
+        await adb.update_user(user_id, state='awaiting_compat_date')
         
         await query.message.reply_text(
             "❤️ <b>Совместимость</b>\n\n"
@@ -1641,106 +4672,62 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # === Практики роста ===
     if callback_data == "practices":
-        # Проверка лимитов
-        if not db.check_daily_limit(user_id):
+        # Проверка и списание лимита одним атомарным запросом
+        cost = feature_cost('view_practices')
+        if not await adb.consume_quota(user_id, cost):
             await show_limit_message(query.message)
             return
         
-        db.increment_daily_requests(user_id)
         db.log_action(user_id, 'view_practices')
         
         wait_msg = await query.message.reply_text("⏳ Подбираю практики...")
         
-        profile_context = build_user_profile_context(user_id)
-        prompt = (
-            f"{profile_context}\n"
-            f"Составь персональные практики на основе нумерологии для прокачки зон роста (пустых чисел матрицы). "
-            f"Для каждого числа дай 2-3 простых конкретных шага.\n"
-            f"Формат Telegram-HTML с эмодзи."
-        )
-        
-        result = ask_deepseek_ai(prompt, user_id=user_id, use_history=False)
+        # Ответ зависит только от профиля - общий кэш для одинаковых профилей
+        prompt = shared_profile_context(birthdate)
         
-        try:
-            await wait_msg.delete()
-        except:
-            pass
-        
-        await query.message.reply_text(
-            result,
-            parse_mode=constants.ParseMode.HTML,
-            reply_markup=back_menu()
+        await reply_with_ai(
+            wait_msg, prompt, user_id, cost=cost, feature='view_practices',
+            cache_key=ai_cache_key('view_practices', birthdate), name=user['name']
         )
         return
     
     # === Личный гайд ===
     if callback_data == "guide":
-        # Проверка лимитов
-        if not db.check_daily_limit(user_id):
+        # Проверка и списание лимита одним атомарным запросом
+        cost = feature_cost('view_guide')
+        if not await adb.consume_quota(user_id, cost):
             await show_limit_message(query.message)
             return
         
-        db.increment_daily_requests(user_id)
         db.log_action(user_id, 'view_guide')
         
         wait_msg = await query.message.reply_text("⏳ Создаю твой личный гайд...")
         
-        profile_context = build_user_profile_context(user_id)
-        prompt = (
-            f"{profile_context}\n"
-            f"Составь персональный гайд на основе нумерологии. Формат Telegram-HTML:\n"
-            f"<b>✨ Сильные стороны</b> (3-4 пункта)\n"
-            f"<b>🎯 Зоны роста</b> (2-3 пункта)\n"
-            f"<b>💪 Практика недели</b> (конкретное упражнение)\n"
-            f"<b>💡 Ключевой совет</b>\n"
-            f"Коротко, дружелюбно, без воды."
-        )
-        
-        result = ask_deepseek_ai(prompt, user_id=user_id, use_history=False)
-        
-        try:
-            await wait_msg.delete()
-        except:
-            pass
+        prompt = shared_profile_context(birthdate)
         
-        await query.message.reply_text(
-            result,
-            parse_mode=constants.ParseMode.HTML,
-            reply_markup=back_menu()
+        await reply_with_ai(
+            wait_msg, prompt, user_id, cost=cost, feature='view_guide',
+            cache_key=ai_cache_key('view_guide', birthdate), name=user['name']
         )
         return
     
     # === Книги и фильмы ===
     if callback_data == "media":
-        # Проверка лимитов
-        if not db.check_daily_limit(user_id):
+        # Проверка и списание лимита одним атомарным запросом
+        cost = feature_cost('view_media')
+        if not await adb.consume_quota(user_id, cost):
             await show_limit_message(query.message)
             return
         
-        db.increment_daily_requests(user_id)
         db.log_action(user_id, 'view_media')
         
         wait_msg = await query.message.reply_text("⏳ Подбираю рекомендации...")
         
-        profile_context = build_user_profile_context(user_id)
-        prompt = (
-            f"{profile_context}\n"
-            f"Подбери 6-8 рекомендаций книг и фильмов под нумерологический профиль. "
-            f"Для каждого укажи название и кратко (1 строка) — почему подходит.\n"
-            f"Формат Telegram-HTML с эмодзи 📚 и 🎬."
-        )
-        
-        result = ask_deepseek_ai(prompt, user_id=user_id, use_history=False)
-        
-        try:
-            await wait_msg.delete()
-        except:
-            pass
+        prompt = shared_profile_context(birthdate)
         
-        await query.message.reply_text(
-            result,
-            parse_mode=constants.ParseMode.HTML,
-            reply_markup=back_menu()
+        await reply_with_ai(
+            wait_msg, prompt, user_id, cost=cost, feature='view_media',
+            cache_key=ai_cache_key('view_media', birthdate), name=user['name']
         )
         return
     
@@ -1756,11 +4743,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Какой 1 результат хочешь получить за неделю?"
         ]
         
-        context.user_data['test_state'] = {
+        await adb.update_session(user_id, test_state={
             'questions': questions,
             'idx': 0,
             'answers': []
-        }
+        })
         
         await query.message.reply_text(
             f"📝 <b>Мини-тест на основе нумерологии</b>\n\n"
@@ -1774,13 +4761,13 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # === Спросить AI ===
     if callback_data == "ask_ai":
-        db.update_user(user_id, state='awaiting_ai_question')
+        await adb.update_user(user_id, state='awaiting_ai_question')
         
-        user_info = db.get_user(user_id)
+        user_info = await adb.get_user(user_id)
         remaining = ""
         
         if not is_pro:
-            today = datetime.now().date().isoformat()
+            today = quota_day()
             if user_info['last_request_date'] == today:
                 remaining = f"\n\n📊 Осталось запросов сегодня: {FREE_DAILY_LIMIT - user_info['daily_requests']}/{FREE_DAILY_LIMIT}"
         
@@ -1796,7 +4783,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # === Очистить историю AI ===
     if callback_data == "clear_history":
-        db.clear_conversation_history(user_id)
+        await adb.clear_conversation_history(user_id)
         await query.message.reply_text(
             "🗑 <b>История диалога очищена</b>\n\n"
             "Теперь AI начнёт новый диалог с чистого листа.",
@@ -1807,18 +4794,16 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # === Календарь ===
     if callback_data == "calendar":
-        # Генерируем календарь на неделю вперед
-        if not db.check_daily_limit(user_id):
+        # Проверка и списание лимита одним атомарным запросом
+        cost = feature_cost('view_calendar')
+        if not await adb.consume_quota(user_id, cost):
             await show_limit_message(query.message)
             return
         
-        db.increment_daily_requests(user_id)
         db.log_action(user_id, 'view_calendar')
         
         wait_msg = await query.message.reply_text("⏳ Формирую календарь...")
         
-        profile_context = build_user_profile_context(user_id)
-        
         # Формируем информацию о числах на неделю вперед
         today = datetime.now(TZ)
         week_info = []
@@ -1828,24 +4813,15 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             week_info.append(f"{day.strftime('%d.%m (%A)')}: число дня {day_num}")
         
         prompt = (
-            f"{profile_context}\n"
-            f"Создай персональный календарь на неделю вперед:\n"
-            f"{chr(10).join(week_info)}\n\n"
-            f"Для каждого дня дай краткую рекомендацию (1-2 строки) с учётом числа дня и профиля пользователя.\n"
-            f"Формат Telegram-HTML с эмодзи."
+            f"{shared_profile_context(birthdate)}\n"
+            f"Дни недели:\n"
+            f"{chr(10).join(week_info)}"
         )
         
-        result = ask_deepseek_ai(prompt, user_id=user_id, use_history=False, max_tokens=1500)
-        
-        try:
-            await wait_msg.delete()
-        except:
-            pass
-        
-        await query.message.reply_text(
-            f"📅 <b>Твой персональный календарь</b>\n\n{result}",
-            parse_mode=constants.ParseMode.HTML,
-            reply_markup=back_menu()
+        await reply_with_ai(
+            wait_msg, prompt, user_id, cost=cost, feature='view_calendar',
+            header="📅 <b>Твой персональный календарь</b>\n\n",
+            cache_key=ai_cache_key('view_calendar', birthdate, pack_date(today)), name=user['name']
         )
         return
     
@@ -1856,25 +4832,17 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         profile_text = (
             f"👤 <b>Профиль</b>\n\n"
             f"Имя: <b>{user['name']}</b>\n"
-            f"Дата рождения: <b>{user['birthdate']}</b>\n"
+            f"Дата рождения: <b>{user['birthdate'].strftime('%d.%m.%Y')}</b>\n"
             f"Статус: {status}\n"
         )
         
         if is_pro:
             # Найти дату окончания подписки
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT expiry_date FROM subscriptions 
-                    WHERE user_id = ? AND payment_status = 'succeeded' AND expiry_date > ?
-                    ORDER BY expiry_date DESC LIMIT 1
-                """, (user_id, datetime.now().isoformat()))
-                result = cursor.fetchone()
-                if result:
-                    expiry = datetime.fromisoformat(result['expiry_date'])
-                    profile_text += f"Подписка до: <b>{expiry.strftime('%d.%m.%Y')}</b>\n"
+            expiry = await adb.get_pro_until(user_id)
+            if expiry:
+                profile_text += f"Подписка до: <b>{expiry.strftime('%d.%m.%Y')}</b>\n"
         else:
-            today = datetime.now().date().isoformat()
+            today = quota_day()
             if user['last_request_date'] == today:
                 profile_text += f"\nЗапросов сегодня: {user['daily_requests']}/{FREE_DAILY_LIMIT}\n"
         
@@ -1910,7 +4878,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "✅ Детальная совместимость\n"
             "✅ Персональные практики и рекомендации\n"
             "✅ Подбор книг и фильмов\n"
-            "✅ Ежедневные прогнозы в 10:00 МСК\n"
+            f"✅ Ежедневные прогнозы (по умолчанию в {FORECAST_HOUR}:00, время настраивается)\n"
             "✅ Персональный календарь\n"
             "✅ Приоритетная поддержка\n\n"
             f"<b>Тарифы:</b>\n"
@@ -1949,7 +4917,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Создаём платёж через YooKassa
-        payment_data = yukassa.create_payment(
+        payment_data = await yukassa.create_payment(
             amount=SUBSCRIPTION_MONTH_PRICE,
             description="PRO подписка на 1 месяц - Нумеролог бот",
             user_id=user_id,
@@ -1963,9 +4931,10 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        # Сохраняем payment_id для отслеживания
-        context.user_data['pending_payment_id'] = payment_data['payment_id']
-        context.user_data['pending_subscription_months'] = 1
+        # Сохраняем payment_id для отслеживания (в БД - проверку может принять другой экземпляр бота)
+        await adb.update_session(
+            user_id, pending_payment_id=payment_data['payment_id'], pending_subscription_months=1
+        )
         
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("💳 Оплатить", url=payment_data['confirmation_url'])],
@@ -1993,7 +4962,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        payment_data = yukassa.create_payment(
+        payment_data = await yukassa.create_payment(
             amount=SUBSCRIPTION_YEAR_PRICE,
             description="PRO подписка на 1 год - Нумеролог бот",
             user_id=user_id,
@@ -2007,8 +4976,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        context.user_data['pending_payment_id'] = payment_data['payment_id']
-        context.user_data['pending_subscription_months'] = 12
+        await adb.update_session(
+            user_id, pending_payment_id=payment_data['payment_id'], pending_subscription_months=12
+        )
         
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("💳 Оплатить", url=payment_data['confirmation_url'])],
@@ -2030,8 +5000,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # === Проверка платежа ===
     if callback_data == "check_payment":
-        payment_id = context.user_data.get('pending_payment_id')
-        months = context.user_data.get('pending_subscription_months', 1)
+        session = await adb.get_session(user_id)
+        payment_id = session.get('pending_payment_id')
+        months = session.get('pending_subscription_months', 1)
         
         if not payment_id:
             await query.message.reply_text(
@@ -2041,7 +5012,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Проверяем статус платежа
-        payment_info = yukassa.check_payment(payment_id)
+        payment_info = await yukassa.check_payment(payment_id)
         
         if not payment_info:
             await query.message.reply_text(
@@ -2054,16 +5025,16 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         if payment_status == 'succeeded':
             # Платёж успешен - активируем подписку
-            db.add_subscription(
+            await adb.add_subscription(
                 user_id,
                 subscription_type="PRO_YEAR" if months >= 12 else "PRO_MONTH",
                 months=months,
                 payment_id=payment_id
             )
+            await reschedule_user_forecast(user_id)
             
             # Очищаем временные данные
-            context.user_data.pop('pending_payment_id', None)
-            context.user_data.pop('pending_subscription_months', None)
+            await adb.update_session(user_id, pending_payment_id=None, pending_subscription_months=None)
             
             await query.message.reply_text(
                 f"🎉 <b>Поздравляем!</b>\n\n"
@@ -2155,7 +5126,7 @@ async def show_pro_required_message(query_or_message, feature_name: str = "эт
         f"✅ Мини-тест для самоанализа\n"
         f"✅ Безлимитный AI-психолог с памятью\n"
         f"✅ Персональный календарь\n"
-        f"✅ Ежедневные прогнозы в 10:00\n\n"
+        f"✅ Ежедневные прогнозы в удобное время\n\n"
         f"<b>Стоимость:</b>\n"
         f"💳 {SUBSCRIPTION_MONTH_PRICE}₽/месяц\n"
         f"💳 {SUBSCRIPTION_YEAR_PRICE}₽/год <i>(экономия 17%)</i>"
@@ -2208,16 +5179,53 @@ async def post_init(application: Application) -> None:
     Выполняется после инициализации Application
     Здесь job_queue уже готов к использованию
     """
+    if not BOT_RUN_JOBS:
+        logger.info("⏸ Фоновые задачи отключены (BOT_RUN_JOBS=0)")
+        return
+    
     jq = application.job_queue
     
-    # Настройка ежедневной рассылки в 10:00 МСК
+    # Слоты прогнозов раскладываются раз в сутки и сразу после запуска
     jq.run_daily(
+        plan_daily_forecasts,
+        time=dt_time(hour=0, minute=5, second=0, tzinfo=TZ),
+        name='plan_daily_forecasts'
+    )
+    jq.run_once(plan_daily_forecasts, when=5, name='plan_daily_forecasts_startup')
+    
+    # Доставка наступивших слотов
+    jq.run_repeating(
         send_daily_forecasts,
-        time=dt_time(hour=10, minute=0, second=0, tzinfo=TZ),
+        interval=FORECAST_TICK_SECONDS,
+        first=15,
         name='daily_forecasts'
     )
     
-    logger.info("📅 Ежедневная рассылка настроена на 10:00 МСК")
+    logger.info(
+        f"📅 Ежедневная рассылка: с {FORECAST_HOUR}:00 по местному времени пользователя, "
+        f"в течение {FORECAST_SPREAD_MINUTES} мин"
+    )
+    
+    # Ночное обслуживание БД
+    jq.run_daily(
+        run_db_maintenance,
+        time=dt_time(hour=MAINTENANCE_HOUR, minute=30, second=0, tzinfo=TZ),
+        name='db_maintenance'
+    )
+    
+    logger.info(f"🧹 Обслуживание БД настроено на {MAINTENANCE_HOUR:02d}:30 МСК")
+
+async def post_shutdown(application: Application) -> None:
+    """
+    Выполняется при остановке Application
+    Закрывает пулы соединений DeepSeek и YooKassa, дожидается фоновых запросов к БД
+    и закрывает подключения
+    """
+    await deepseek.close()
+    if yukassa:
+        await yukassa.close()
+    adb.shutdown()
+    logger.info("🛑 Подключения к базе данных закрыты")
 
 # ====
 # ГЛАВНАЯ ФУНКЦИЯ
@@ -2242,6 +5250,7 @@ def main():
         Application.builder()
         .token(BOT_TOKEN)
         .post_init(post_init)  # ВАЖНО: инициализация JobQueue
+        .post_shutdown(post_shutdown)
         .build()
     )
     
@@ -2250,9 +5259,12 @@ def main():
     application.add_handler(CommandHandler("menu", menu_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(CommandHandler("forecast_time", forecast_time_command))
     application.add_handler(CommandHandler("admin", admin_command))
     application.add_handler(CommandHandler("admin_users", admin_users_command))
     application.add_handler(CommandHandler("admin_stats", admin_stats_command))
+    application.add_handler(CommandHandler("admin_ai", admin_ai_command))
+    application.add_handler(CommandHandler("admin_costs", admin_costs_command))
     application.add_handler(CommandHandler("grant_pro", grant_pro_command))
     
     # Регистрация обработчика текстовых сообщений
@@ -2266,11 +5278,40 @@ def main():
     # Регистрация обработчика ошибок
     application.add_error_handler(error_handler)
     
-    # Запуск бота
-    logger.info("✅ Бот успешно запущен!")
-    logger.info("Нажмите Ctrl+C для остановки")
+    # Бот обрабатывает только сообщения и нажатия кнопок - остальные типы
+    # обновлений Telegram не присылает
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Запуск бота
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL or not WEBHOOK_SECRET_TOKEN:
+            logger.error("❌ Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET_TOKEN")
+            return
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET_TOKEN):
+            logger.error("❌ WEBHOOK_SECRET_TOKEN: допустимы 1-256 символов A-Z, a-z, 0-9, _ и -")
+            return
+        
+        logger.info(
+            f"✅ Бот запущен в режиме webhook: {WEBHOOK_URL} "
+            f"(слушаем {WEBHOOK_LISTEN}:{WEBHOOK_PORT}, соединений до {WEBHOOK_MAX_CONNECTIONS})"
+        )
+        # Запросы без верного секрета в заголовке отклоняются самим сервером webhook
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=allowed_updates,
+        )
+    elif BOT_MODE == "polling":
+        logger.info("✅ Бот успешно запущен!")
+        logger.info("Нажмите Ctrl+C для остановки")
+        
+        application.run_polling(allowed_updates=allowed_updates)
+    else:
+        logger.error(f"❌ Неизвестный BOT_MODE: {BOT_MODE} (ожидается polling или webhook)")
 
 if __name__ == "__main__":
     main()
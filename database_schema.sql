@@ -1,6 +1,13 @@
 -- ================================================
 -- СХЕМА БАЗЫ ДАННЫХ ДЛЯ TELEGRAM БОТА
 -- Версия: 5.0 с поддержкой истории диалогов
+--
+-- Бот создаёт и обновляет схему сам: миграции из списка MIGRATIONS в bot.py
+-- применяются по порядку, номер последней хранится в PRAGMA user_version.
+-- Этот файл - справочное описание итоговой схемы.
+--
+-- Время хранится как INTEGER unix epoch (секунды), календарные даты -
+-- как INTEGER YYYYMMDD (например, 19950622).
 -- ================================================
 
 -- Таблица пользователей
@@ -8,13 +15,17 @@ CREATE TABLE IF NOT EXISTS users (
     user_id INTEGER PRIMARY KEY,
     username TEXT,
     name TEXT,
-    birthdate TEXT,
-    registration_date TEXT,
+    birthdate INTEGER,
+    registration_date INTEGER,
     state TEXT DEFAULT 'idle',
     language TEXT DEFAULT 'ru',
     daily_requests INTEGER DEFAULT 0,
-    last_request_date TEXT,
-    daily_forecast_enabled INTEGER DEFAULT 1
+    last_request_date INTEGER,
+    daily_forecast_enabled INTEGER DEFAULT 1,
+    pro_until INTEGER,
+    blocked_at INTEGER,                  -- unix epoch, бот заблокирован / аккаунт удалён
+    forecast_hour INTEGER,               -- час прогноза по местному времени (NULL - FORECAST_HOUR)
+    timezone TEXT                        -- часовой пояс IANA (NULL - Europe/Moscow)
 );
 
 -- Таблица подписок
@@ -22,8 +33,8 @@ CREATE TABLE IF NOT EXISTS subscriptions (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER,
     subscription_type TEXT,
-    start_date TEXT,
-    expiry_date TEXT,
+    start_date INTEGER,
+    expiry_date INTEGER,
     payment_status TEXT,
     payment_id TEXT,
     auto_renew INTEGER DEFAULT 0,
@@ -35,7 +46,7 @@ CREATE TABLE IF NOT EXISTS usage_stats (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER,
     action_type TEXT,
-    timestamp TEXT,
+    timestamp INTEGER,
     FOREIGN KEY (user_id) REFERENCES users(user_id)
 );
 
@@ -45,13 +56,112 @@ CREATE TABLE IF NOT EXISTS conversation_history (
     user_id INTEGER,
     role TEXT,              -- 'user' или 'assistant'
     content TEXT,           -- текст сообщения
-    timestamp TEXT,         -- время создания ISO 8601
+    timestamp INTEGER,      -- время создания (unix epoch, секунды)
     FOREIGN KEY (user_id) REFERENCES users(user_id)
 );
 
--- Индекс для быстрого поиска по user_id
-CREATE INDEX IF NOT EXISTS idx_conversation_user_id 
-ON conversation_history(user_id, timestamp DESC);
+-- Резюме старой части диалога: сообщения до covered_until_id свёрнуты в summary
+CREATE TABLE IF NOT EXISTS conversation_summaries (
+    user_id INTEGER PRIMARY KEY,
+    summary TEXT NOT NULL,
+    covered_until_id INTEGER NOT NULL,   -- id последнего свёрнутого сообщения
+    updated_at INTEGER NOT NULL,         -- unix epoch
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+
+-- Индекс для чтения и подрезки истории пользователя по id
+CREATE INDEX IF NOT EXISTS idx_conversation_user
+ON conversation_history(user_id, id);
+
+-- Дневные агрегаты статистики (обновляются вместе с записью usage_stats)
+CREATE TABLE IF NOT EXISTS daily_action_counts (
+    day INTEGER NOT NULL,
+    action_type TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, action_type)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS daily_active_users (
+    day INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (day, user_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS daily_totals (
+    day INTEGER PRIMARY KEY,
+    actions INTEGER NOT NULL DEFAULT 0,
+    active_users INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+-- Кэш ответов AI для разделов, зависящих только от нумерологического профиля
+CREATE TABLE IF NOT EXISTS ai_response_cache (
+    key TEXT PRIMARY KEY,       -- раздел:sha256(версия шаблона, отпечаток профиля, ...)
+    feature TEXT NOT NULL,
+    response TEXT NOT NULL,     -- ответ с меткой {ИМЯ} вместо имени
+    created_at INTEGER NOT NULL,
+    last_hit_at INTEGER NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_ai_response_cache_last_hit ON ai_response_cache(last_hit_at);
+
+-- Расписание ежедневных прогнозов: слот доставки каждого получателя
+CREATE TABLE IF NOT EXISTS forecast_schedule (
+    user_id INTEGER PRIMARY KEY,
+    local_day INTEGER NOT NULL,          -- день прогноза по местному времени, YYYYMMDD
+    due_at INTEGER NOT NULL,             -- время отправки, unix epoch
+    attempts INTEGER NOT NULL DEFAULT 0  -- неудачных попыток доставки
+);
+
+CREATE INDEX IF NOT EXISTS idx_forecast_schedule_due ON forecast_schedule(due_at);
+
+-- Журнал запросов к AI (пишется пачками, отчёт /admin_costs)
+CREATE TABLE IF NOT EXISTS ai_calls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at INTEGER NOT NULL,            -- unix epoch
+    day INTEGER NOT NULL,                   -- YYYYMMDD
+    feature TEXT NOT NULL,                  -- раздел (ai_question, view_guide, daily_forecast, ...)
+    user_id INTEGER,                        -- NULL для фоновых запросов
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,   -- из них попало в кэш префикса
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    latency_ms INTEGER NOT NULL,            -- время запроса к DeepSeek без ожидания в очереди
+    finish_reason TEXT NOT NULL             -- stop, length, ... или error / cancelled
+);
+
+CREATE INDEX IF NOT EXISTS idx_ai_calls_day_feature ON ai_calls(day, feature);
+
+-- Отметки доставки рассылок: перезапущенная рассылка пропускает доставленное
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    run_id TEXT NOT NULL,                -- например daily_forecast:20250115
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL,                -- sent, blocked, failed
+    updated_at INTEGER NOT NULL,         -- unix epoch
+    PRIMARY KEY (run_id, user_id)
+) WITHOUT ROWID;
+
+-- Состояние диалога пользователя (мини-тест, ожидаемый платёж)
+CREATE TABLE IF NOT EXISTS user_sessions (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,                  -- JSON: test_state, pending_payment_id, ...
+    updated_at INTEGER NOT NULL          -- unix epoch
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_sessions_updated ON user_sessions(updated_at);
+
+-- Индексы под статистику, поиск по username, подписки и рассылку
+CREATE INDEX IF NOT EXISTS idx_usage_stats_timestamp ON usage_stats(timestamp, action_type);
+CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id, payment_status, expiry_date);
+CREATE INDEX IF NOT EXISTS idx_users_pro_until ON users(pro_until);
+CREATE INDEX IF NOT EXISTS idx_users_forecast ON users(user_id, pro_until)
+WHERE birthdate IS NOT NULL AND daily_forecast_enabled = 1 AND blocked_at IS NULL;
+
+-- Индексы по времени для ночной чистки по срокам хранения
+CREATE INDEX IF NOT EXISTS idx_conversation_timestamp ON conversation_history(timestamp);
+CREATE INDEX IF NOT EXISTS idx_conversation_summaries_updated ON conversation_summaries(updated_at);
+CREATE INDEX IF NOT EXISTS idx_ai_response_cache_created ON ai_response_cache(created_at);
+CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_updated ON broadcast_deliveries(updated_at);
 
 -- ================================================
 -- ОПИСАНИЕ ТАБЛИЦ
@@ -62,20 +172,26 @@ users:
   - user_id: Telegram user ID (первичный ключ)
   - username: Telegram username (может быть NULL)
   - name: Имя пользователя (из регистрации)
-  - birthdate: Дата рождения в формате ДД.ММ.ГГГГ
-  - registration_date: Дата регистрации (ISO 8601)
+  - birthdate: Дата рождения, число YYYYMMDD
+  - registration_date: Время регистрации (unix epoch)
   - state: Состояние бота (idle, awaiting_name, awaiting_birthdate, и т.д.)
   - language: Язык интерфейса (пока только 'ru')
   - daily_requests: Количество запросов сегодня
-  - last_request_date: Дата последнего запроса (YYYY-MM-DD)
+  - last_request_date: День последнего запроса (YYYYMMDD)
   - daily_forecast_enabled: Включена ли ежедневная рассылка (1/0)
+  - pro_until: Окончание PRO (unix epoch), максимум expiry_date по успешным
+    подпискам; обновляется в add_subscription
+  - blocked_at: Когда Telegram ответил, что чат недоступен (бот заблокирован
+    или аккаунт удалён); такие пользователи не получают рассылки.
+    Сбрасывается, когда пользователь снова пишет /start
+  - forecast_hour, timezone: Время ежедневного прогноза (команда /forecast_time)
 
 subscriptions:
   - id: Автоинкремент ID
   - user_id: Ссылка на пользователя
   - subscription_type: Тип подписки (PRO_MONTH, PRO_YEAR)
-  - start_date: Дата начала (ISO 8601)
-  - expiry_date: Дата окончания (ISO 8601)
+  - start_date: Начало (unix epoch)
+  - expiry_date: Окончание (unix epoch)
   - payment_status: Статус оплаты (succeeded, pending, cancelled)
   - payment_id: ID платежа в YooKassa или ADMIN_GRANT_*
   - auto_renew: Автопродление (1/0)
@@ -84,18 +200,71 @@ usage_stats:
   - id: Автоинкремент ID
   - user_id: Ссылка на пользователя
   - action_type: Тип действия (registration_complete, ai_question, и т.д.)
-  - timestamp: Время действия (ISO 8601)
+  - timestamp: Время действия (unix epoch)
+
+daily_action_counts / daily_active_users / daily_totals:
+  - day: День (YYYYMMDD)
+  - Количество действий по типам, уникальные активные пользователи и итоги дня.
+    Обновляются в той же транзакции, что и пачка usage_stats, поэтому
+    /admin и /admin_stats не сканируют usage_stats.
+
+ai_response_cache:
+  - key: Раздел и sha256 от версии шаблона промпта и отпечатка профиля
+    (числа сознания, миссии, действия, пустые цифры, корень финансового кода)
+  - feature: Раздел (view_practices, view_guide, view_media, view_calendar,
+    daily_forecast - текст прогноза когорты на день)
+  - response: Ответ AI, имя подставляется при показе вместо {ИМЯ}
+  - created_at / last_hit_at: Время создания и последнего использования (unix epoch)
+  - hits: Сколько раз ответ выдан из кэша (hits и last_hit_at пишутся пачками,
+    раз в STATS_FLUSH_INTERVAL_MS)
+  
+  Записи старше AI_CACHE_TTL_DAYS и давно не использованные сверх
+  AI_CACHE_MAX_ENTRIES удаляются ночным обслуживанием.
 
 conversation_history:
   - id: Автоинкремент ID
   - user_id: Ссылка на пользователя
   - role: Роль отправителя ('user' или 'assistant')
   - content: Текст сообщения
-  - timestamp: Время отправки (ISO 8601)
+  - timestamp: Время отправки (unix epoch)
   
   Эта таблица хранит историю диалогов с AI для каждого пользователя.
-  Последние 10-15 сообщений используются как контекст для DeepSeek API.
+  В user-сообщениях - только текст вопроса, профиль пользователя передаётся
+  в API отдельно и в историю не сохраняется.
   Автоматически подрезается до 15 последних сообщений на пользователя.
+
+conversation_summaries:
+  - user_id: Пользователь (первичный ключ)
+  - summary: Краткое резюме диалога до covered_until_id включительно
+  - covered_until_id: id последнего свёрнутого сообщения conversation_history
+  - updated_at: Время обновления резюме (unix epoch)
+  
+  В DeepSeek API уходят резюме и несвёрнутые сообщения (последние
+  HISTORY_VERBATIM_MESSAGES как есть) в пределах HISTORY_TOKEN_BUDGET.
+
+forecast_schedule:
+  Заполняется раз в сутки (и при запуске бота): каждому получателю - слот в
+  окне FORECAST_SPREAD_MINUTES от его часа, смещение постоянно для пользователя.
+  Задача доставки раз в FORECAST_TICK_SECONDS готовит тексты для ближайших
+  слотов и отправляет наступившие. Строка удаляется, когда прогноз доставлен
+  (или чат недоступен); после ошибки отправки или генерации слот переносится
+  на FORECAST_RETRY_MINUTES, после FORECAST_MAX_ATTEMPTS попыток - удаляется.
+
+user_sessions:
+  Состояние многошагового диалога (ответы мини-теста, payment_id ожидаемой
+  оплаты). Хранится в БД, а не в памяти процесса, поэтому следующий шаг может
+  обработать любой экземпляр бота. Удаляется через SESSION_RETENTION_DAYS дней.
+
+broadcast_deliveries:
+  Результат доставки каждого сообщения рассылки (пишется пачками раз в
+  BROADCAST_CHECKPOINT_INTERVAL_MS). При перезапуске рассылки с тем же run_id
+  сообщения со статусом sent и blocked не отправляются повторно, failed -
+  отправляются ещё раз. Хранится BROADCAST_RETENTION_DAYS дней.
+
+ai_calls:
+  Каждый запрос к DeepSeek API, включая неудачные (finish_reason = 'error').
+  Хранится USAGE_STATS_RETENTION_DAYS дней. Стоимость считается в отчёте
+  по ценам DEEPSEEK_PRICE_* из .env.
 */
 
 -- ================================================
@@ -106,20 +275,16 @@ conversation_history:
 -- SELECT role, content, timestamp
 -- FROM conversation_history
 -- WHERE user_id = ?
--- ORDER BY timestamp DESC
+-- ORDER BY id DESC
 -- LIMIT 10;
 
 -- Очистить историю пользователя
 -- DELETE FROM conversation_history WHERE user_id = ?;
 
 -- Подрезать историю, оставив последние 15 сообщений
+-- (граница - id 15-го с конца сообщения)
 -- DELETE FROM conversation_history
--- WHERE user_id = ? AND id NOT IN (
---     SELECT id FROM conversation_history
---     WHERE user_id = ?
---     ORDER BY timestamp DESC
---     LIMIT 15
--- );
+-- WHERE user_id = ? AND id < ?;
 
 -- Получить статистику по пользователям
 -- SELECT 
@@ -129,7 +294,7 @@ conversation_history:
 --         SELECT 1 FROM subscriptions s 
 --         WHERE s.user_id = u.user_id 
 --         AND s.payment_status = 'succeeded' 
---         AND s.expiry_date > datetime('now')
+--         AND s.expiry_date > unixepoch('now')
 --     ) THEN 'PRO' ELSE 'FREE' END as status,
 --     COUNT(DISTINCT ch.id) as message_count
 -- FROM users u